@@ -0,0 +1,144 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+MAX_OPEN_FILES = 64 # Số file giữ sẵn fd mở
+REVALIDATE_INTERVAL = 1.0 # Số giây giữa hai lần kiểm tra file trên đĩa có bị thay đổi không
+
+def advise(fd, offset, length, advice_name): # Gửi gợi ý posix_fadvise nếu hệ điều hành hỗ trợ
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def pread(fd, size, offset): # os.pread, hoặc lseek + read trên hệ điều hành không có pread
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+class CachedHandle:
+    """fd chỉ đọc của một file, dùng chung giữa các luồng (chỉ đọc bằng pread nên không có vị trí chung)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        stat = os.fstat(self.fd)
+        self.identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.size = stat.st_size
+        self.checked = time.monotonic()
+        self.refs = 0
+        self.retired = False
+
+class FileReader:
+    """Đối tượng giống file (fileno/seek/readinto) trên fd dùng chung, cho loop.sendfile."""
+
+    mode = "rb"
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.position = 0
+
+    def fileno(self):
+        return self.fd
+
+    def seek(self, position, whence=os.SEEK_SET):
+        self.position = position if whence == os.SEEK_SET else self.position + position
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        data = pread(self.fd, len(buffer), self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+class FileCache:
+    """Cache fd mở sẵn của các file hay được tải, dùng chung cho mọi kết nối của server.
+
+    Không có block cache: dữ liệu đi thẳng từ page cache của kernel (sendfile, mmap, pread)
+    nên giữ thêm bản sao trong bộ nhớ tiến trình không tiết kiệm được gì. hits/misses đếm
+    số lần dùng lại fd đang mở hoặc phải mở file. An toàn khi dùng từ nhiều luồng; stat và
+    open chạy ngoài lock để luồng đang mở file trên đĩa chậm không chặn các luồng khác.
+    """
+
+    def __init__(self, max_open_files=MAX_OPEN_FILES):
+        self.max_open_files = max_open_files
+        self.lock = threading.Lock()
+        self.handles = OrderedDict() # path -> CachedHandle, cuối danh sách là dùng gần nhất
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, path):
+        """Lấy fd của file (mở mới nếu chưa có hoặc file đã bị thay đổi); gọi release khi dùng xong."""
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is not None and time.monotonic() - handle.checked < REVALIDATE_INTERVAL:
+                return self.use(handle)
+        if handle is not None:
+            try:
+                stat = os.stat(path)
+                current = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                current = None
+            if current == handle.identity:
+                with self.lock:
+                    if self.handles.get(path) is handle:
+                        handle.checked = time.monotonic()
+                        return self.use(handle)
+        opened = CachedHandle(path)
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is None or handle.identity != opened.identity:
+                if handle is not None:
+                    self.retire(handle)
+                self.handles[path] = opened
+                while len(self.handles) > self.max_open_files:
+                    _, oldest = self.handles.popitem(last=False)
+                    self.retire(oldest)
+                self.misses += 1
+                opened.refs += 1
+                return opened
+            handle.checked = opened.checked
+            handle = self.use(handle)
+        os.close(opened.fd) # Luồng khác vừa mở cùng file: dùng fd của nó, đóng fd thừa
+        return handle
+
+    def use(self, handle): # Tăng số tham chiếu của handle đang có trong cache (gọi khi đang giữ lock)
+        self.handles.move_to_end(handle.path)
+        self.hits += 1
+        handle.refs += 1
+        return handle
+
+    def release(self, handle):
+        with self.lock:
+            handle.refs -= 1
+            if handle.retired and handle.refs == 0:
+                os.close(handle.fd)
+
+    def retire(self, handle): # Bỏ handle khỏi cache, đóng fd khi không còn luồng nào dùng (gọi khi đang giữ lock)
+        if self.handles.get(handle.path) is handle:
+            del self.handles[handle.path]
+        handle.retired = True
+        if handle.refs == 0:
+            os.close(handle.fd)
+
+    def advise_range(self, handle, offset, length): # Báo kernel sắp đọc tuần tự đoạn này
+        advise(handle.fd, offset, length, "POSIX_FADV_SEQUENTIAL")
+        advise(handle.fd, offset, length, "POSIX_FADV_WILLNEED")
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "open_files": len(self.handles),
+            }
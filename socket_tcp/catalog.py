@@ -0,0 +1,127 @@
+import os
+import time
+import threading
+from delta import match_blocks
+
+REFRESH_INTERVAL = 1.0 # Số giây tối thiểu giữa hai lần quét lại thư mục
+
+def human_size(size): # Hàm đổi số byte sang dạng dễ đọc, giống định dạng trong files.txt
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+
+class CatalogEntry:
+    """Thông tin một file trong danh mục."""
+
+    def __init__(self, name, size, mtime_ns):
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    @property
+    def version(self): # Dấu phiên bản client dùng để đối chiếu nhật ký tải dở
+        return f"{self.size}:{self.mtime_ns}"
+
+class FileCatalog:
+    """Danh mục các file server phục vụ: tên, kích thước và mtime.
+
+    Tra cứu theo tên là O(1). Thư mục được quét lại tối đa mỗi REFRESH_INTERVAL
+    giây; file không đổi (cùng kích thước và mtime) giữ nguyên entry.
+    """
+
+    def __init__(self, directory=".", listing_file="files.txt", refresh_interval=REFRESH_INTERVAL):
+        self.directory = directory
+        self.listing_file = listing_file
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.listed_names = [] # Thứ tự tên file công bố trong files.txt
+        self.listing_mtime_ns = None
+        self.listing_text = None # Chuỗi danh sách đã dựng sẵn, dựng lại khi có thay đổi
+        self.last_refresh = 0.0
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = now
+
+            changed = False
+            seen = {}
+            try:
+                with os.scandir(self.directory) as it:
+                    for dir_entry in it:
+                        if not dir_entry.is_file():
+                            continue
+                        stat = dir_entry.stat()
+                        entry = self.entries.get(dir_entry.name)
+                        if entry is None or entry.size != stat.st_size or entry.mtime_ns != stat.st_mtime_ns:
+                            entry = CatalogEntry(dir_entry.name, stat.st_size, stat.st_mtime_ns)
+                            changed = True
+                        seen[dir_entry.name] = entry
+            except OSError as e:
+                print(f"Không thể quét thư mục {self.directory}: {e}")
+                return
+            if len(seen) != len(self.entries):
+                changed = True
+            self.entries = seen
+
+            listing_path = os.path.join(self.directory, self.listing_file)
+            listing_entry = seen.get(self.listing_file)
+            listing_mtime_ns = listing_entry.mtime_ns if listing_entry else None
+            if listing_mtime_ns != self.listing_mtime_ns:
+                self.listing_mtime_ns = listing_mtime_ns
+                self.listed_names = self.read_listed_names(listing_path)
+                changed = True
+            if changed:
+                self.listing_text = None
+
+    def read_listed_names(self, listing_path): # Tên file là phần trước " : " trên mỗi dòng của files.txt
+        names = []
+        try:
+            with open(listing_path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        names.append(line.strip().split(" : ")[0])
+        except FileNotFoundError:
+            print(f"File not found: {listing_path}")
+        return names
+
+    def lookup(self, name):
+        """Trả về CatalogEntry của file hoặc None nếu không tồn tại."""
+        self.refresh()
+        return self.entries.get(name)
+
+    def listing(self):
+        """Danh sách file công bố, mỗi dòng "tên : kích thước dễ đọc : số byte : mtime_ns"."""
+        self.refresh()
+        with self.lock:
+            if self.listing_text is None:
+                lines = []
+                for name in self.listed_names:
+                    entry = self.entries.get(name)
+                    if entry is None:
+                        lines.append(f"{name} : (không có trên server)")
+                    else:
+                        lines.append(f"{name} : {human_size(entry.size)} : {entry.size} : {entry.mtime_ns}")
+                self.listing_text = "".join(line + "\n" for line in lines)
+            return self.listing_text
+
+    def delta(self, name, signature, block_size):
+        """Đối chiếu chữ ký các khối file cũ của client với file hiện tại.
+
+        Trả về (entry, các lệnh chép) hoặc None nếu không có file; file đổi trong lúc
+        quét thì không có lệnh chép nào (client tải lại cả file).
+        """
+        entry = self.lookup(name)
+        if entry is None:
+            return None
+        path = os.path.join(self.directory, name)
+        copies = match_blocks(path, entry.size, signature, block_size)
+        stat = os.stat(path)
+        if stat.st_size != entry.size or stat.st_mtime_ns != entry.mtime_ns:
+            copies = []
+        return entry, copies
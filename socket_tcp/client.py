@@ -2,15 +2,49 @@ import socket
 import time
 import threading
 import os
+import zlib
+import json
+import struct
+from collections import deque
 #from tkinter import filedialog
 from tkinter import Tk, Listbox, Button, filedialog
 from tqdm import tqdm
+from delta import block_size_for, file_signature, unpack_copies, SIGNATURE
+from compression import decompress_block, CODECS, BLOCK_SIZE as COMPRESSION_BLOCK_SIZE
+from protocol import (
+    FrameConnection, ProtocolError, COMPRESSION, BLOCK, FILE_INFO, RANGE, CRC, DELTA,
+    MSG_ERROR, MSG_LIST, MSG_STAT, MSG_FILE_INFO, MSG_DONE, MSG_CANCEL, MSG_QUIT,
+    MSG_RANGE, MSG_DATA, MSG_DATA_END, MSG_BLOCK, MSG_BATCH, MSG_DELTA, MSG_DELTA_PLAN, MSG_RANGE_CRC,
+    ROLE_CONTROL, ROLE_POOL, ROLE_BATCH,
+)
 
 HOST = input("Nhập Host IP: ") # Nhập IP của máy chủ server
 PORT = 65432    
 FORMAT = "utf8"
-progress = [0] * 4
-lock = threading.Lock()
+STREAM_BUFFER_SIZE = 256 * 1024 # Bộ đệm nhận cấp sẵn cho mỗi kết nối, dữ liệu đọc thẳng vào đây bằng recv_into
+COMPRESSION_CODEC = "zlib" # Bộ nén đề nghị với server: "none", "zlib" hoặc "lzma"; server gửi thô file không nén được
+COMPRESSION_LEVEL = 1 # Mức nén (0-9), mức thấp nén nhanh, đủ cho log và CSV
+MAX_WORKERS = 8 # Số kết nối tải song song tối đa cho một file
+MIN_PART_SIZE = 256 * 1024 # Kích thước nhỏ nhất của một đoạn con
+MAX_PART_SIZE = 16 * 1024 * 1024
+PARTS_PER_WORKER = 4 # Chia file thành nhiều đoạn hơn số luồng để luồng nhanh nhận thêm việc
+MIN_STEAL_SIZE = 128 * 1024 # Chỉ lấy bớt việc của luồng khác khi phần còn lại đủ lớn
+MAX_RANGE_FAILURES = 3
+BUSY_RETRY_DELAY = 1 # Giây chờ trước khi thử lại khi server đã đủ kết nối tải
+SINGLE_CONNECTION_SECONDS = 0.5 # File tải xong dưới ngưỡng này bằng một kết nối thì không chia luồng
+measured_throughput = None # Tốc độ trung bình (byte/s) của một kết nối, đo từ các lần tải trước
+POOL_IDLE_TIMEOUT = 20 # Bỏ kết nối rảnh trong pool trước khi server đóng nó (30s)
+JOURNAL_DIR = ".journal" # Thư mục ẩn trong thư mục tải, chứa nhật ký tải của từng file
+BATCH_MAX_FILE_SIZE = 1024 * 1024 # File nhỏ hơn ngưỡng này được tải gộp trong một luồng dữ liệu
+BATCH_MIN_FILES = 2
+BATCH_HEADER = struct.Struct("!BHQQ") # Header mỗi file khi tải gộp: trạng thái, độ dài tên, kích thước, mtime_ns
+BATCH_CRC = struct.Struct("!I")
+BATCH_BLOCK = struct.Struct("!BI") # Đầu mỗi khối của file nén khi tải gộp: bộ nén của khối, độ dài
+BATCH_FILE, BATCH_MISSING, BATCH_END, BATCH_FILE_COMPRESSED = 0, 1, 2, 3
+DELTA_MODE = True # File đã có bản cũ trong thư mục tải: chỉ tải các khối đã đổi (đồng bộ delta)
+DELTA_MIN_SIZE = 1024 * 1024 # File nhỏ hơn thì tải lại cả file
+COPY_BUFFER_SIZE = 1024 * 1024 # Mỗi lần chép khi dựng lại file từ bản cũ
+chunk_pool = None # Pool kết nối ROLE_POOL dùng chung cho mọi file, tạo khi bắt đầu tải
 
 def read_new_files(file_name, already_downloaded): # Hàm đọc file và trả về danh sách các file mới cần tải
     try:
@@ -25,131 +59,487 @@ def read_new_files(file_name, already_downloaded): # Hàm đọc file và trả
         print(f"Có lỗi khi đọc file '{file_name}': {e}")
         return []
 
-def write_data_into_file(chunk_paths, download_folder_path, file_name):# Hàm ghi dữ liệu (chunk) vào file
-    downloaded_file = os.path.join(download_folder_path, file_name)
-    with open(downloaded_file, 'wb') as f:
-        for chunk_data in chunk_paths:
-            if chunk_data is not None:
-                f.write(chunk_data) 
-    
+def prepare_output_file(file_path, file_size): # Hàm tạo trước file đích với đúng kích thước để các luồng ghi thẳng vào vị trí của mình
+    fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        os.ftruncate(fd, file_size)
+        if file_size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, file_size) # Cấp phát trước block trên đĩa, tránh phân mảnh
+            except OSError:
+                pass # Hệ thống file không hỗ trợ, ftruncate là đủ
+    finally:
+        os.close(fd)
+
+def open_output_file(file_path): # Mỗi luồng mở một fd riêng để ghi theo vị trí
+    return os.open(file_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+
+def write_at(fd, data, offset): # Hàm ghi data vào file tại offset (pwrite, không cần seek chung)
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+def read_at(fd, size, offset): # Hàm đọc size byte tại offset (pread, hoặc lseek + read)
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def apply_copies(file_path, copies): # Hàm chép các khối dùng lại tới vị trí mới ngay trong file cũ, theo offset đích tăng dần
+    fd = os.open(file_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        for target, source, length in copies:
+            if source == target:
+                continue # Khối không dời chỗ: không cần đọc ghi
+            # Nguồn luôn ở sau đích nên chép xuôi không ghi đè phần nguồn chưa đọc
+            for offset in range(0, length, COPY_BUFFER_SIZE):
+                write_at(fd, read_at(fd, min(COPY_BUFFER_SIZE, length - offset), source + offset), target + offset)
+    finally:
+        os.close(fd)
+
+def print_download_done(file_name, downloaded_file):
     print("\n")
     print(f"File '{file_name}' đã được tải xuống thành công tại {downloaded_file}.\n\n")
     print("--------------------------------------------------------------------------------\n")
 
 
 
-# Thêm Barrier để đồng bộ hóa các luồng
-barrier = threading.Barrier(4)  # Đồng bộ hóa 4 luồng
-
-def download_chunk(host, port, file_name, chunk_paths, chunk_index, start, end, progress_bars, lock):
-    """Tải xuống một chunk từ server."""
+class DownloadJournal:
+    """Nhật ký tải của một file, lưu trong thư mục ẩn của thư mục tải (.journal/<file>).
+
+    Ghi lại các đoạn byte đã tải xong, kích thước và phiên bản file trên server
+    (kích thước:mtime) để lần chạy sau chỉ tải phần còn thiếu.
+    """
+
+    def __init__(self, output_path, file_size, version):
+        folder, name = os.path.split(output_path)
+        self.path = os.path.join(folder, JOURNAL_DIR, name)
+        self.file_size = file_size
+        self.version = version
+        self.lock = threading.Lock()
+        self.ranges = [] # Các đoạn [start, end] đã tải, đã sắp xếp và gộp
+        self.complete = False
+
+        state = self.load()
+        if (
+            state is not None
+            and version is not None
+            and state.get("version") == version
+            and state.get("size") == file_size
+            and os.path.exists(output_path)
+            and os.path.getsize(output_path) == file_size
+        ):
+            self.ranges = [tuple(r) for r in state.get("ranges", [])]
+            self.complete = state.get("complete", False)
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self): # Ghi ra file tạm rồi đổi tên để nhật ký không bị hỏng nếu client dừng giữa chừng
+        state = {"size": self.file_size, "version": self.version, "ranges": self.ranges, "complete": self.complete}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path)
+
+    def missing_ranges(self):
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < self.file_size:
+            missing.append((position, self.file_size - 1))
+        return missing
+
+    def add(self, start, end):
+        self.add_ranges([(start, end)])
+
+    def add_ranges(self, ranges):
+        with self.lock:
+            merged = []
+            for r_start, r_end in sorted(self.ranges + list(ranges)):
+                if merged and r_start <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], r_end))
+                else:
+                    merged.append((r_start, r_end))
+            self.ranges = merged
+            self.save()
+
+    def mark_complete(self):
+        with self.lock:
+            self.ranges = [(0, self.file_size - 1)] if self.file_size else []
+            self.complete = True
+            self.save()
+
+class RangeScheduler:
+    """Hàng đợi các đoạn con của file dùng chung cho các luồng tải.
+
+    Luồng nào rảnh thì lấy đoạn tiếp theo; khi hàng đợi hết, luồng rảnh lấy
+    nửa sau phần còn lại của luồng đang chậm nhất (work stealing).
+    """
+
+    def __init__(self, ranges, part_size):
+        self.lock = threading.Lock()
+        self.pending = deque(
+            (start, min(start + part_size - 1, range_end))
+            for range_start, range_end in ranges
+            for start in range(range_start, range_end + 1, part_size)
+        )
+        self.active = {} # worker_id -> [vị trí tiếp theo, offset cuối, offset đầu]
+        self.done_bytes = 0
+
+    def next_range(self, worker_id):
+        with self.lock:
+            if self.pending:
+                start, end = self.pending.popleft()
+            else:
+                # Lấy bớt phần còn lại của luồng có nhiều byte chưa tải nhất
+                victim = max(self.active.values(), key=lambda r: r[1] - r[0], default=None)
+                if victim is None or victim[1] - victim[0] + 1 < 2 * MIN_STEAL_SIZE:
+                    return None
+                start = victim[0] + (victim[1] - victim[0] + 1) // 2
+                end = victim[1]
+                victim[1] = start - 1
+            self.active[worker_id] = [start, end, start]
+            return start, end
+
+    def accept(self, worker_id, size):
+        """Ghi nhận size byte vừa nhận, trả về (offset ghi, số byte còn thuộc về luồng này)."""
+        with self.lock:
+            current = self.active[worker_id]
+            size = max(0, min(size, current[1] - current[0] + 1))
+            offset = current[0]
+            current[0] += size
+            self.done_bytes += size
+            return offset, size
+
+    def remaining(self, worker_id):
+        with self.lock:
+            current = self.active[worker_id]
+            return current[1] - current[0] + 1
+
+    def release(self, worker_id):
+        """Kết thúc đoạn hiện tại (đã khớp CRC), trả về (start, end) phần luồng này đã tải."""
+        with self.lock:
+            current = self.active.pop(worker_id)
+            return current[2], current[0] - 1
+
+    def fail(self, worker_id):
+        """Đoạn hiện tại lỗi: phần đã ghi chưa được kiểm CRC nên cả phần thuộc về luồng này
+        (trừ phần cuối luồng khác đã lấy) trả về hàng đợi. Trả về số byte đã ghi bị bỏ."""
+        with self.lock:
+            current = self.active.pop(worker_id)
+            if current[2] <= current[1]:
+                self.pending.append((current[2], current[1]))
+            discarded = current[0] - current[2]
+            self.done_bytes -= discarded
+            return discarded
+
+def plan_download(file_size): # Hàm chọn số luồng và kích thước đoạn theo kích thước file và tốc độ đo được
+    if measured_throughput and file_size / measured_throughput < SINGLE_CONNECTION_SECONDS:
+        num_workers = 1 # Một kết nối đã tải xong đủ nhanh, không cần mở thêm
+    else:
+        num_workers = max(1, min(MAX_WORKERS, file_size // MIN_PART_SIZE))
+    part_size = file_size // (num_workers * PARTS_PER_WORKER)
+    part_size = max(MIN_PART_SIZE, min(MAX_PART_SIZE, part_size))
+    return num_workers, part_size
+
+class ChunkPoolUnsupported(Exception):
+    pass
+
+class ServerBusy(Exception): # Server đã đủ kết nối tải, từ chối kết nối mới (MSG_ERROR "BUSY")
+    pass
+
+class ChunkConnection(FrameConnection):
+    """Một kết nối khung ROLE_POOL tới server, dùng lại cho nhiều yêu cầu đoạn của nhiều file."""
+
+    def __init__(self, host, port, role=ROLE_POOL):
+        super().__init__(socket.create_connection((host, port)))
+        self.last_used = time.monotonic()
+        self.receive_buffer = memoryview(bytearray(STREAM_BUFFER_SIZE)) # Dùng lại cho mọi đoạn tải trên kết nối này
+        try:
+            self.version, _ = self.hello(role, options=COMPRESSION.pack(CODECS[COMPRESSION_CODEC], COMPRESSION_LEVEL))
+        except (ProtocolError, ConnectionError) as e:
+            self.sock.close()
+            if str(e) == "BUSY":
+                raise ServerBusy("Server đã đủ kết nối tải.")
+            raise ChunkPoolUnsupported(f"Server không hỗ trợ kết nối vai trò {role}: {e}")
+        except Exception:
+            self.sock.close()
+            raise
+
+    def request(self, file_name, start, end): # Gửi khung MSG_RANGE, trả về mã yêu cầu
+        return self.send(MSG_RANGE, RANGE.pack(start, end) + file_name.encode(FORMAT))
+
+    def read_block(self, codec, length, max_size): # Nhận length byte của một khối nén vào bộ đệm, trả về dữ liệu đã giải nén
+        if length > len(self.receive_buffer):
+            raise ProtocolError("Khối nén quá lớn.")
+        block = self.receive_buffer[:length]
+        self.read_exact_into(block)
+        return decompress_block(codec, block, max_size)
+
+class ChunkConnectionPool:
+    """Giữ các kết nối ROLE_POOL đang rảnh để luồng tải sau (kể cả của file khác) dùng lại."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        with self.lock:
+            while self.idle:
+                connection = self.idle.pop()
+                if time.monotonic() - connection.last_used < POOL_IDLE_TIMEOUT:
+                    return connection
+                connection.close() # Server có thể đã đóng kết nối rảnh lâu
+        return ChunkConnection(self.host, self.port)
+
+    def release(self, connection):
+        connection.last_used = time.monotonic()
+        with self.lock:
+            self.idle.append(connection)
+
+def verify_range(file_name, start, end, crc): # Hỏi CRC32 của đoạn [start, end] (MSG_RANGE_CRC), lỗi nếu khác crc
+    connection = chunk_pool.acquire()
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((host, port))
-        client_socket.sendall("CHUNK".encode(FORMAT))
-        response = client_socket.recv(1024).decode(FORMAT)
-
-        if response != "READY":
-            raise Exception("Server không sẵn sàng.")
-
-        request = f"CHUNK_REQUEST:{file_name}:{chunk_index}:{start}:{end}"
-        client_socket.sendall(request.encode(FORMAT))
-
-        response = client_socket.recv(1024).decode(FORMAT)
-        if response != "DATA_START":
-            raise Exception("Không nhận được tín hiệu bắt đầu.")
-
-        client_socket.sendall("READY_FOR_DATA".encode(FORMAT))
-        chunk_data = bytearray()
-        total_received = 0
-        chunk_size = end - start + 1
-
-        # Thanh tiến trình cho từng chunk
-        chunk_progress = progress_bars[chunk_index]
-
-        while True:
-            data = client_socket.recv(1024)
-            if data == b"DATA_END":
-                break
-            chunk_data.extend(data)
+        request_id = connection.send(MSG_RANGE_CRC, RANGE.pack(start, end) + file_name.encode(FORMAT))
+        kind, reply_id, payload = connection.read_frame()
+        if reply_id != request_id:
+            raise ProtocolError("Khung trả lời không khớp với yêu cầu.")
+    except Exception:
+        connection.close()
+        raise
+    chunk_pool.release(connection)
+    if kind != MSG_DATA_END or CRC.unpack(payload)[0] != crc:
+        raise Exception("Sai CRC32 của chunk.")
+
+def download_pooled_range(connection, file_name, output_fd, scheduler, worker_id, start, end, progress_bar, lock):
+    """Tải đoạn [start, end] trên kết nối dùng lại.
+
+    Server trả lời bằng một khung MSG_DATA (dữ liệu thô), hoặc bằng các khung MSG_BLOCK
+    nén độc lập khi đã thỏa thuận nén và file nén được.
+    Trả về (số byte đã ghi, kết nối còn dùng lại được hay không); chỉ trả về khi phần
+    đã ghi khớp CRC32 của server.
+    """
+    request_id = connection.request(file_name, start, end)
+    kind, reply_id, length = connection.read_header()
+    if kind == MSG_ERROR:
+        raise Exception(f"Server từ chối đoạn {start}-{end}: {connection.read_exact(length).decode(FORMAT)}")
+    if kind not in (MSG_DATA, MSG_BLOCK) or reply_id != request_id:
+        raise ProtocolError("Khung trả lời không khớp với yêu cầu.")
+    if kind == MSG_DATA and length != end - start + 1:
+        raise Exception("Số byte server báo không khớp với yêu cầu.")
+
+    total_received = 0
+    accepted = 0
+    crc = 0
+    accepted_crc = 0 # CRC32 của phần đã ghi, khác crc khi luồng khác đã lấy bớt phần cuối
+    while total_received < end - start + 1:
+        remaining = scheduler.remaining(worker_id)
+        if remaining <= 0:
+            # Phần cuối đã được luồng khác tải, server vẫn đang gửi nên phải bỏ kết nối này.
+            # MSG_DATA_END sẽ mang CRC của cả đoạn: hỏi riêng CRC của phần đã ghi
+            if accepted:
+                verify_range(file_name, start, start + accepted - 1, accepted_crc)
+            return accepted, False
+        if kind == MSG_BLOCK:
+            if total_received:
+                kind, reply_id, length = connection.read_header()
+                if kind != MSG_BLOCK or reply_id != request_id:
+                    raise ProtocolError("Khung trả lời không khớp với yêu cầu.")
+            codec = BLOCK.unpack(connection.read_exact(BLOCK.size))[0]
+            data = connection.read_block(codec, length - BLOCK.size, min(COMPRESSION_BLOCK_SIZE, end - start + 1 - total_received))
+        else:
+            # Không đọc quá khung MSG_DATA: phần sau là khung MSG_DATA_END
+            count = connection.recv_into(connection.receive_buffer[:min(STREAM_BUFFER_SIZE, remaining, end - start + 1 - total_received)])
+            data = connection.receive_buffer[:count]
+        crc = zlib.crc32(data, crc)
+        total_received += len(data)
+
+        offset, size = scheduler.accept(worker_id, len(data))
+        if size:
+            accepted += size
+            accepted_crc = zlib.crc32(data[:size], accepted_crc)
+            write_at(output_fd, data[:size], offset)
             with lock:
-                chunk_progress.update(len(data))
-            client_socket.sendall("DATA_ACK".encode(FORMAT))
-            total_received += len(data)
-            # Đồng bộ hóa các luồng sau mỗi lần tải xong một đoạn nhỏ
-            barrier.wait()
-
-        chunk_paths[chunk_index] = chunk_data
-    except Exception as e:
-        print(f"Lỗi khi tải chunk {chunk_index}: {e}")
+                progress_bar.update(size)
+
+    kind, reply_id, payload = connection.read_frame()
+    if kind != MSG_DATA_END or reply_id != request_id or CRC.unpack(payload)[0] != crc:
+        raise Exception("Sai CRC32 của chunk.")
+    return accepted, True
+
+def download_worker(file_name, output_path, scheduler, journal, worker_id, progress_bar, lock, rates):
+    """Luồng tải: lấy lần lượt các đoạn từ scheduler cho đến khi hết việc, trên kết nối lấy từ chunk_pool."""
+    output_fd = open_output_file(output_path)
+    connection = None
+    failures = 0
+    received = 0
+    started = time.monotonic()
+    try:
+        while failures < MAX_RANGE_FAILURES:
+            next_range = scheduler.next_range(worker_id)
+            if next_range is None:
+                break
+            start, end = next_range
+            try:
+                if connection is None:
+                    connection = chunk_pool.acquire()
+                accepted, reusable = download_pooled_range(
+                    connection, file_name, output_fd, scheduler, worker_id, start, end, progress_bar, lock
+                )
+                if not reusable:
+                    connection.close()
+                    connection = None
+                received += accepted
+                done_start, done_end = scheduler.release(worker_id)
+                failures = 0
+            except Exception as e:
+                print(f"Lỗi khi tải đoạn {start}-{end}: {e}")
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                discarded = scheduler.fail(worker_id) # Cả đoạn được tải lại, kể cả phần đã ghi
+                with lock:
+                    progress_bar.update(-discarded)
+                failures += 1
+                if isinstance(e, ServerBusy):
+                    time.sleep(BUSY_RETRY_DELAY) # Các luồng đã có kết nối vẫn tải tiếp đoạn vừa trả về hàng đợi
+                continue
+            if done_end >= done_start:
+                journal.add(done_start, done_end) # Đoạn đã khớp CRC và đã ghi xuống file, lần sau không cần tải lại
     finally:
-        client_socket.close()
-        chunk_progress.close()  # Đóng thanh tiến trình sau khi hoàn tất
-
-def download_file(client, file_name, gui_listbox):
-    """Tải xuống file từ server theo từng chunk."""
+        if connection is not None:
+            chunk_pool.release(connection)
+        os.close(output_fd)
+        elapsed = time.monotonic() - started
+        if received and elapsed > 0:
+            rates.append(received / elapsed)
+
+def sync_delta(client, file_name, output_path, file_size, version, journal):
+    """Đồng bộ delta với bản cũ (phiên bản khác) của file đã có trong thư mục tải.
+
+    Gửi chữ ký các khối của bản cũ trong một khung MSG_DELTA; server trả về các đoạn
+    của file mới trùng với khối nào của bản cũ. Các đoạn đó được chép tại chỗ và ghi
+    vào nhật ký, phần còn thiếu tải như bình thường. Trả về số byte dùng lại được.
+    """
+    basis_size = os.path.getsize(output_path)
+    block_size = block_size_for(basis_size)
+    signature = file_signature(output_path, block_size)
+    if not signature:
+        return 0
+    name = file_name.encode(FORMAT)
+    request_id = client.send(MSG_DELTA, DELTA.pack(block_size, 0, len(signature) // SIGNATURE.size, len(name)) + name + signature)
+    kind, reply_id, payload = client.read_frame()
+    if reply_id != request_id:
+        raise ProtocolError("Khung trả lời không khớp với yêu cầu.")
+    if kind != MSG_DELTA_PLAN:
+        return 0 # Server không hỗ trợ đồng bộ delta: tải cả file
+    size, mtime_ns = FILE_INFO.unpack_from(payload)
+    if f"{size}:{mtime_ns}" != version:
+        return 0 # File trên server vừa đổi lần nữa
+    copies = unpack_copies(payload[FILE_INFO.size:], file_size, basis_size)
+    # Nhật ký mang phiên bản mới trước khi sửa file: dừng giữa chừng thì lần sau không tin vào bản cũ
+    journal.save()
+    apply_copies(output_path, copies)
+    journal.add_ranges((target, target + length - 1) for target, _, length in copies)
+    return sum(length for _, _, length in copies)
+
+def download_file(client, file_name, file_size, gui_listbox, version=None):
+    """Tải xuống file từ server theo từng đoạn, số luồng tùy theo kích thước file.
+
+    Kích thước và phiên bản đã có từ MSG_FILE_INFO; client là kết nối điều khiển để báo MSG_DONE/MSG_CANCEL.
+    """
+    global measured_throughput, chunk_pool
+    if chunk_pool is None:
+        chunk_pool = ChunkConnectionPool(HOST, PORT)
     try:
         print("--------------------------------------------------------------------------------\n")
         print(f"Đang tải file '{file_name}'...")
 
-        while True:
-            file_size_str = client.recv(1024).decode(FORMAT).strip()
-            if not file_size_str.isdigit() or int(file_size_str) <= 0:
-                print("Kích thước file không hợp lệ, yêu cầu server gửi lại.")
-                client.sendall("INVALID_FILE_SIZE".encode(FORMAT))
-            else:
-                file_size = int(file_size_str)
-                client.sendall("VALID_FILE_SIZE".encode(FORMAT))
-                break
-
         # Chọn thư mục để lưu file
         download_folder_path = filedialog.askdirectory(title=f"Chọn thư mục lưu file {file_name}")
         if not download_folder_path:
             print("Chưa chọn thư mục tải về. Hủy quá trình tải.\n")
-            client.sendall("CANCEL".encode(FORMAT))
+            client.send(MSG_CANCEL, file_name.encode(FORMAT))
             return
 
-        # Chia kích thước file thành các chunk
-        num_chunks = 4
-        chunk_size = file_size // num_chunks
+        # Đọc nhật ký tải: bỏ qua file đã tải đủ, chỉ tải lại các đoạn còn thiếu
+        output_path = os.path.join(download_folder_path, file_name)
+        journal = DownloadJournal(output_path, file_size, version)
+        if journal.complete:
+            print(f"File '{file_name}' đã có sẵn tại {output_path}, bỏ qua.\n")
+            client.send(MSG_DONE, file_name.encode(FORMAT))
+            gui_listbox.insert('end', file_name)
+            return
+        missing = journal.missing_ranges()
+        missing_size = sum(end - start + 1 for start, end in missing)
+        if missing_size != file_size:
+            print(f"Tiếp tục tải dở: còn {missing_size}/{file_size} bytes.")
+        elif DELTA_MODE and file_size >= DELTA_MIN_SIZE and os.path.exists(output_path):
+            reused = sync_delta(client, file_name, output_path, file_size, version, journal)
+            if reused:
+                missing = journal.missing_ranges()
+                missing_size = sum(end - start + 1 for start, end in missing)
+                print(f"Đồng bộ delta: dùng lại {reused}/{file_size} bytes từ bản cũ, còn tải {missing_size} bytes.")
+
+        # Chọn số luồng và kích thước đoạn
+        num_workers, part_size = plan_download(missing_size)
+        scheduler = RangeScheduler(missing, part_size)
         threads = []
-        chunk_paths = [None] * num_chunks
-
-        # Tạo thanh tiến trình cho từng chunk
-        progress_bars = [
-            tqdm(
-                total=chunk_size if i != num_chunks - 1 else file_size - (num_chunks - 1) * chunk_size,
-                desc=f"Downloading {file_name} part {i + 1}",
-                unit="bytes",
-                unit_scale=True,
-                # dynamic_ncols=True,
-                bar_format="{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} {unit}",
-            )
-            for i in range(num_chunks)
-        ]
+        rates = []
+
+        # Tạo trước file đích (giữ nguyên dữ liệu đã tải), các luồng ghi trực tiếp vào phần của mình
+        prepare_output_file(output_path, file_size)
 
-        for i in range(num_chunks):
-            start = i * chunk_size
-            end = file_size - 1 if i == num_chunks - 1 else (start + chunk_size - 1)
+        progress_bar = tqdm(
+            total=file_size,
+            initial=file_size - missing_size,
+            desc=f"Downloading {file_name} ({num_workers} kết nối)",
+            unit="bytes",
+            unit_scale=True,
+            bar_format="{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} {unit}",
+        )
+
+        for i in range(num_workers):
             thread = threading.Thread(
-                target=download_chunk,
-                args=(HOST, PORT, file_name, chunk_paths, i, start, end, progress_bars, threading.Lock())
+                target=download_worker,
+                args=(file_name, output_path, scheduler, journal, i, progress_bar, threading.Lock(), rates)
             )
             threads.append(thread)
             thread.start()
-            time.sleep(0.7)
 
         for thread in threads:
             thread.join()
+        progress_bar.close()
+
+        # Cập nhật tốc độ trung bình của một kết nối cho lần tải sau
+        if rates:
+            rate = sum(rates) / len(rates)
+            measured_throughput = rate if measured_throughput is None else 0.7 * measured_throughput + 0.3 * rate
 
         # Kiểm tra xem đã nhận đủ byte của file chưa
-        total_received = sum(len(chunk) for chunk in chunk_paths if chunk is not None)
-        if total_received != file_size:
+        if scheduler.done_bytes != missing_size:
             raise Exception("Không nhận đủ dữ liệu.")
+        journal.mark_complete()
 
-        # Ghi dữ liệu vào file
-        write_data_into_file(chunk_paths, download_folder_path, file_name)
-        client.sendall("DONE".encode(FORMAT))
+        print_download_done(file_name, output_path)
+        client.send(MSG_DONE, file_name.encode(FORMAT))
 
         gui_listbox.insert('end', file_name)
 
@@ -158,6 +548,126 @@ def download_file(client, file_name, gui_listbox):
 
 
 
+def download_batch(file_names, server_files, gui_listbox):
+    """Tải gộp nhiều file nhỏ trên một kết nối ROLE_BATCH, tách và ghi từng file ngay khi nhận.
+
+    Trả về tập tên các file đã tải đủ (kể cả file đã có sẵn từ lần trước); các file còn lại
+    được tải lần lượt như cũ, kể cả khi server không hỗ trợ tải gộp hay luồng gộp bị lỗi giữa chừng.
+    Nếu người dùng không chọn thư mục thì cả nhóm coi như đã xử lý, giống khi hủy tải một file.
+    """
+    print("--------------------------------------------------------------------------------\n")
+    print(f"Đang tải gộp {len(file_names)} file nhỏ...")
+    download_folder_path = filedialog.askdirectory(title=f"Chọn thư mục lưu {len(file_names)} file")
+    if not download_folder_path:
+        print("Chưa chọn thư mục tải về. Hủy quá trình tải.\n")
+        return set(file_names)
+
+    # Bỏ qua các file đã tải đủ ở lần chạy trước
+    completed = set()
+    requested = []
+    for name in file_names:
+        size, version = server_files[name]
+        if DownloadJournal(os.path.join(download_folder_path, name), size, version).complete:
+            print(f"File '{name}' đã có sẵn, bỏ qua.")
+            gui_listbox.insert('end', name)
+            completed.add(name)
+        else:
+            requested.append(name)
+    if not requested:
+        return completed
+
+    try:
+        connection = ChunkConnection(HOST, PORT, ROLE_BATCH)
+    except ChunkPoolUnsupported:
+        print("Server không hỗ trợ tải gộp, tải lần lượt từng file.")
+        return completed
+    except ServerBusy:
+        print("Server đã đủ kết nối tải, tải lần lượt từng file.")
+        return completed
+    progress_bar = tqdm(
+        total=sum(server_files[name][0] for name in requested),
+        desc=f"Downloading {len(requested)} files",
+        unit="bytes",
+        unit_scale=True,
+        bar_format="{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} {unit}",
+    )
+    try:
+        connection.send(MSG_BATCH, "\n".join(requested).encode(FORMAT))
+        while True:
+            header = connection.receive_buffer[:BATCH_HEADER.size]
+            connection.read_exact_into(header)
+            status, name_length, size, mtime_ns = BATCH_HEADER.unpack(header)
+            if status == BATCH_END:
+                break
+            name = connection.read_exact(name_length).decode(FORMAT)
+            if status == BATCH_MISSING:
+                print(f"Không thể tải file '{name}'.\n")
+                continue
+            if status not in (BATCH_FILE, BATCH_FILE_COMPRESSED):
+                raise ProtocolError(f"Trạng thái tải gộp không hợp lệ: {status}.")
+            compressed = status == BATCH_FILE_COMPRESSED
+
+            output_path = os.path.join(download_folder_path, name)
+            prepare_output_file(output_path, size)
+            output_fd = open_output_file(output_path)
+            try:
+                received = 0
+                crc = 0
+                while received < size:
+                    if compressed:
+                        block_header = connection.receive_buffer[:BATCH_BLOCK.size]
+                        connection.read_exact_into(block_header)
+                        codec, length = BATCH_BLOCK.unpack(block_header)
+                        data = connection.read_block(codec, length, min(COMPRESSION_BLOCK_SIZE, size - received))
+                    else:
+                        count = connection.recv_into(connection.receive_buffer[:min(STREAM_BUFFER_SIZE, size - received)])
+                        data = connection.receive_buffer[:count]
+                    write_at(output_fd, data, received)
+                    crc = zlib.crc32(data, crc)
+                    received += len(data)
+                    progress_bar.update(len(data))
+            finally:
+                os.close(output_fd)
+            trailer = connection.receive_buffer[:BATCH_CRC.size]
+            connection.read_exact_into(trailer)
+            if BATCH_CRC.unpack(trailer)[0] != crc:
+                raise Exception(f"Sai CRC32 của file '{name}'.")
+
+            DownloadJournal(output_path, size, f"{size}:{mtime_ns}").mark_complete()
+            gui_listbox.insert('end', name)
+            completed.add(name)
+        print(f"\nĐã tải gộp xong vào {download_folder_path}.\n")
+    except Exception as e:
+        print(f"Lỗi khi tải gộp: {e}")
+    finally:
+        progress_bar.close()
+        connection.close()
+    if len(completed) < len(file_names):
+        print(f"Tải lần lượt {len(file_names) - len(completed)} file chưa tải gộp được.")
+    return completed
+
+def request_listing(client): # Hàm lấy danh sách file từ server (MSG_LIST)
+    client.send(MSG_LIST)
+    _, _, payload = client.read_frame()
+    return payload.decode(FORMAT)
+
+def stat_files(client, file_names):
+    """Hỏi kích thước và phiên bản của nhiều file, trả về {tên file: (kích thước, phiên bản)}.
+
+    Mọi khung MSG_STAT được gửi dồn trước rồi mới đọc các trả lời (theo đúng thứ tự),
+    nên cả danh sách chỉ tốn một vòng hỏi đáp. File không có trên server không nằm trong kết quả.
+    """
+    request_ids = [client.send(MSG_STAT, name.encode(FORMAT)) for name in file_names]
+    files = {}
+    for name, request_id in zip(file_names, request_ids):
+        kind, reply_id, payload = client.read_frame()
+        if reply_id != request_id:
+            raise ProtocolError("Khung trả lời không khớp với yêu cầu.")
+        if kind == MSG_FILE_INFO:
+            size, mtime_ns = FILE_INFO.unpack(payload)
+            files[name] = (size, f"{size}:{mtime_ns}")
+    return files
+
 def control_files_to_download(client, file_name, gui_listbox, root): # Hàm giám sát file input.txt, đảm bảo quét 5s một lần
     already_downloaded = set()  # Lưu danh sách các file đã tải
     print("Bắt đầu giám sát file input.txt. Nhấn Ctrl+C để dừng.\n\n")
@@ -167,23 +677,32 @@ def control_files_to_download(client, file_name, gui_listbox, root): # Hàm giá
             new_files = read_new_files(file_name, already_downloaded)
             if new_files:
                 print(f"Các file mới cần tải: {new_files}\n")
+                # Hỏi kích thước và phiên bản của mọi file mới trong một lượt gửi dồn
+                server_files = stat_files(client, new_files)
             else:
                 print("Không có File cần tải xuống!")
+                server_files = {}
 
-            for file in new_files:
-                client.sendall(file.encode(FORMAT))
-                response = client.recv(1024).decode(FORMAT)
+            # Gộp các file nhỏ vào một lần tải để không mất nhiều vòng hỏi đáp cho từng file
+            small_files = [f for f in new_files if f in server_files and server_files[f][0] <= BATCH_MAX_FILE_SIZE]
+            if len(small_files) >= BATCH_MIN_FILES:
+                # File nào chưa tải gộp xong thì tải lần lượt ngay trong lượt này
+                batched = download_batch(small_files, server_files, gui_listbox)
+                already_downloaded.update(batched)
+                new_files = [f for f in new_files if f not in batched]
 
-                if response == "OK":
-                    download_file(client, file, gui_listbox)
-                    time.sleep(0.5)
-                elif response == "NOT_FOUND":
+            for file in new_files:
+                # Phiên bản file trên server dùng để đối chiếu với nhật ký tải dở
+                if file in server_files:
+                    file_size, version = server_files[file]
+                    download_file(client, file, file_size, gui_listbox, version)
+                else:
                     print(f"Không thể tải file '{file}'.\n")
                 already_downloaded.add(file) # Đánh dấu file đã tải
 
             time.sleep(5)  # Chờ 5 giây trước khi quét lại
     except KeyboardInterrupt:
-        client.sendall("QUIT".encode(FORMAT))
+        client.send(MSG_QUIT)
         print("\nDừng giám sát file.")
         root.quit()  # Đóng giao diện
         return
@@ -212,12 +731,10 @@ def start_gui(client):
 
 def main():
     try:
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((HOST, PORT))        
-        client.sendall("CLIENT".encode(FORMAT))
-        time.sleep(1)
-       
-        list_files = client.recv(1024).decode(FORMAT)
+        client = FrameConnection(socket.create_connection((HOST, PORT)))
+        client.hello(ROLE_CONTROL) # Bắt tay phiên bản thay cho chờ cố định 1 giây
+
+        list_files = request_listing(client)
         print("Danh sách file từ server:")
         print(list_files)
 
@@ -0,0 +1,135 @@
+import zlib
+import struct
+import bisect
+import hashlib
+
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+SIGNATURE = struct.Struct("!I16s") # Chữ ký một khối: tổng yếu (adler32, lăn được), tổng mạnh (BLAKE2b 128 bit)
+COPY = struct.Struct("!QQQ") # Lệnh chép: offset đích trong file mới, offset nguồn trong file cũ của client, độ dài
+SCAN_SIZE = 4 * 1024 * 1024 # Mỗi lần đọc file khi dò khối khớp
+MAX_ROLL_BYTES = 16 * 1024 * 1024 # Số byte tối đa lăn tổng yếu từng byte (vài MB/s trong Python) cho một file
+ADLER_MOD = 65521
+
+def block_size_for(size): # Kích thước khối ~ căn bậc hai kích thước file (như rsync), lũy thừa của 2
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+def valid_block_size(block_size):
+    return MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE
+
+def strong_sum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def file_signature(path, block_size):
+    """Chữ ký các khối đủ block_size byte của file (khối cuối ngắn hơn bỏ qua, sẽ được tải lại)."""
+    parts = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            if len(block) < block_size:
+                break
+            parts.append(SIGNATURE.pack(zlib.adler32(block), strong_sum(block)))
+    return b"".join(parts)
+
+def match_blocks(path, size, signature, block_size):
+    """Tìm trong file (size byte) các đoạn trùng với khối của client, trả về [(đích, nguồn, độ dài)].
+
+    Như rsync: tổng yếu được lăn qua từng byte để tìm khối đã dời chỗ, khớp tổng yếu
+    thì mới tính tổng mạnh. Chỉ nhận khối có offset nguồn >= offset đích, để client dựng
+    lại file tại chỗ bằng cách chép theo thứ tự offset tăng dần mà không ghi đè khối
+    nguồn chưa dùng (dữ liệu bị dời ra sau, như khi chèn thêm, sẽ được tải lại).
+    Lăn từng byte chậm nên giới hạn ở MAX_ROLL_BYTES; quá mức đó chỉ thử các vị trí
+    cùng độ lệch với khối khớp gần nhất (đủ cho file sửa tại chỗ hoặc ghi thêm vào cuối).
+    """
+    weak_sums = set()
+    weak_lows = bytearray(1 << 16) # Lọc nhanh theo 16 bit thấp của tổng yếu trước khi tra set
+    sources = {} # chữ ký -> các offset nguồn tăng dần (khối giống nhau có nhiều offset)
+    count = len(signature) // SIGNATURE.size
+    for index in range(count):
+        entry = bytes(signature[index * SIGNATURE.size:(index + 1) * SIGNATURE.size])
+        weak = SIGNATURE.unpack(entry)[0]
+        weak_sums.add(weak)
+        weak_lows[weak & 0xFFFF] = 1
+        sources.setdefault(entry, []).append(index * block_size)
+    copies = []
+    if not count:
+        return copies
+    removed_terms = [(block_size * byte + 1) % ADLER_MOD for byte in range(256)] # Phần bỏ khỏi b khi byte rời cửa sổ
+    limit = min(size - block_size, (count - 1) * block_size) # Sau vị trí này không còn khối nguồn nào hợp lệ
+    position = 0
+    shift = 0 # Độ lệch nguồn - đích của khối khớp gần nhất
+    rolled = 0
+    weak = None # Tổng yếu của cửa sổ tại position, None nếu cần tính lại
+    base = 0 # Offset trong file của data[0]
+    data = b""
+    with open(path, "rb") as f:
+        while position <= limit:
+            if position + block_size + 1 > base + len(data): # Cần cả byte sau cửa sổ để lăn
+                more = f.read(SCAN_SIZE)
+                data = data[position - base:] + more
+                base = position
+                if not more: # Hết file (có thể ngắn đi trong lúc quét)
+                    limit = min(limit, base + len(data) - block_size)
+                    if position > limit:
+                        break
+            view = memoryview(data)
+            i = position - base
+            window = view[i:i + block_size]
+            if weak is None:
+                weak = zlib.adler32(window)
+            source = None
+            if weak in weak_sums:
+                offsets = sources.get(SIGNATURE.pack(weak, strong_sum(window)))
+                if offsets:
+                    # Ưu tiên khối cùng độ lệch, sau đó khối nguồn gần nhất phía sau
+                    k = bisect.bisect_left(offsets, position + shift)
+                    if k < len(offsets) and offsets[k] == position + shift:
+                        source = offsets[k]
+                    else:
+                        k = bisect.bisect_left(offsets, position)
+                        source = offsets[k] if k < len(offsets) else None
+            if source is not None:
+                last = copies[-1] if copies else None
+                if last and last[0] + last[2] == position and last[1] + last[2] == source:
+                    copies[-1] = (last[0], last[1], last[2] + block_size)
+                else:
+                    copies.append((position, source, block_size))
+                shift = source - position
+                position += block_size
+                weak = None
+                continue
+            if position >= limit:
+                break
+            if rolled >= MAX_ROLL_BYTES:
+                position += block_size - (position + shift) % block_size
+                weak = None
+                continue
+            # Lăn tổng yếu tới vị trí đầu tiên có tổng yếu trùng một khối của client
+            end = i + min(limit, base + len(data) - block_size, position + MAX_ROLL_BYTES - rolled) - position
+            start = position
+            a, b = weak & 0xFFFF, weak >> 16
+            for removed, added in zip(view[i:end], view[i + block_size:end + block_size]):
+                a = (a - removed + added) % ADLER_MOD
+                b = (b - removed_terms[removed] + a) % ADLER_MOD
+                position += 1
+                if weak_lows[a] and (b << 16) | a in weak_sums:
+                    break
+            rolled += position - start
+            weak = (b << 16) | a
+    return copies
+
+def pack_copies(copies):
+    return b"".join(COPY.pack(*copy) for copy in copies)
+
+def unpack_copies(data, size, basis_size):
+    """Đọc các lệnh chép; lỗi nếu lệnh nằm ngoài file, không theo thứ tự hoặc không chép tại chỗ được."""
+    copies = []
+    position = 0
+    for target, source, length in COPY.iter_unpack(data):
+        if target < position or source < target or target + length > size or source + length > basis_size:
+            raise ValueError("Lệnh chép không hợp lệ.")
+        copies.append((target, source, length))
+        position = target + length
+    return copies
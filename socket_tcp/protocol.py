@@ -0,0 +1,110 @@
+import struct
+
+PROTOCOL_VERSION = 2 # Phiên bản cao nhất bên này hiểu được; từ phiên bản 2 MSG_HELLO có thể kèm đề nghị nén
+MIN_PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct("!BHI") # Header mỗi khung: loại, mã yêu cầu, độ dài payload
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # Khung điều khiển lớn hơn coi như hỏng (khung MSG_DATA không bị giới hạn)
+HELLO = struct.Struct("!HB") # Payload MSG_HELLO / MSG_WELCOME: phiên bản, vai trò kết nối
+COMPRESSION = struct.Struct("!BB") # Theo sau HELLO (phiên bản 2): bộ nén, mức nén đề nghị / được chấp nhận
+BLOCK = struct.Struct("!B") # Đầu payload MSG_BLOCK: bộ nén của khối (CODEC_NONE: khối gửi thô)
+FILE_INFO = struct.Struct("!QQ") # Payload MSG_FILE_INFO: kích thước, mtime_ns
+RANGE = struct.Struct("!QQ") # Payload MSG_RANGE: start, end, theo sau là tên file
+CRC = struct.Struct("!I")
+DELTA = struct.Struct("!IIIH") # Đầu payload MSG_DELTA: kích thước khối, khối đầu, tổng số khối, độ dài tên; theo sau là tên và chữ ký các khối
+
+# Loại khung, đều nhỏ hơn 0x20 để server phân biệt với lệnh văn bản cũ (bắt đầu bằng chữ cái)
+MSG_HELLO, MSG_WELCOME, MSG_ERROR = 1, 2, 3
+MSG_LIST, MSG_LISTING = 4, 5
+MSG_STAT, MSG_FILE_INFO, MSG_NOT_FOUND = 6, 7, 8
+MSG_DONE, MSG_CANCEL, MSG_QUIT = 9, 10, 11
+MSG_RANGE, MSG_DATA, MSG_DATA_END = 12, 13, 14 # Payload MSG_DATA là dữ liệu file gửi bằng sendfile
+MSG_BATCH = 15 # Trên kết nối ROLE_BATCH: danh sách tên file, mỗi dòng một tên
+# 16-23 và 26 là khung riêng của giao thức UDP (socket_udp/protocol.py), không dùng lại số
+MSG_BLOCK = 24 # Trả lời MSG_RANGE bằng các khối nén độc lập thay cho một khung MSG_DATA
+# Đồng bộ delta: gửi cả chữ ký trong một MSG_DELTA và nhận ngay MSG_DELTA_PLAN
+MSG_DELTA, MSG_DELTA_PLAN = 25, 27 # Payload MSG_DELTA_PLAN trả lời: FILE_INFO + các lệnh chép
+MSG_RANGE_CRC = 28 # Như MSG_RANGE nhưng server chỉ trả lời MSG_DATA_END (CRC32 của đoạn), không gửi dữ liệu
+ROLE_CONTROL, ROLE_POOL, ROLE_BATCH = 0, 1, 2 # Vai trò kết nối trong MSG_HELLO
+
+class ProtocolError(Exception):
+    pass
+
+def is_frame(data): # Dữ liệu mở đầu bằng khung (không phải lệnh văn bản của client cũ)
+    return len(data) > 0 and data[0] < 0x20
+
+def encode(kind, request_id=0, payload=b""):
+    return FRAME_HEADER.pack(kind, request_id, len(payload)) + payload
+
+def negotiate(payload):
+    """Phía server: đọc MSG_HELLO, trả về (phiên bản dùng chung, vai trò); lỗi nếu không có phiên bản chung."""
+    version, role = HELLO.unpack_from(payload)
+    if version < MIN_PROTOCOL_VERSION:
+        raise ProtocolError(f"Không hỗ trợ giao thức phiên bản {version}.")
+    return min(version, PROTOCOL_VERSION), role
+
+async def read_frame(reader, prefix=b""):
+    """Đọc một khung từ asyncio.StreamReader; prefix là phần header đã đọc trước (để nhận dạng khung)."""
+    header = prefix + await reader.readexactly(FRAME_HEADER.size - len(prefix))
+    kind, request_id, length = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError("Khung quá lớn.")
+    return kind, request_id, await reader.readexactly(length)
+
+class FrameConnection:
+    """Kết nối TCP (blocking) trao đổi khung.
+
+    TCP có thể gộp hoặc tách các lần gửi, nên mọi lần đọc đều theo độ dài trong header
+    và không bao giờ đọc quá khung hiện tại; client gửi dồn nhiều yêu cầu (pipelining)
+    rồi mới đọc các trả lời theo thứ tự.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.next_id = 0
+
+    def send(self, kind, payload=b""): # Gửi một khung, trả về mã yêu cầu của nó
+        self.next_id = (self.next_id + 1) & 0xFFFF
+        self.sock.sendall(encode(kind, self.next_id, payload))
+        return self.next_id
+
+    def hello(self, role, version=PROTOCOL_VERSION, options=b""):
+        """Bắt tay: gửi MSG_HELLO (kèm options), trả về (phiên bản server chọn, phần còn lại của MSG_WELCOME).
+
+        Lỗi nếu server không hiểu giao thức khung.
+        """
+        self.send(MSG_HELLO, HELLO.pack(version, role) + options)
+        kind, _, payload = self.read_frame()
+        if kind != MSG_WELCOME:
+            raise ProtocolError(bytes(payload).decode("utf8", "replace") if kind == MSG_ERROR else "Server không hỗ trợ giao thức khung.")
+        return HELLO.unpack_from(payload)[0], bytes(payload[HELLO.size:])
+
+    def recv_into(self, view): # Nhận tối đa len(view) byte thẳng vào view (không cấp bộ nhớ), trả về số byte nhận được
+        count = self.sock.recv_into(view)
+        if not count:
+            raise ConnectionError("Kết nối bị đóng khi đang nhận dữ liệu.")
+        return count
+
+    def read_exact_into(self, view): # Nhận đủ len(view) byte vào view
+        received = 0
+        while received < len(view):
+            received += self.recv_into(view[received:])
+
+    def read_exact(self, size):
+        data = bytearray(size)
+        self.read_exact_into(memoryview(data))
+        return data
+
+    def read_header(self): # Đọc header khung, trả về (loại, mã yêu cầu, độ dài); payload đọc tiếp bằng recv
+        first = self.read_exact(1)
+        if not is_frame(first):
+            raise ProtocolError("Server không hỗ trợ giao thức khung.")
+        return FRAME_HEADER.unpack(first + self.read_exact(FRAME_HEADER.size - 1))
+
+    def read_frame(self):
+        kind, request_id, length = self.read_header()
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError("Khung quá lớn.")
+        return kind, request_id, self.read_exact(length)
+
+    def close(self):
+        self.sock.close()
@@ -1,163 +1,662 @@
 import socket
 import os
-import threading
+import mmap
+import asyncio
+import argparse
+import zlib
+import struct
+import json
 import time
+import signal
+import selectors
+from catalog import FileCatalog
+from cache import FileCache, FileReader, pread
+from delta import valid_block_size, pack_copies, SIGNATURE
+from compression import CompressionSampler, compress_block, valid_codec, CODEC_NONE, BLOCK_SIZE as COMPRESSION_BLOCK_SIZE
+from protocol import (
+    encode, read_frame, negotiate, is_frame, ProtocolError, FRAME_HEADER, HELLO, COMPRESSION, BLOCK, FILE_INFO, RANGE, CRC, DELTA,
+    MSG_HELLO, MSG_WELCOME, MSG_ERROR, MSG_LIST, MSG_LISTING, MSG_STAT, MSG_FILE_INFO, MSG_NOT_FOUND,
+    MSG_DONE, MSG_CANCEL, MSG_QUIT, MSG_RANGE, MSG_DATA, MSG_DATA_END, MSG_BLOCK, MSG_BATCH, MSG_DELTA, MSG_DELTA_PLAN,
+    MSG_RANGE_CRC, ROLE_CONTROL, ROLE_POOL, ROLE_BATCH,
+)
 
 HOST = socket.gethostbyname(socket.gethostname()) # Lấy IP của máy chủ
 PORT = 65432
 FORMAT = "utf8"
 CHUNK_SIZE = 1024
+MAX_CONNECTIONS = 1024 # Số kết nối tải (ROLE_POOL, ROLE_BATCH, CHUNK) phục vụ cùng lúc, kết nối vượt quá bị từ chối (BUSY)
+CHUNK_IDLE_TIMEOUT = 30 # Số giây giữ kết nối ROLE_POOL khi không có yêu cầu mới
+DRAIN_TIMEOUT = 30 # Khi dừng, chờ tối đa chừng này giây cho các lượt gửi đang chạy
+BATCH_HEADER = struct.Struct("!BHQQ") # Header mỗi file khi tải gộp: trạng thái, độ dài tên, kích thước, mtime_ns
+BATCH_CRC = struct.Struct("!I")
+BATCH_BLOCK = struct.Struct("!BI") # Đầu mỗi khối của file nén khi tải gộp: bộ nén của khối, độ dài
+BATCH_FILE, BATCH_MISSING, BATCH_END, BATCH_FILE_COMPRESSED = 0, 1, 2, 3
+catalog = None # Danh mục file (FileCatalog), tạo khi server khởi động
+file_cache = FileCache() # fd mở sẵn dùng chung cho mọi kết nối (dữ liệu đọc từ page cache của kernel)
+server_stats = {"connections": 0, "active_transfers": 0, "bytes_sent": 0, "delta_reused_bytes": 0} # Thống kê của tiến trình này
+draining = False # Đang dừng: không nhận yêu cầu gửi mới
+transfer_slots = None # asyncio.Semaphore(MAX_CONNECTIONS) cho kết nối tải; kết nối điều khiển gần như luôn rảnh nên không tính
+compression_enabled = True # False (--compression off): từ chối mọi đề nghị nén của client
+compression_sampler = CompressionSampler() # Kết quả lấy mẫu "file có đáng nén không", nhớ theo phiên bản file
 
-def read_file(file_name): # Hàm đọc file và trả về nội dung của file chứa danh sách các tên file có thể tải
-    sending = ""
+def range_crc32(fd, start, count): # Hàm tính CRC32 của đoạn [start, start + count) qua mmap, không copy ra bytes
+    if count == 0:
+        return 0
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+        if start + count > len(mapped):
+            raise Exception("File bị thay đổi trong lúc gửi.")
+        with memoryview(mapped) as view:
+            return zlib.crc32(view[start:start + count])
+
+def open_listed_file(file_name): # Mở file qua file_cache, chỉ nhận tên có trong danh mục (không cho đường dẫn ra ngoài thư mục phục vụ)
+    if catalog.lookup(file_name) is None:
+        raise FileNotFoundError(file_name)
+    return file_cache.acquire(file_name)
+
+async def send_file_range(writer, handle, start, count): # Hàm gửi đoạn file bằng sendfile (zero-copy), trả về CRC32 của đoạn
+    """Gửi count byte từ offset start, kernel copy thẳng từ page cache sang socket.
+
+    handle là fd lấy từ file_cache; loop.sendfile tự chuyển sang đọc bộ đệm trong
+    thread pool khi hệ thống không hỗ trợ sendfile.
+    """
+    loop = asyncio.get_running_loop()
+    if count > 0:
+        file_cache.advise_range(handle, start, count)
+        await writer.drain()
+        sent = await loop.sendfile(writer.transport, FileReader(handle.fd), start, count)
+        server_stats["bytes_sent"] += sent
+        if sent != count:
+            raise Exception("File bị thay đổi trong lúc gửi.")
+    return await asyncio.to_thread(range_crc32, handle.fd, start, count)
+
+def accept_compression(version, options): # Bộ nén client đề nghị trong MSG_HELLO, (CODEC_NONE, 0) nếu không dùng
+    if version < 2 or not compression_enabled or len(options) < COMPRESSION.size:
+        return CODEC_NONE, 0
+    codec, level = COMPRESSION.unpack_from(options)
+    return (codec, level) if valid_codec(codec, level) else (CODEC_NONE, 0)
+
+def should_compress(handle): # Lấy mẫu file (kết quả được nhớ) xem có đáng nén không; chạy trong thread pool
+    return compression_sampler.compressible((handle.path,) + handle.identity, handle.size, lambda offset, size: pread(handle.fd, size, offset))
+
+def compress_file_block(handle, offset, size, codec, level): # Đọc và nén một khối (zlib/lzma nhả GIL nên chạy song song được)
+    data = pread(handle.fd, size, offset)
+    if len(data) != size:
+        raise Exception("File bị thay đổi trong lúc gửi.")
+    packed = compress_block(codec, level, data)
+    if len(packed) >= len(data):
+        return data, CODEC_NONE, data # Khối không nén được: gửi thô
+    return data, codec, packed
+
+async def send_compressed_range(writer, handle, start, count, codec, level, block_header):
+    """Gửi đoạn thành các khối COMPRESSION_BLOCK_SIZE nén độc lập, trả về CRC32 của dữ liệu gốc.
+
+    block_header(bộ nén, độ dài) tạo phần đầu mỗi khối (khung MSG_BLOCK, hoặc BATCH_BLOCK
+    khi tải gộp). Khối sau được nén trong lúc khối trước đang được gửi.
+    """
+    loop = asyncio.get_running_loop()
+    file_cache.advise_range(handle, start, count)
+    end = start + count
+    crc = 0
+    next_block = None
+    offset = start
     try:
-        with open(file_name, "r") as f:
-            for line in f:
-                if line.strip():
-                    sending += line.strip() + '\n'
-    except FileNotFoundError:
-        print(f"File not found: {file_name}")
-    return sending
-
-def send_chunk(client_socket, file_path, chunk_index, start, end): # Hàm gửi một chunk dữ liệu từ offset start đến end
-    """Gửi một chunk dữ liệu từ start đến end."""
+        while offset < end:
+            size = min(COMPRESSION_BLOCK_SIZE, end - offset)
+            block = next_block or loop.run_in_executor(None, compress_file_block, handle, offset, size, codec, level)
+            offset += size
+            next_block = None
+            if offset < end:
+                next_block = loop.run_in_executor(None, compress_file_block, handle, offset, min(COMPRESSION_BLOCK_SIZE, end - offset), codec, level)
+            data, block_codec, payload = await block
+            crc = zlib.crc32(data, crc)
+            writer.write(block_header(block_codec, len(payload)))
+            writer.write(payload)
+            server_stats["bytes_sent"] += len(payload)
+            await writer.drain()
+    finally:
+        if next_block is not None and not next_block.cancel():
+            # Khối sau đang nén trong thread pool (không hủy được): chờ xong để caller không trả fd khi thread còn đọc
+            await asyncio.gather(next_block, return_exceptions=True)
+    return crc
+
+async def send_chunk(reader, writer, file_path, chunk_index, start, end, stream=False): # Hàm gửi một chunk dữ liệu từ offset start đến end
+    """Gửi một chunk dữ liệu từ start đến end.
+
+    Chế độ stream: báo trước số byte, gửi liên tục cả đoạn rồi gửi CRC32 ở cuối.
+    Chế độ cũ: chờ DATA_ACK sau mỗi khối CHUNK_SIZE byte.
+    """
     try:
-        with open(file_path, "rb") as file:
-            file.seek(start)
+        handle = await asyncio.to_thread(open_listed_file, file_path)
+        try:
             remaining = end - start + 1
 
-            client_socket.sendall("DATA_START".encode(FORMAT))
-            ack = client_socket.recv(1024).decode(FORMAT)
+            if stream:
+                writer.write(f"DATA_START:{remaining}".encode(FORMAT))
+            else:
+                writer.write("DATA_START".encode(FORMAT))
+            await writer.drain()
+            ack = (await reader.read(1024)).decode(FORMAT)
             if ack != "READY_FOR_DATA":
                 raise Exception("Client không sẵn sàng nhận dữ liệu.")
 
+            if stream:
+                crc = await send_file_range(writer, handle, start, remaining)
+                # Trailer có độ dài cố định để client đọc đúng số byte
+                writer.write(f"DATA_END:{crc:08x}".encode(FORMAT))
+                await writer.drain()
+                return
+
+            offset = start
             while remaining > 0:
-                data = file.read(min(CHUNK_SIZE, remaining))
+                data = await asyncio.to_thread(pread, handle.fd, min(CHUNK_SIZE, remaining), offset)
                 if not data:
                     break
-                client_socket.sendall(data)
+                writer.write(data)
+                await writer.drain()
+                server_stats["bytes_sent"] += len(data)
+                offset += len(data)
                 remaining -= len(data)
 
-                ack = client_socket.recv(1024).decode(FORMAT)
+                ack = (await reader.read(1024)).decode(FORMAT)
+                if not ack:
+                    return # Client đóng kết nối sớm
                 if ack != "DATA_ACK":
                     raise Exception("Không nhận được ACK cho dữ liệu.")
 
-            client_socket.sendall("DATA_END".encode(FORMAT))
+            writer.write("DATA_END".encode(FORMAT))
+            await writer.drain()
+        finally:
+            file_cache.release(handle)
+    except ConnectionError:
+        pass # Client đóng kết nối sớm khi phần cuối của đoạn đã được luồng khác tải
     except Exception as e:
         print(f"Lỗi khi gửi chunk {chunk_index}: {e}")
 
-def handle_chunk_connection(client_socket): 
+async def handle_chunk_connection(reader, writer):
     """Xử lý yêu cầu tải chunk từ client."""
     try:
         # Gửi tín hiệu sẵn sàng
-        client_socket.sendall("READY".encode(FORMAT))
+        writer.write("READY".encode(FORMAT))
+        await writer.drain()
         # Nhận yêu cầu chunk
-        chunk_request = client_socket.recv(1024).decode(FORMAT)
+        chunk_request = (await reader.read(1024)).decode(FORMAT)
 
         if not chunk_request.startswith("CHUNK_REQUEST"):
             raise Exception("Yêu cầu không hợp lệ.")
 
-        # Tách thông tin yêu cầu
-        _, file_name, chunk_index, start, end = chunk_request.split(":")
+        # Tách thông tin yêu cầu, trường thứ 6 (nếu có) là cờ chế độ truyền
+        parts = chunk_request.split(":")
+        _, file_name, chunk_index, start, end = parts[:5]
         chunk_index, start, end = int(chunk_index), int(start), int(end)
+        stream = len(parts) > 5 and parts[5] == "STREAM"
 
         # Gửi chunk dữ liệu
-        send_chunk(client_socket, file_name, chunk_index, start, end)
+        await send_chunk(reader, writer, file_name, chunk_index, start, end, stream)
     except Exception as e:
         print(f"Lỗi khi xử lý chunk: {e}")
+
+async def send_framed_range(writer, request_id, file_name, start, end, codec=CODEC_NONE, level=0):
+    """Trả lời MSG_RANGE: khung MSG_DATA (dữ liệu gửi bằng sendfile) hoặc các khung MSG_BLOCK nén, rồi MSG_DATA_END."""
+    try:
+        handle = await asyncio.to_thread(open_listed_file, file_name)
+    except OSError:
+        writer.write(encode(MSG_ERROR, request_id, b"NOT_FOUND"))
+        await writer.drain()
+        return
+    try:
+        if start < 0 or end < start or end >= handle.size:
+            writer.write(encode(MSG_ERROR, request_id, b"BAD_RANGE"))
+            await writer.drain()
+            return
+        count = end - start + 1
+        if codec != CODEC_NONE and await asyncio.to_thread(should_compress, handle):
+            crc = await send_compressed_range(
+                writer, handle, start, count, codec, level,
+                lambda block_codec, length: FRAME_HEADER.pack(MSG_BLOCK, request_id, BLOCK.size + length) + BLOCK.pack(block_codec),
+            )
+        else:
+            # Ghi riêng header khung, payload là dữ liệu file đi thẳng từ page cache
+            writer.write(FRAME_HEADER.pack(MSG_DATA, request_id, count))
+            crc = await send_file_range(writer, handle, start, count)
+        writer.write(encode(MSG_DATA_END, request_id, CRC.pack(crc)))
+        await writer.drain()
     finally:
-        client_socket.close()
+        file_cache.release(handle)
 
-def handle_client(client_socket, client_address):
-    """Xử lý kết nối từ client."""
-    try:      
-        client_type = client_socket.recv(1024).decode(FORMAT)
+async def send_range_crc(writer, request_id, file_name, start, end): # Trả lời MSG_RANGE_CRC: chỉ MSG_DATA_END với CRC32 của đoạn
+    try:
+        handle = await asyncio.to_thread(open_listed_file, file_name)
+    except OSError:
+        writer.write(encode(MSG_ERROR, request_id, b"NOT_FOUND"))
+        await writer.drain()
+        return
+    try:
+        if start < 0 or end < start or end >= handle.size:
+            writer.write(encode(MSG_ERROR, request_id, b"BAD_RANGE"))
+        else:
+            crc = await asyncio.to_thread(range_crc32, handle.fd, start, end - start + 1)
+            writer.write(encode(MSG_DATA_END, request_id, CRC.pack(crc)))
+        await writer.drain()
+    finally:
+        file_cache.release(handle)
+
+async def serve_framed_pool(reader, writer, codec, level):
+    """Kết nối ROLE_POOL: mỗi khung MSG_RANGE (start, end, tên file) là một yêu cầu đoạn, client có thể gửi dồn.
+
+    MSG_RANGE_CRC cùng payload chỉ hỏi CRC32 của đoạn (client kiểm phần đầu đoạn khi phần cuối
+    đã được tải trên kết nối khác).
+    """
+    while True:
+        try:
+            kind, request_id, payload = await asyncio.wait_for(read_frame(reader), CHUNK_IDLE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            break # Đóng kết nối rảnh hoặc client đã đóng
+        if kind not in (MSG_RANGE, MSG_RANGE_CRC) or draining:
+            break # Server đang dừng: client mở kết nối mới khi server chạy lại
+        start, end = RANGE.unpack_from(payload)
+        file_name = bytes(payload[RANGE.size:]).decode(FORMAT)
+        if kind == MSG_RANGE_CRC:
+            await send_range_crc(writer, request_id, file_name, start, end)
+        else:
+            await tracked(send_framed_range(writer, request_id, file_name, start, end, codec, level))
+
+def delta_plan(payload):
+    """Trả lời MSG_DELTA: (loại khung, payload) với các đoạn client chép được từ file cũ của nó."""
+    block_size, first_block, block_count, name_length = DELTA.unpack_from(payload)
+    name = bytes(payload[DELTA.size:DELTA.size + name_length]).decode(FORMAT)
+    signature = payload[DELTA.size + name_length:]
+    if not valid_block_size(block_size) or first_block != 0 or len(signature) != block_count * SIGNATURE.size:
+        return MSG_ERROR, "Chữ ký khối không hợp lệ.".encode(FORMAT)
+    result = catalog.delta(name, signature, block_size)
+    if result is None:
+        return MSG_NOT_FOUND, b""
+    entry, copies = result
+    reused = sum(length for _, _, length in copies)
+    server_stats["delta_reused_bytes"] += reused
+    print(f"Đồng bộ delta {name}: client dùng lại {reused}/{entry.size} bytes.")
+    return MSG_DELTA_PLAN, FILE_INFO.pack(entry.size, entry.mtime_ns) + pack_copies(copies)
+
+async def serve_framed_control(reader, writer, client_address):
+    """Kết nối ROLE_CONTROL: trả lời từng khung theo đúng thứ tự nhận, nên client gửi dồn được nhiều yêu cầu."""
+    print("--------------------------------------------------------------------------------------------------------------\n")
+    print(f"Client {client_address} đã kết nối.\n")
+    print("--------------------------------------------------------------------------------------------------------------\n")
+    while True:
+        try:
+            kind, request_id, payload = await read_frame(reader)
+        except asyncio.IncompleteReadError:
+            break
+        if kind == MSG_QUIT:
+            break
+        elif kind == MSG_LIST:
+            # Danh sách kèm kích thước và mtime
+            writer.write(encode(MSG_LISTING, request_id, (await asyncio.to_thread(catalog.listing)).encode(FORMAT)))
+        elif kind == MSG_STAT:
+            file_name = bytes(payload).decode(FORMAT)
+            entry = await asyncio.to_thread(catalog.lookup, file_name)
+            if entry is not None:
+                print(f"Client {client_address} yêu cầu tải file: {file_name}")
+                writer.write(encode(MSG_FILE_INFO, request_id, FILE_INFO.pack(entry.size, entry.mtime_ns)))
+            else:
+                print(f"Không tìm thấy file {file_name}.\n")
+                writer.write(encode(MSG_NOT_FOUND, request_id))
+        elif kind == MSG_DONE:
+            print(f"Đã gửi file {bytes(payload).decode(FORMAT)} cho client {client_address} thành công.\n")
+        elif kind == MSG_CANCEL:
+            print(f"Client {client_address} đã hủy yêu cầu tải file {bytes(payload).decode(FORMAT)}.")
+        elif kind == MSG_DELTA:
+            # Quét file có thể mất vài giây: chạy ngoài event loop
+            reply_kind, reply = await asyncio.to_thread(delta_plan, payload)
+            writer.write(encode(reply_kind, request_id, reply))
+        else:
+            writer.write(encode(MSG_ERROR, request_id, f"Loại khung không hợp lệ: {kind}".encode(FORMAT)))
+        await writer.drain()
+    print(f"Client {client_address} đã ngắt kết nối.\n")
+
+async def handle_framed_connection(reader, writer, client_address, first):
+    """Kết nối dùng giao thức khung: bắt tay MSG_HELLO/MSG_WELCOME (phiên bản, vai trò) rồi phục vụ theo vai trò."""
+    kind, request_id, payload = await read_frame(reader, first)
+    if kind != MSG_HELLO:
+        raise ProtocolError("Kết nối không mở đầu bằng MSG_HELLO.")
+    try:
+        version, role = negotiate(payload)
+    except ProtocolError as e:
+        writer.write(encode(MSG_ERROR, request_id, str(e).encode(FORMAT)))
+        await writer.drain()
+        return
+    if role != ROLE_CONTROL and transfer_slots.locked():
+        # Đủ kết nối tải: từ chối ngay để client thử lại sau hoặc dùng kết nối đang có, không xếp hàng chờ
+        writer.write(encode(MSG_ERROR, request_id, b"BUSY"))
+        await writer.drain()
+        return
+    # Từ phiên bản 2: trả lời kèm bộ nén được chấp nhận cho kết nối này (mỗi đoạn vẫn có thể gửi thô)
+    codec, level = accept_compression(version, payload[HELLO.size:])
+    welcome = HELLO.pack(version, role) + (COMPRESSION.pack(codec, level) if version >= 2 else b"")
+    writer.write(encode(MSG_WELCOME, request_id, welcome))
+    await writer.drain()
 
+    if role == ROLE_CONTROL:
+        await serve_framed_control(reader, writer, client_address)
+        return
+    async with transfer_slots:
+        if role == ROLE_POOL:
+            await serve_framed_pool(reader, writer, codec, level)
+        elif role == ROLE_BATCH:
+            kind, _, payload = await read_frame(reader)
+            if kind != MSG_BATCH:
+                raise ProtocolError("Kết nối tải gộp không có MSG_BATCH.")
+            names = bytes(payload).decode(FORMAT).split("\n")
+            print(f"Client {client_address} tải gộp {len(names)} file.")
+            await tracked(send_batch(writer, names, codec, level))
+        else:
+            raise ProtocolError(f"Vai trò kết nối không hợp lệ: {role}")
+
+async def tracked(coroutine): # Chạy một lượt gửi, đếm trong server_stats để khi dừng chờ nó xong
+    server_stats["active_transfers"] += 1
+    try:
+        return await coroutine
+    finally:
+        server_stats["active_transfers"] -= 1
+
+async def send_batch(writer, names, codec=CODEC_NONE, level=0):
+    """Gửi lần lượt từng file của lô: header BATCH_HEADER + tên, dữ liệu, CRC32; cuối cùng là BATCH_END.
+
+    File đáng nén (khi client đã thỏa thuận bộ nén) có trạng thái BATCH_FILE_COMPRESSED và
+    dữ liệu là các khối BATCH_BLOCK + dữ liệu nén.
+    """
+    for name in names:
+        name_bytes = name.encode(FORMAT)
+        try:
+            handle = await asyncio.to_thread(open_listed_file, name)
+        except OSError:
+            writer.write(BATCH_HEADER.pack(BATCH_MISSING, len(name_bytes), 0, 0) + name_bytes)
+            continue
+        try:
+            size, mtime_ns = handle.identity[1], handle.identity[2]
+            if codec != CODEC_NONE and await asyncio.to_thread(should_compress, handle):
+                writer.write(BATCH_HEADER.pack(BATCH_FILE_COMPRESSED, len(name_bytes), size, mtime_ns) + name_bytes)
+                crc = await send_compressed_range(writer, handle, 0, size, codec, level, BATCH_BLOCK.pack)
+            else:
+                writer.write(BATCH_HEADER.pack(BATCH_FILE, len(name_bytes), size, mtime_ns) + name_bytes)
+                crc = await send_file_range(writer, handle, 0, size)
+            writer.write(BATCH_CRC.pack(crc))
+        finally:
+            file_cache.release(handle)
+    writer.write(BATCH_HEADER.pack(BATCH_END, 0, 0, 0))
+    await writer.drain()
+
+async def handle_client(reader, writer):
+    """Xử lý kết nối từ client."""
+    client_address = writer.get_extra_info("peername")
+    client_type = None
+    try:
+        first = await reader.readexactly(1)
+        if is_frame(first):
+            client_type = "FRAMED"
+            await handle_framed_connection(reader, writer, client_address, first)
+            return
+        # Client cũ: lệnh văn bản (CLIENT, CHUNK) không có độ dài
+        client_type = (first + await reader.read(1023)).decode(FORMAT)
 
         if client_type == "CLIENT":
             print("--------------------------------------------------------------------------------------------------------------\n")
             print(f"Client {client_address} đã kết nối.\n")
             print("--------------------------------------------------------------------------------------------------------------\n")
 
-            client_socket.sendall(read_file("files.txt").encode(FORMAT))
+            # Danh sách kèm kích thước và mtime, kết thúc bằng một dòng trống
+            writer.write((await asyncio.to_thread(catalog.listing) + "\n").encode(FORMAT))
+            await writer.drain()
 
             while True:
                 # Nhận yêu cầu tải file từ client
-                file_request = client_socket.recv(1024).decode(FORMAT)
+                file_request = (await reader.read(1024)).decode(FORMAT)
 
                 if file_request == "CANCEL":
                     print(f"Client {client_address} đã hủy yêu cầu tải file.")
                     continue
 
-                if file_request == "QUIT":
+                if file_request == "QUIT" or not file_request:
                     break
-                
+
                 print("--------------------------------------------------------------------------------------------------------------\n")
                 print(f"Client {client_address} yêu cầu tải file: {file_request}")
 
-                if os.path.exists(file_request):
-                    client_socket.sendall("OK".encode(FORMAT))
+                entry = await asyncio.to_thread(catalog.lookup, file_request)
+                if entry is not None:
+                    writer.write("OK".encode(FORMAT))
+                    await writer.drain()
 
                     # Gửi kích thước file
                     print(f"Đang gửi file {file_request}...")
-                    file_size = os.path.getsize(file_request)
-                    client_socket.sendall(str(file_size).encode(FORMAT))
-                    file_size_response = client_socket.recv(1024).decode(FORMAT)
+                    writer.write(str(entry.size).encode(FORMAT))
+                    await writer.drain()
+                    file_size_response = (await reader.read(1024)).decode(FORMAT)
 
-                    if file_size_response == "INVALID_FILE_SIZE":
-                        while file_size_response == "INVALID_FILE_SIZE":
-                            file_size = os.path.getsize(file_request)
-                            client_socket.sendall(str(file_size).encode(FORMAT))
-                            file_size_response = client_socket.recv(1024).decode(FORMAT)
+                    while file_size_response == "INVALID_FILE_SIZE":
+                        entry = await asyncio.to_thread(catalog.lookup, file_request) or entry
+                        writer.write(str(entry.size).encode(FORMAT))
+                        await writer.drain()
+                        file_size_response = (await reader.read(1024)).decode(FORMAT)
 
 
-                    done_file = client_socket.recv(1024).decode(FORMAT)# Nhận tín hiệu tải xuống thành công từ client
-                    if done_file == "DONE": 
+                    done_file = (await reader.read(1024)).decode(FORMAT)# Nhận tín hiệu tải xuống thành công từ client
+                    if done_file == "DONE":
                         print(f"Đã gửi file {file_request} cho client {client_address} thành công.\n")
                         print("--------------------------------------------------------------------------------------------------------------\n")
                     else:
                         print(f"Không thể gửi file {file_request} cho client {client_address}.\n")
                         print("--------------------------------------------------------------------------------------------------------------\n")
                 else:
-                    client_socket.sendall("NOT_FOUND".encode(FORMAT)) # Gửi thông báo không tìm thấy file
+                    writer.write("NOT_FOUND".encode(FORMAT)) # Gửi thông báo không tìm thấy file
+                    await writer.drain()
                     print(f"Không tìm thấy file {file_request}.\n")
-                    print("--------------------------------------------------------------------------------------------------------------\n")       
+                    print("--------------------------------------------------------------------------------------------------------------\n")
         elif client_type == "CHUNK":
-            handle_chunk_connection(client_socket)
-            time.sleep(0.01)
+            if transfer_slots.locked():
+                writer.write("BUSY".encode(FORMAT)) # Client cũ chờ READY: báo server không sẵn sàng
+                return
+            async with transfer_slots:
+                await tracked(handle_chunk_connection(reader, writer))
         else:
             print(f"Loại client không hợp lệ: {client_type}")
 
-    except ConnectionResetError:
+    except (ConnectionError, asyncio.IncompleteReadError):
         pass
     except Exception as e:
         print(f"Lỗi khi xử lý client {client_address}: {e}")
     finally:
-        client_socket.close()
+        writer.close()
 
         if client_type == "CLIENT":
             print(f"Client {client_address} đã ngắt kết nối.\n")
 
-def run_server(): # Hàm chạy server
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-        server.bind((HOST, PORT))
-        server.listen()
-        print(f"\nServer đang chạy với IP: {HOST}  ... PORT: {PORT}\n")
-        print("--------------------------------------------------------------------------------------------------------------\n")
-       
-        while True:
-            conn, addr = server.accept()
-            thread = threading.Thread(target=handle_client, args=(conn, addr))
-            thread.start()
+def worker_stats(): # Thống kê gửi về tiến trình giám sát
+    return dict(server_stats, pid=os.getpid(), cache=file_cache.stats(), compression=compression_sampler.stats())
+
+def add_stats(total, report): # Cộng từng số liệu của report vào total, kể cả số liệu lồng nhau
+    for key, value in report.items():
+        if isinstance(value, dict):
+            add_stats(total.setdefault(key, {}), value)
+        elif key != "pid":
+            total[key] = total.get(key, 0) + value
+
+def combine_stats(reports): # Thống kê cộng dồn của các tiến trình con
+    combined = {"workers": len(reports)}
+    for report in reports:
+        add_stats(combined, report)
+    cache = combined.get("cache")
+    if cache is not None:
+        total = cache["hits"] + cache["misses"]
+        cache["hit_ratio"] = cache["hits"] / total if total else 0.0
+    return combined
+
+async def run_server(max_connections=MAX_CONNECTIONS, listen_socket=None, reuse_port=False, stats_fd=None): # Hàm chạy server: một event loop phục vụ mọi kết nối điều khiển và kết nối tải
+    """Chạy server tới khi nhận SIGTERM (hoặc SIGINT khi là tiến trình con), rồi dừng êm.
+
+    Khi dừng: ngừng nhận kết nối, chờ các lượt gửi đang chạy xong (tối đa
+    DRAIN_TIMEOUT giây) rồi đóng các kết nối còn lại (kết nối điều khiển đang rảnh).
+    Tiến trình con nhận listen_socket kế thừa hoặc tự bind với SO_REUSEPORT, và gửi
+    thống kê qua stats_fd khi nhận SIGUSR1 và khi kết thúc.
+    """
+    global catalog, draining, transfer_slots
+    catalog = await asyncio.to_thread(FileCatalog, ".", "files.txt")
+    transfer_slots = asyncio.Semaphore(max_connections)
+    connections = set()
+
+    async def serve(reader, writer):
+        connections.add(asyncio.current_task())
+        server_stats["connections"] += 1
+        try:
+            await handle_client(reader, writer)
+        finally:
+            connections.discard(asyncio.current_task())
+
+    def report():
+        if stats_fd is not None:
+            os.write(stats_fd, (json.dumps(worker_stats()) + "\n").encode(FORMAT))
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    stop_signals = [signal.SIGTERM] + ([signal.SIGINT] if stats_fd is not None else [])
+    try:
+        for sig in stop_signals:
+            loop.add_signal_handler(sig, stopping.set)
+        if stats_fd is not None:
+            loop.add_signal_handler(signal.SIGUSR1, report)
+    except (NotImplementedError, AttributeError, RuntimeError):
+        pass # Windows hoặc không chạy trong luồng chính: không có signal handler cho event loop
+
+    if listen_socket is not None:
+        server = await asyncio.start_server(serve, sock=listen_socket)
+    else:
+        server = await asyncio.start_server(serve, HOST, PORT, reuse_port=reuse_port or None)
+    async with server:
+        if stats_fd is None:
+            print(f"\nServer đang chạy với IP: {HOST}  ... PORT: {PORT}\n")
+            print("--------------------------------------------------------------------------------------------------------------\n")
+        await stopping.wait()
+
+        # Dừng êm: không nhận kết nối mới, chờ các lượt gửi đang chạy
+        draining = True
+        server.close()
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while server_stats["active_transfers"] and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in list(connections):
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+    report()
+
+def run_worker(max_connections, listen_socket, stats_fd):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Chỉ dừng qua signal handler của event loop, không ngắt giữa chừng
+    asyncio.run(run_server(max_connections, listen_socket, listen_socket is None, stats_fd))
+
+def run_workers(workers, max_connections):
+    """Tiến trình giám sát: tạo workers tiến trình con cùng phục vụ PORT, mỗi tiến trình một event loop.
+
+    Mỗi tiến trình con tự bind PORT với SO_REUSEPORT (kernel chia kết nối giữa chúng),
+    hoặc dùng chung socket nghe tạo trước khi fork nếu hệ điều hành không có
+    SO_REUSEPORT. Ctrl+C/SIGTERM làm mọi tiến trình con dừng êm; SIGUSR1 in thống kê
+    cộng dồn của chúng.
+    """
+    listen_socket = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        listen_socket = socket.create_server((HOST, PORT))
+        listen_socket.setblocking(False)
+
+    selector = selectors.DefaultSelector()
+    children = {} # pid -> thống kê gần nhất
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 0
+            try:
+                run_worker(max_connections, listen_socket, write_fd)
+            except BaseException as e:
+                print(f"Lỗi tiến trình con {os.getpid()}: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        children[pid] = None
+        selector.register(read_fd, selectors.EVENT_READ, [pid, b""])
+    print(f"\nServer đang chạy với IP: {HOST}  ... PORT: {PORT} ({workers} tiến trình)\n")
+    print("--------------------------------------------------------------------------------------------------------------\n")
+
+    requests = []
+    def forward(sig, frame):
+        requests.append(sig)
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1):
+        signal.signal(sig, forward)
+
+    stopping = False
+    waiting_report = set() # Tiến trình con chưa gửi thống kê sau SIGUSR1
+    alive = set(children)
+    while selector.get_map():
+        while requests:
+            sig = requests.pop(0)
+            if sig == signal.SIGUSR1:
+                waiting_report = set(alive)
+            elif not stopping:
+                stopping = True
+                print(f"Đang dừng: chờ các lượt gửi đang chạy (tối đa {DRAIN_TIMEOUT} giây)...")
+            for pid in alive:
+                try:
+                    os.kill(pid, signal.SIGUSR1 if sig == signal.SIGUSR1 else signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        for key, _ in selector.select(0.5):
+            data = os.read(key.fd, 65536)
+            if not data: # Tiến trình con đã thoát
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                continue
+            key.data[1] += data
+            *lines, key.data[1] = key.data[1].split(b"\n")
+            for line in lines:
+                children[key.data[0]] = json.loads(line)
+                waiting_report.discard(key.data[0])
+                if not waiting_report and not stopping:
+                    print(f"Thống kê: {combine_stats([r for r in children.values() if r is not None])}")
+        while alive:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            alive.discard(pid)
+            waiting_report.discard(pid)
+            if not stopping:
+                print(f"Tiến trình con {pid} dừng bất thường (mã {os.waitstatus_to_exitcode(status)}).")
+    for pid in alive:
+        os.waitpid(pid, 0)
+    print(f"Server ngừng hoạt động!")
+    print(f"Thống kê: {combine_stats([r for r in children.values() if r is not None])}")
 
 def main():
+    global compression_enabled
+    parser = argparse.ArgumentParser(description="Server TCP chia sẻ file")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="Số kết nối tải phục vụ cùng lúc (mỗi tiến trình), kết nối vượt quá bị từ chối")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Số tiến trình phục vụ cùng cổng (SO_REUSEPORT), mặc định 1: một tiến trình như trước")
+    parser.add_argument("--compression", choices=["auto", "off"], default="auto",
+                        help='"auto": nén theo đề nghị của client với file lấy mẫu thấy nén được, "off": luôn gửi thô')
+    args = parser.parse_args()
+    compression_enabled = args.compression == "auto"
+    if args.workers > 1 and not hasattr(os, "fork"):
+        parser.error("--workers > 1 cần hệ điều hành có fork")
+    if args.workers > 1:
+        run_workers(args.workers, args.max_connections)
+        return
     try:
-        run_server()
+        asyncio.run(run_server(args.max_connections)) # Trả về khi đã dừng êm (SIGTERM)
     except KeyboardInterrupt:
-        print(f"Server ngừng hoạt động!")
+        pass
     except Exception as E:
         print(f"Error: {E}")
+        return
+    print(f"Server ngừng hoạt động!")
+    print(f"Thống kê: {worker_stats()}")
 
 if __name__ == "__main__":
     main()
-
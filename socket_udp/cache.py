@@ -0,0 +1,181 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+BLOCK_SIZE = 64 * 1024 # Kích thước một block trong block cache
+MAX_CACHE_BYTES = 64 * 1024 * 1024 # Tổng dung lượng tối đa của block cache
+MAX_OPEN_FILES = 64 # Số file giữ sẵn fd mở
+READAHEAD_BYTES = 2 * 1024 * 1024 # Khi đọc tuần tự, báo kernel đọc trước chừng này byte
+REVALIDATE_INTERVAL = 1.0 # Số giây giữa hai lần kiểm tra file trên đĩa có bị thay đổi không
+
+def advise(fd, offset, length, advice_name): # Gửi gợi ý posix_fadvise nếu hệ điều hành hỗ trợ
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def pread(fd, size, offset): # os.pread, hoặc lseek + read trên hệ điều hành không có pread
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+class CachedHandle:
+    """fd chỉ đọc của một file, dùng chung giữa các luồng (chỉ đọc bằng pread nên không có vị trí chung)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = None # Gán khi đưa vào cache; đổi khi file bị thay thế, để block cũ không được dùng lại
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        stat = os.fstat(self.fd)
+        self.identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.size = stat.st_size
+        self.checked = time.monotonic()
+        self.refs = 0
+        self.retired = False
+        self.last_read_end = None # Offset cuối của lần đọc trước, để nhận ra đọc tuần tự
+
+class FileCache:
+    """Cache dùng chung cho server: fd mở sẵn của các file hay được tải và LRU block cache.
+
+    Block cache giới hạn theo tổng số byte; hits/misses đếm số block đọc được từ cache
+    hoặc phải đọc từ đĩa. An toàn khi dùng từ nhiều luồng; stat, open và pread chạy
+    ngoài lock để luồng đang chờ đĩa không chặn các luồng khác.
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, max_open_files=MAX_OPEN_FILES, block_size=BLOCK_SIZE):
+        self.max_bytes = max_bytes
+        self.max_open_files = max_open_files
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.handles = OrderedDict() # path -> CachedHandle, cuối danh sách là dùng gần nhất
+        self.blocks = OrderedDict() # (path, generation, block index) -> bytes
+        self.cached_bytes = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, path):
+        """Lấy fd của file (mở mới nếu chưa có hoặc file đã bị thay đổi); gọi release khi dùng xong."""
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is not None and time.monotonic() - handle.checked < REVALIDATE_INTERVAL:
+                return self.use(handle)
+        if handle is not None:
+            try:
+                stat = os.stat(path)
+                current = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                current = None
+            if current == handle.identity:
+                with self.lock:
+                    if self.handles.get(path) is handle:
+                        handle.checked = time.monotonic()
+                        return self.use(handle)
+        opened = CachedHandle(path)
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is None or handle.identity != opened.identity:
+                if handle is not None:
+                    self.retire(handle)
+                self.generation += 1
+                opened.generation = self.generation
+                self.handles[path] = opened
+                while len(self.handles) > self.max_open_files:
+                    _, oldest = self.handles.popitem(last=False)
+                    self.retire(oldest)
+                opened.refs += 1
+                return opened
+            handle.checked = opened.checked
+            handle = self.use(handle)
+        os.close(opened.fd) # Luồng khác vừa mở cùng file: dùng fd của nó, đóng fd thừa
+        return handle
+
+    def use(self, handle): # Tăng số tham chiếu của handle đang có trong cache (gọi khi đang giữ lock)
+        self.handles.move_to_end(handle.path)
+        handle.refs += 1
+        return handle
+
+    def release(self, handle):
+        with self.lock:
+            handle.refs -= 1
+            if handle.retired and handle.refs == 0:
+                os.close(handle.fd)
+
+    def retire(self, handle): # Bỏ handle khỏi cache, đóng fd khi không còn luồng nào dùng (gọi khi đang giữ lock)
+        if self.handles.get(handle.path) is handle:
+            del self.handles[handle.path]
+        handle.retired = True
+        if handle.refs == 0:
+            os.close(handle.fd)
+
+    def read_block(self, handle, index):
+        key = (handle.path, handle.generation, index)
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+
+        block = pread(handle.fd, self.block_size, index * self.block_size)
+        if len(block) > self.max_bytes:
+            return block
+        with self.lock:
+            if key not in self.blocks:
+                self.blocks[key] = block
+                self.cached_bytes += len(block)
+                while self.cached_bytes > self.max_bytes:
+                    _, evicted = self.blocks.popitem(last=False)
+                    self.cached_bytes -= len(evicted)
+                    self.evictions += 1
+        return block
+
+    def read(self, path, offset, size):
+        """Đọc tối đa size byte tại offset qua block cache."""
+        return bytes(self.view(path, offset, size))
+
+    def view(self, path, offset, size):
+        """Như read, nhưng đoạn nằm gọn trong một block được trả về dạng memoryview không sao chép."""
+        handle = self.acquire(path)
+        try:
+            end = min(offset + size, handle.size)
+            if offset >= end:
+                return b""
+            if handle.last_read_end == offset:
+                # Đọc tuần tự: báo kernel đọc trước phần tiếp theo
+                advise(handle.fd, end, READAHEAD_BYTES, "POSIX_FADV_WILLNEED")
+            handle.last_read_end = end
+
+            first = offset // self.block_size
+            last = (end - 1) // self.block_size
+            if first == last:
+                block = self.read_block(handle, first)
+                start = offset - first * self.block_size
+                return memoryview(block)[start:start + end - offset]
+            parts = []
+            for index in range(first, last + 1):
+                block = self.read_block(handle, index)
+                block_start = index * self.block_size
+                parts.append(block[max(offset, block_start) - block_start:end - block_start])
+            return b"".join(parts)
+        finally:
+            self.release(handle)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "cached_bytes": self.cached_bytes,
+                "open_files": len(self.handles),
+            }
@@ -7,34 +7,348 @@ from tkinter import filedialog
 from tqdm import tqdm
 import hashlib
 import struct
+import json
+import zlib
+from datagram import enable_gro, recv_datagrams, payload_for_mtu, RECV_BUFFER_SIZE, MTU_CANDIDATES
+from fec import PARITY_HEADER, recover
+from congestion import RttEstimator
+from reassembly import ReassemblyBuffer, PacketHistory
+from compression import decompress_block, CODECS
+from delta import block_size_for, file_signature, unpack_copies, SIGNATURE, COPY
+from protocol import (
+    encode, decode, is_frame, ProtocolError, HELLO, FILE_INFO, BATCH_INFO, DELTA, PLAN_PAGE, FRAME_HEADER,
+    MSG_HELLO, MSG_WELCOME, MSG_ERROR, MSG_LIST, MSG_STAT, MSG_FILE_INFO, MSG_DONE, MSG_QUIT,
+    MSG_BATCH, MSG_BATCH_INFO, MSG_BATCH_DONE, MSG_DIGEST, MSG_DIGEST_VALUE, MSG_MTU_PROBE, MSG_MTU_PROBE_END,
+    MSG_DELTA, MSG_DELTA_ACK, MSG_DELTA_PLAN,
+    PROTOCOL_VERSION, ROLE_CONTROL,
+)
 
 HOST = input("Nhập HOST IP: ")
 PORT = 65432
 FORMAT = "utf8"
-CHUNK_SIZE = 2048
+CHUNK_SIZE = 1024 # Dữ liệu mỗi gói khi chưa dò được MTU
 MAX_RETRIES = 5
-TIMEOUT = 2
-WINDOW_SIZE = 5
+TIMEOUT = 2 # Thời gian chờ tối đa (giây) giữa hai lần nhắc server; thực tế chờ theo RTT đo được
+WINDOW_SIZE = 256 # Số gói tối đa giữ lại khi đến trước thứ tự, không nhỏ hơn cửa sổ gửi của server (MAX_SEQ_NUM)
 ack_lock = threading.Lock()
-
-def calculate_checksum(data):
+JOURNAL_DIR = ".journal" # Thư mục ẩn trong thư mục tải, chứa nhật ký tải của từng file
+session_token = "" # Token phiên server cấp khi chấp nhận kết nối, gửi kèm CHUNK_REQUEST
+payload_size = CHUNK_SIZE # Số byte dữ liệu mỗi gói, dò theo MTU đường truyền sau khi kết nối
+MTU_PROBE_TIMEOUT = 0.5 # Số giây chờ các gói dò MTU
+MTU_BACKOFF_TIME = 0.5 # Số giây không nhận được gói nào trước khi giảm kích thước gói
+rtt_estimator = RttEstimator(TIMEOUT) # RTT tới server, đo khi kết nối và khi bắt đầu tải mỗi phần
+reassembly_usage = {"allocated_bytes": 0, "peak_bytes": 0, "rejected": 0} # Bộ nhớ đệm sắp xếp lại của các phần, cộng dồn từ lần tải trước
+next_request_id = 0 # Mã yêu cầu của khung điều khiển gửi gần nhất
+MTU_PROBE_HEADER = struct.Struct("!H") # Đầu payload khung MSG_MTU_PROBE: MTU của gói dò
+PACKET_VERSION = 1
+PACKET_DATA, PACKET_EOF, PACKET_PARITY, PACKET_COMPRESSED = 0, 1, 2, 3
+FEC_HISTORY = 64 # Số gói đã ghi giữ lại để dựng gói mất từ parity (không nhỏ hơn nhóm FEC lớn nhất của server)
+PACKET_HEADER = struct.Struct("!BBHII") # Header gói dữ liệu: phiên bản, loại gói, độ dài dữ liệu, số thứ tự, CRC32 dữ liệu
+DIGEST_BLOCK_SIZE = 1024 * 1024
+DIGEST_RATE = 100 * 1024 * 1024 # Tốc độ băm ước lượng của server (byte/giây), để chờ phản hồi DIGEST đủ lâu
+BATCH_MAX_FILE_SIZE = 1024 * 1024 # File nhỏ hơn ngưỡng này được tải gộp trong một luồng dữ liệu
+BATCH_MIN_FILES = 2
+BATCH_HEADER = struct.Struct("!BHQQ") # Header mỗi file khi tải gộp: trạng thái, độ dài tên, kích thước, mtime_ns
+BATCH_FILE, BATCH_MISSING, BATCH_END = 0, 1, 2
+COMPRESSION_CODEC = "zlib" # Bộ nén đề nghị trong CHUNK_REQUEST ("none" để tắt); server chỉ nén khi file nén được
+COMPRESSION_LEVEL = 1 # Mỗi gói được nén riêng nên mức cao ít có lợi
+DELTA_MODE = True # File đã có bản cũ trong thư mục tải: chỉ tải các khối đã đổi (đồng bộ delta)
+DELTA_MIN_SIZE = 1024 * 1024 # File nhỏ hơn thì tải lại cả file
+DELTA_PART_BLOCKS = 1024 # Số chữ ký khối trong mỗi khung MSG_DELTA (~20KB, vừa một datagram)
+DELTA_PARTS_IN_FLIGHT = 8 # Số khung MSG_DELTA gửi dồn mỗi lượt, không làm tràn bộ đệm nhận của server
+DELTA_RATE = 20 * 1024 * 1024 # Tốc độ dò khối ước lượng của server (byte/giây), để chờ MSG_DELTA_PLAN đủ lâu
+COPY_BUFFER_SIZE = 1024 * 1024 # Mỗi lần chép khi dựng lại file từ bản cũ
+
+def file_digest(file_path): # SHA-256 (hex) của file đã tải, so với DIGEST của server
     sha256 = hashlib.sha256()
-    sha256.update(data)
-    return sha256.digest() 
-
-def download_chunk(server_address, filename, chunk_index, start_chunk, end_chunk, chunks_data):
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def send_frame(client_socket, server_address, kind, payload=b""): # Gửi một khung điều khiển, trả về mã yêu cầu của nó
+    global next_request_id
+    next_request_id = (next_request_id + 1) & 0xFFFF
+    client_socket.sendto(encode(kind, next_request_id, payload), server_address)
+    return next_request_id
+
+def exchange(client_socket, server_address, requests, timeout=None):
+    """Gửi dồn các yêu cầu (loại, payload) rồi chờ trả lời, trả về [(loại, payload)] theo thứ tự yêu cầu.
+
+    Trả lời được ghép theo mã yêu cầu nên có thể đến theo thứ tự bất kỳ; khung lạ hoặc
+    trả lời trùng bị bỏ. Hết thời gian chờ thì gửi lại nguyên khung các yêu cầu chưa có
+    trả lời (tối đa MAX_RETRIES lần), cùng mã yêu cầu để server nhận ra yêu cầu lặp.
+    Khi không chỉ định timeout, chờ theo RTT đo được và lấy mẫu RTT nếu mọi trả lời về
+    ngay từ lần gửi đầu.
+    """
+    global next_request_id
+    pending = {} # mã yêu cầu -> vị trí trong requests
+    frames = {}
+    for i, (kind, payload) in enumerate(requests):
+        next_request_id = (next_request_id + 1) & 0xFFFF
+        pending[next_request_id] = i
+        frames[next_request_id] = encode(kind, next_request_id, payload)
+        client_socket.sendto(frames[next_request_id], server_address)
+    replies = [None] * len(requests)
+    sent_at = time.monotonic()
+    retries = 0
+    previous_timeout = client_socket.gettimeout()
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        timeout = 5.0
+        while pending:
+            client_socket.settimeout(timeout if timeout is not None else rtt_estimator.rto())
+            try:
+                data, _ = client_socket.recvfrom(RECV_BUFFER_SIZE)
+            except socket.timeout:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise Exception("Server không trả lời yêu cầu điều khiển.")
+                if timeout is None:
+                    rtt_estimator.on_timeout()
+                for request_id in pending:
+                    client_socket.sendto(frames[request_id], server_address)
+                continue
+            if not is_frame(data):
+                raise ProtocolError("Server không hỗ trợ giao thức khung.")
+            kind, request_id, payload = decode(data)
+            index = pending.pop(request_id, None)
+            if index is not None:
+                replies[index] = (kind, payload)
+    finally:
+        client_socket.settimeout(previous_timeout)
+    if timeout is None and retries == 0:
+        rtt_estimator.sample(time.monotonic() - sent_at)
+    return replies
+
+def request(client_socket, server_address, kind, payload=b"", timeout=None): # Một yêu cầu điều khiển, trả về (loại, payload) của trả lời
+    return exchange(client_socket, server_address, [(kind, payload)], timeout)[0]
+
+def packet_payload(mtu): # Số byte dữ liệu mỗi gói để gói lớn nhất (gói parity, dài hơn PARITY_HEADER) vừa MTU
+    return payload_for_mtu(mtu, PACKET_HEADER.size + PARITY_HEADER.size)
+
+def smaller_payload(size): # Kích thước gói nhỏ hơn tiếp theo để thử khi gói lớn không tới được, None nếu đã nhỏ nhất
+    sizes = [packet_payload(mtu) for mtu in MTU_CANDIDATES] + [CHUNK_SIZE]
+    smaller = [s for s in sizes if s < size]
+    return max(smaller) if smaller else None
+
+def probe_mtu(client_socket, server_address):
+    """Dò kích thước gói lớn nhất đi được từ server tới client.
+
+    Server gửi một gói cờ DF cho mỗi MTU thử; MTU lớn nhất nhận được nguyên vẹn quyết
+    định số byte dữ liệu mỗi gói. Không có khung trả lời nào (yêu cầu hoặc cả lượt gói dò
+    bị mất) thì gửi lại cùng mã yêu cầu, tối đa MAX_RETRIES lần như các yêu cầu điều khiển
+    khác; vẫn không nhận được gói dò nào thì giữ CHUNK_SIZE.
+    """
+    request_id = send_frame(client_socket, server_address, MSG_MTU_PROBE)
+    timeout = client_socket.gettimeout()
+    client_socket.settimeout(MTU_PROBE_TIMEOUT)
+    best = None
+    answered = False
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt:
+                client_socket.sendto(encode(MSG_MTU_PROBE, request_id), server_address)
+            try:
+                while True:
+                    data, _ = client_socket.recvfrom(RECV_BUFFER_SIZE)
+                    if not is_frame(data):
+                        continue
+                    kind, reply_id, payload = decode(data)
+                    if reply_id != request_id:
+                        continue
+                    answered = True
+                    if kind == MSG_MTU_PROBE_END:
+                        break
+                    if kind == MSG_MTU_PROBE:
+                        mtu = MTU_PROBE_HEADER.unpack_from(payload)[0]
+                        if len(data) == payload_for_mtu(mtu, 0) and (best is None or mtu > best):
+                            best = mtu
+            except (socket.timeout, ProtocolError):
+                pass # Gói cuối bị mất: dùng các gói dò đã nhận
+            if answered:
+                break
+    finally:
         client_socket.settimeout(timeout)
+    if best is None:
+        return CHUNK_SIZE
+    return max(CHUNK_SIZE, packet_payload(best))
 
-        request = f"CHUNK_REQUEST:{filename}:{chunk_index}:{start_chunk}:{end_chunk}:{0}".encode()
+def prepare_output_file(file_path, file_size):
+    """Tạo trước file đích với đúng kích thước để các luồng ghi thẳng vào vị trí của mình."""
+    fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        os.ftruncate(fd, file_size)
+        if file_size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, file_size)
+            except OSError:
+                pass # Hệ thống file không hỗ trợ, ftruncate là đủ
+    finally:
+        os.close(fd)
+
+def open_output_file(file_path):
+    return os.open(file_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+
+def write_at(fd, data, offset):
+    """Ghi data vào file tại offset bằng pwrite (mỗi luồng có fd riêng)."""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+def read_at(fd, size, offset): # Đọc size byte tại offset (pread, hoặc lseek + read)
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def apply_copies(file_path, copies):
+    """Chép các khối dùng lại tới vị trí mới ngay trong file cũ, theo offset đích tăng dần.
+
+    Nguồn luôn ở sau đích nên chép xuôi không ghi đè phần nguồn chưa đọc.
+    """
+    fd = os.open(file_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        for target, source, length in copies:
+            if source == target:
+                continue # Khối không dời chỗ: không cần đọc ghi
+            for offset in range(0, length, COPY_BUFFER_SIZE):
+                write_at(fd, read_at(fd, min(COPY_BUFFER_SIZE, length - offset), source + offset), target + offset)
+    finally:
+        os.close(fd)
+
+class DownloadJournal:
+    """Nhật ký tải của một file, lưu trong thư mục ẩn của thư mục tải (.journal/<file>).
+
+    Ghi lại các đoạn byte đã tải xong, kích thước và phiên bản file trên server
+    (kích thước:mtime) để lần chạy sau chỉ tải phần còn thiếu.
+    """
+
+    def __init__(self, output_path, file_size, version):
+        folder, name = os.path.split(output_path)
+        self.path = os.path.join(folder, JOURNAL_DIR, name)
+        self.file_size = file_size
+        self.version = version
+        self.lock = threading.Lock()
+        self.ranges = [] # Các đoạn [start, end] đã tải, đã sắp xếp và gộp
+        self.complete = False
+
+        state = self.load()
+        if (
+            state is not None
+            and version is not None
+            and state.get("version") == version
+            and state.get("size") == file_size
+            and os.path.exists(output_path)
+            and os.path.getsize(output_path) == file_size
+        ):
+            self.ranges = [tuple(r) for r in state.get("ranges", [])]
+            self.complete = state.get("complete", False)
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self): # Ghi ra file tạm rồi đổi tên để nhật ký không bị hỏng nếu client dừng giữa chừng
+        state = {"size": self.file_size, "version": self.version, "ranges": self.ranges, "complete": self.complete}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path)
+
+    def missing_ranges(self):
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < self.file_size:
+            missing.append((position, self.file_size - 1))
+        return missing
+
+    def add(self, start, end):
+        self.add_ranges([(start, end)])
+
+    def add_ranges(self, ranges):
+        with self.lock:
+            merged = []
+            for r_start, r_end in sorted(self.ranges + list(ranges)):
+                if merged and r_start <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], r_end))
+                else:
+                    merged.append((r_start, r_end))
+            self.ranges = merged
+            self.save()
+
+    def discard(self): # Bỏ nhật ký (file tải về bị sai), lần sau tải lại từ đầu
+        with self.lock:
+            self.ranges = []
+            self.complete = False
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def mark_complete(self):
+        with self.lock:
+            self.ranges = [(0, self.file_size - 1)] if self.file_size else []
+            self.complete = True
+            self.save()
+
+def split_ranges(ranges, num_parts):
+    """Chia các đoạn còn thiếu thành khoảng num_parts phần, mỗi phần do một luồng tải."""
+    total = sum(end - start + 1 for start, end in ranges)
+    parts = []
+    for start, end in ranges:
+        count = max(1, round(num_parts * (end - start + 1) / total))
+        size = (end - start + 1) // count
+        for i in range(count):
+            part_start = start + i * size
+            part_end = end if i == count - 1 else part_start + size - 1
+            parts.append((part_start, part_end))
+    return parts
+
+def download_chunk(server_address, filename, chunk_index, start_chunk, end_chunk, output_path, received, journal, sink=None):
+    # sink(data, offset) nhận dữ liệu thay cho việc ghi vào output_path (dùng khi tải gộp)
+    output_fd = None
+    total_received = 0
+    buffered = None
+    try:
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packet_payload = payload_size
+        # Bộ đệm nhận đủ chứa cả cửa sổ, để gói không bị kernel bỏ khi luồng ghi chậm một chút
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * WINDOW_SIZE * (packet_payload + PACKET_HEADER.size))
+        if sink is None:
+            output_fd = open_output_file(output_path)
+            sink = lambda data, offset: write_at(output_fd, data, offset)
+        # Chờ theo RTT: gói EOF hoặc SACK cuối bị mất chỉ làm chậm vài RTT thay vì cả TIMEOUT
+        timer = RttEstimator(TIMEOUT, rtt_estimator.srtt, rtt_estimator.rttvar)
+        client_socket.settimeout(timer.rto())
+
+        first_seq = 0
+        request = f"CHUNK_REQUEST:{filename}:{chunk_index}:{start_chunk}:{end_chunk}:{first_seq}:{session_token}:{packet_payload}:{CODECS[COMPRESSION_CODEC]}:{COMPRESSION_LEVEL}".encode()
         client_socket.sendto(request, server_address)
+        request_sent_at = time.monotonic() # Đo RTT từ yêu cầu tới gói đầu tiên, bỏ nếu phải gửi lại yêu cầu (quy tắc Karn)
+        last_arrival = request_sent_at
 
-        chunk_data = bytearray() 
-        pre_seq_num = 0
+        pre_seq_num = first_seq # Gói tiếp theo cần ghi, mọi gói trước đó đã nhận
+        buffered = ReassemblyBuffer(WINDOW_SIZE, packet_payload) # Gói đến trước thứ tự, chờ ghi
         chunk_size = end_chunk - start_chunk + 1
         total_received = 0
+        retries = 0
+        parities = {} # seq đầu nhóm -> dữ liệu gói parity chưa dùng
+        history = PacketHistory(FEC_HISTORY, packet_payload) # Các gói đã ghi gần đây, chỉ giữ từ khi server bắt đầu gửi parity
+        fec_active = False
+        recovered = 0
 
         chunk_progress = tqdm(
             total=chunk_size,
@@ -46,60 +360,221 @@ def download_chunk(server_address, filename, chunk_index, start_chunk, end_chunk
             bar_format="{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} {unit}"
         )
 
-        while True:
-            try:
-                packet,_ = client_socket.recvfrom(CHUNK_SIZE)
-
-                if packet == b"EOF":
-                    break
-
-                seq_num, = struct.unpack('I', packet[:4]) 
-                checksum = packet[4:36]
-                data = packet[36:]
-
-                if calculate_checksum(data) == checksum:
-                    if seq_num != pre_seq_num:
-                        request = f"CHUNK_REQUEST:{filename}:{chunk_index}:{total_received}:{end_chunk}:{pre_seq_num}".encode()
-                        client_socket.sendto(request, server_address)
-                        continue
-                    
-                    chunk_data.extend(data)
+        def send_sack(): # ACK tích lũy + bitmap các gói đã nhận sau pre_seq_num
+            bitmap = 0
+            for seq in buffered.held() if buffered else ():
+                bitmap |= 1 << (seq - pre_seq_num - 1)
+            with ack_lock:
+                client_socket.sendto(f"SACK:{pre_seq_num}:{bitmap:x}:{recovered}".encode(), server_address)
+
+        def accept(seq_num, data): # Nhận một gói dữ liệu hợp lệ: ghi ngay nếu đúng thứ tự, ngược lại giữ lại
+            nonlocal pre_seq_num, total_received
+            if seq_num == pre_seq_num:
+                # Ghi gói này và các gói liền sau đã nhận trước
+                while data is not None:
+                    sink(data, start_chunk + total_received)
                     chunk_progress.update(len(data))
-                    ack = f"ACK:{filename}:{chunk_index}:{seq_num}".encode()
-                    
-                    with ack_lock:
-                        client_socket.sendto(ack, server_address)
-                    pre_seq_num += 1
                     total_received += len(data)
-
+                    if fec_active:
+                        history.put(pre_seq_num, data)
+                    pre_seq_num += 1
+                    data = buffered.pop(pre_seq_num)
+            else:
+                buffered.add(pre_seq_num, seq_num, data) # Chép vào vòng đệm: buffer nhận được dùng lại ở lần đọc sau
+
+        def request_smaller(size):
+            """Yêu cầu lại phần còn thiếu với gói size byte, đánh số từ sau mọi gói cũ còn đang bay.
+
+            Server chỉ gửi trong cửa sổ không quá WINDOW_SIZE gói từ pre_seq_num, nên gói
+            của yêu cầu cũ đến muộn đều có seq nhỏ hơn first_seq mới và bị bỏ qua.
+            """
+            global payload_size
+            nonlocal request, first_seq, pre_seq_num, packet_payload, fec_active, request_sent_at
+            packet_payload = size
+            payload_size = min(payload_size, size) # Các phần và file sau dùng luôn kích thước đã giảm
+            first_seq = pre_seq_num + WINDOW_SIZE
+            pre_seq_num = first_seq
+            buffered.resize(size)
+            parities.clear()
+            history.resize(size)
+            fec_active = False
+            request = f"CHUNK_REQUEST:{filename}:{chunk_index}:{start_chunk + total_received}:{end_chunk}:{first_seq}:{session_token}:{size}:{CODECS[COMPRESSION_CODEC]}:{COMPRESSION_LEVEL}".encode()
+            client_socket.sendto(request, server_address)
+            request_sent_at = time.monotonic()
+
+        def recover_lost(): # Dựng lại gói mất từ parity khi nhóm chỉ thiếu đúng một gói
+            nonlocal recovered
+            for start in list(parities):
+                payload = parities[start]
+                count = PARITY_HEADER.unpack_from(payload)[0]
+                group = range(start, start + count)
+                missing = [seq for seq in group if seq >= pre_seq_num and seq not in buffered]
+                if not missing:
+                    del parities[start]
+                    continue
+                if len(missing) > 1:
+                    continue
+                others = [buffered.get(seq) if seq in buffered else history.get(seq) for seq in group if seq != missing[0]]
+                if None in others:
+                    del parities[start] # Gói cũ đã bị bỏ khỏi lịch sử, để server gửi lại
+                    continue
+                del parities[start]
+                recovered += 1
+                accept(missing[0], recover(payload, others))
+
+        # Bộ đệm nhận cấp một lần; với GRO một lần đọc nhận được nhiều gói
+        gro = enable_gro(client_socket)
+        buffer = bytearray(RECV_BUFFER_SIZE)
+        finished = False
+        while not finished:
+            try:
+                packets = recv_datagrams(client_socket, buffer, gro)
+                last_arrival = time.monotonic()
+                if request_sent_at is not None:
+                    timer.sample(last_arrival - request_sent_at)
+                    rtt_estimator.sample(last_arrival - request_sent_at)
+                    request_sent_at = None
+                    client_socket.settimeout(timer.rto())
+                if retries:
+                    retries = 0
+                    timer.backoff = 1
+                    client_socket.settimeout(timer.rto())
+            except socket.timeout:
+                retries += 1
+                timer.on_timeout() # Chờ gấp đôi ở lần sau, tới TIMEOUT
+                client_socket.settimeout(timer.rto())
+                idle = time.monotonic() - last_arrival
+                smaller = payload_size if payload_size < packet_payload else smaller_payload(packet_payload)
+                if idle >= MTU_BACKOFF_TIME and not buffered and smaller is not None:
+                    # Không gói nào tới: gói có thể lớn hơn MTU đường truyền (bị chặn hoặc mất khi phân mảnh)
+                    print(f"Part {chunk_index + 1}: không nhận được gói {packet_payload} byte, giảm xuống {smaller} byte.")
+                    request_smaller(smaller)
+                    last_arrival = time.monotonic()
+                    continue
+                if idle > MAX_RETRIES * TIMEOUT:
+                    raise Exception("Server không phản hồi.")
+                if pre_seq_num == first_seq and not buffered:
+                    client_socket.sendto(request, server_address) # Yêu cầu ban đầu có thể đã bị mất
+                    request_sent_at = None
                 else:
-                    request = f"CHUNK_REQUEST:{filename}:{chunk_index}:{total_received}:{pre_seq_num}".encode()
-                    client_socket.sendto(request, server_address)
+                    send_sack() # Nhắc server: EOF hoặc SACK trước có thể đã bị mất
+                continue
+
+            for packet in packets:
+                if len(packet) >= FRAME_HEADER.size and packet[0] == MSG_ERROR:
+                    # Server từ chối CHUNK_REQUEST (tên file không có trong danh mục)
+                    raise Exception(f"Server từ chối yêu cầu: {decode(bytes(packet))[2].decode(FORMAT, 'replace')}")
+                if len(packet) < PACKET_HEADER.size:
+                    continue
+                version, kind, length, seq_num, crc = PACKET_HEADER.unpack_from(packet)
+                if version != PACKET_VERSION:
+                    continue
+
+                if kind == PACKET_EOF:
+                    if seq_num == pre_seq_num:
+                        finished = True
+                        break
+                    continue # Còn thiếu gói: SACK bên dưới báo server gửi lại đúng các gói đó
+
+                data = packet[PACKET_HEADER.size:]
+                if len(data) != length or zlib.crc32(data) != crc:
+                    continue # Gói hỏng: không ACK, server gửi lại khi hết giờ
+
+                if kind == PACKET_COMPRESSED:
+                    try:
+                        data = decompress_block(CODECS[COMPRESSION_CODEC], data, packet_payload)
+                    except ValueError:
+                        continue # Gói của yêu cầu cũ (gói lớn hơn) hoặc hỏng: bỏ như gói hỏng
+                elif kind == PACKET_PARITY:
+                    fec_active = True
+                    if seq_num + PARITY_HEADER.unpack_from(data)[0] > pre_seq_num:
+                        parities[seq_num] = bytes(data)
+                    continue
+                elif kind != PACKET_DATA:
+                    continue # Loại gói không biết: không ghi vào file
+                accept(seq_num, data)
+            if parities:
+                recover_lost()
+            if not finished:
+                send_sack() # Một SACK cho cả loạt gói đọc được
 
-            except socket.timeout:
-                timeout = min(5.0, timeout * 1.5)
-                request = f"CHUNK_REQUEST:{filename}:{chunk_index}:{total_received}:{end_chunk}:{pre_seq_num}".encode()
-                client_socket.sendto(request, server_address)
 
-        
-        if chunk_data and len(chunk_data) != 0: 
-            chunks_data[chunk_index] = chunk_data
+        received[chunk_index] = total_received
 
     except Exception as e:
         print(f"[ERROR] Part {chunk_index + 1}: {e}")
 
     finally:
+        if output_fd is not None:
+            os.close(output_fd)
+        if total_received and journal is not None:
+            journal.add(start_chunk, start_chunk + total_received - 1) # Phần đã ghi xuống file, lần sau không tải lại
+        if buffered is not None:
+            usage = buffered.stats()
+            with ack_lock:
+                reassembly_usage["allocated_bytes"] += usage["allocated_bytes"]
+                reassembly_usage["peak_bytes"] = max(reassembly_usage["peak_bytes"], usage["peak_bytes"])
+                reassembly_usage["rejected"] += usage["rejected"]
         client_socket.close()
         chunk_progress.close()
 
 
 
-def download_file(file_name, client_socket):
-    """Tải file từ server."""
+def sync_delta(client_socket, server_address, file_name, output_path, file_size, version, journal):
+    """Đồng bộ delta với bản cũ (phiên bản khác) của file đã có trong thư mục tải.
+
+    Chữ ký các khối của bản cũ được gửi thành nhiều khung MSG_DELTA (gửi dồn từng
+    lượt, khung mất được gửi lại), rồi MSG_DELTA_PLAN lấy các đoạn của file mới trùng
+    với bản cũ: trang đầu chờ server dò khối và cho biết tổng số lệnh chép, các trang
+    sau được hỏi dồn. Các đoạn đó được chép tại chỗ và ghi vào nhật ký, phần còn thiếu
+    tải như bình thường. Trả về số byte dùng lại được.
+    """
+    basis_size = os.path.getsize(output_path)
+    block_size = block_size_for(basis_size)
+    signature = file_signature(output_path, block_size)
+    if not signature:
+        return 0
+    name = file_name.encode(FORMAT)
+    block_count = len(signature) // SIGNATURE.size
+    parts = [
+        (MSG_DELTA, DELTA.pack(block_size, first, block_count, len(name)) + name
+         + signature[first * SIGNATURE.size:(first + DELTA_PART_BLOCKS) * SIGNATURE.size])
+        for first in range(0, block_count, DELTA_PART_BLOCKS)
+    ]
+    for i in range(0, len(parts), DELTA_PARTS_IN_FLIGHT):
+        if any(kind != MSG_DELTA_ACK for kind, _ in exchange(client_socket, server_address, parts[i:i + DELTA_PARTS_IN_FLIGHT])):
+            return 0 # Server không hỗ trợ đồng bộ delta: tải cả file
+    kind, payload = request(client_socket, server_address, MSG_DELTA_PLAN, PLAN_PAGE.pack(0) + name, TIMEOUT + file_size / DELTA_RATE)
+    if kind != MSG_DELTA_PLAN:
+        return 0
+    size, mtime_ns = FILE_INFO.unpack_from(payload)
+    if f"{size}:{mtime_ns}" != version:
+        return 0 # File trên server vừa đổi lần nữa
+    count = PLAN_PAGE.unpack_from(payload, FILE_INFO.size)[0]
+    pages = [payload[FILE_INFO.size + PLAN_PAGE.size:]]
+    page_size = len(pages[0]) // COPY.size
+    if count > page_size:
+        if not page_size:
+            return 0
+        requests = [(MSG_DELTA_PLAN, PLAN_PAGE.pack(first) + name) for first in range(page_size, count, page_size)]
+        for i in range(0, len(requests), DELTA_PARTS_IN_FLIGHT):
+            for kind, payload in exchange(client_socket, server_address, requests[i:i + DELTA_PARTS_IN_FLIGHT]):
+                if kind != MSG_DELTA_PLAN or payload[:FILE_INFO.size] != FILE_INFO.pack(size, mtime_ns):
+                    return 0
+                pages.append(payload[FILE_INFO.size + PLAN_PAGE.size:])
+    copies = unpack_copies(b"".join(pages), file_size, basis_size)
+    if len(copies) != count:
+        return 0
+    # Nhật ký mang phiên bản mới trước khi sửa file: dừng giữa chừng thì lần sau không tin vào bản cũ
+    journal.save()
+    apply_copies(output_path, copies)
+    journal.add_ranges((target, target + length - 1) for target, _, length in copies)
+    return sum(length for _, _, length in copies)
+
+def download_file(file_name, client_socket, file_size, version=None):
+    """Tải file từ server; kích thước và phiên bản đã có từ MSG_FILE_INFO."""
     try:
         print(f"Đang tải file '{file_name}'...")
-        file_size, _ = client_socket.recvfrom(1024)
-        file_size = int(file_size.decode(FORMAT))
 
         # Chọn thư mục lưu file
         download_folder_path = filedialog.askdirectory(title=f"Chọn thư mục lưu file {file_name}")
@@ -109,18 +584,41 @@ def download_file(file_name, client_socket):
 
             return
 
-        # Chia file thành các chunk
+        # Đọc nhật ký tải: bỏ qua file đã tải đủ, chỉ tải lại các đoạn còn thiếu
+        output_file_path = os.path.join(download_folder_path, file_name)
+        journal = DownloadJournal(output_file_path, file_size, version)
+        if journal.complete:
+            print(f"File '{file_name}' đã có sẵn tại {output_file_path}, bỏ qua.\n")
+            send_frame(client_socket, (HOST, PORT), MSG_DONE, file_name.encode(FORMAT))
+            return
+        missing = journal.missing_ranges()
+        missing_size = sum(end - start + 1 for start, end in missing)
+        if missing_size != file_size:
+            print(f"Tiếp tục tải dở: còn {missing_size}/{file_size} bytes.")
+        elif DELTA_MODE and file_size >= DELTA_MIN_SIZE and os.path.exists(output_file_path):
+            try:
+                reused = sync_delta(client_socket, (HOST, PORT), file_name, output_file_path, file_size, version, journal)
+            except Exception as e:
+                print(f"Không đồng bộ delta được ({e}), tải lại cả file.")
+                reused = 0
+            if reused:
+                missing = journal.missing_ranges()
+                missing_size = sum(end - start + 1 for start, end in missing)
+                print(f"Đồng bộ delta: dùng lại {reused}/{file_size} bytes từ bản cũ, còn tải {missing_size} bytes.")
+
+        # Chia phần còn thiếu thành các chunk
         num_chunks = 4
-        chunk_size = file_size // num_chunks
+        parts = split_ranges(missing, num_chunks)
         threads = []
-        chunks_data = [None] * num_chunks
+        received = [0] * len(parts)
+
+        # Tạo trước file đích (giữ nguyên dữ liệu đã tải), các luồng ghi trực tiếp vào phần của mình
+        prepare_output_file(output_file_path, file_size)
 
-        for i in range(num_chunks):
-            start = i * chunk_size
-            end = file_size - 1 if i == num_chunks - 1 else (start + chunk_size - 1)
+        for i, (start, end) in enumerate(parts):
             thread = threading.Thread(
                 target = download_chunk,
-                args = ((HOST, PORT), file_name, i, start, end, chunks_data)
+                args = ((HOST, PORT), file_name, i, start, end, output_file_path, received, journal)
             )
             threads.append(thread)
             thread.start() 
@@ -129,34 +627,168 @@ def download_file(file_name, client_socket):
             thread.join()
 
           #kiểm tra xem đã nhận đủ byte của file chưa
-        total_received = sum(len(chunk) for chunk in chunks_data if chunk is not None)
-        if total_received != file_size:
+        total_received = sum(received)
+        if total_received != missing_size:
             raise Exception("Không nhận đủ dữ liệu.")
-        
 
-        # Ghi dữ liệu vào file
-        output_file_path = os.path.join(download_folder_path, file_name)
-        with open(output_file_path, "wb") as f:
-            for i in range(num_chunks):
-                chunk = chunks_data[i]
-                if chunk is not None:
-                    f.write(chunk)
+        # Kiểm tra SHA-256 cả file một lần thay cho băm từng gói tin
+        kind, digest = request(client_socket, (HOST, PORT), MSG_DIGEST, file_name.encode(FORMAT), TIMEOUT + file_size / DIGEST_RATE)
+        if kind == MSG_DIGEST_VALUE and digest.decode(FORMAT) != file_digest(output_file_path):
+            journal.discard()
+            raise Exception("File tải về không khớp SHA-256 trên server, cần tải lại.")
+        journal.mark_complete()
 
-        client_socket.sendto("DONE".encode(FORMAT), (HOST, PORT))
+        send_frame(client_socket, (HOST, PORT), MSG_DONE, file_name.encode(FORMAT))
 
         print(f"\nFile '{file_name}' đã được tải xuống thành công tại: {output_file_path}")
+        print(f"Bộ đệm sắp xếp lại (cộng dồn): {reassembly_usage}")
         print("--------------------------------------------------------------------------------\n")
     except Exception as e:
         print(f"Lỗi khi tải file: {e}")
 
 
+class BatchUnpacker:
+    """Tách luồng tải gộp thành từng file và ghi ngay khi nhận.
+
+    Mỗi file trong luồng gồm header BATCH_HEADER + tên + dữ liệu; download_chunk
+    chỉ chuyển dữ liệu theo đúng thứ tự nên chỉ cần đọc tuần tự.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.pending = b"" # Phần header/tên chưa nhận đủ
+        self.current = None # [tên, đường dẫn, fd, kích thước, số byte đã ghi, mtime_ns]
+        self.finished = False
+        self.completed = []
+        self.missing = []
+
+    def write(self, data, offset):
+        data = memoryview(data)
+        while len(data) and not self.finished:
+            if self.current is None:
+                self.pending += data
+                data = self.read_header()
+                continue
+            name, path, fd, size, written, mtime_ns = self.current
+            count = min(len(data), size - written)
+            write_at(fd, data[:count], written)
+            data = data[count:]
+            self.current[4] = written + count
+            if written + count == size:
+                self.finish_file()
+
+    def read_header(self): # Đọc header + tên file từ self.pending, trả về phần dữ liệu còn lại
+        if len(self.pending) < BATCH_HEADER.size:
+            return b""
+        status, name_length, size, mtime_ns = BATCH_HEADER.unpack_from(self.pending)
+        if status == BATCH_END:
+            self.finished = True
+            return b""
+        header_end = BATCH_HEADER.size + name_length
+        if len(self.pending) < header_end:
+            return b""
+        name = self.pending[BATCH_HEADER.size:header_end].decode(FORMAT)
+        rest = memoryview(self.pending[header_end:])
+        self.pending = b""
+        if status == BATCH_MISSING:
+            self.missing.append(name)
+            return rest
+        if status != BATCH_FILE:
+            raise ProtocolError(f"Trạng thái tải gộp không hợp lệ: {status}.")
+        path = os.path.join(self.folder, name)
+        prepare_output_file(path, size)
+        self.current = [name, path, open_output_file(path), size, 0, mtime_ns]
+        if size == 0:
+            self.finish_file()
+        return rest
+
+    def finish_file(self):
+        name, path, fd, size, _, mtime_ns = self.current
+        os.close(fd)
+        DownloadJournal(path, size, f"{size}:{mtime_ns}").mark_complete()
+        self.completed.append(name)
+        self.current = None
+
+    def close(self):
+        if self.current is not None:
+            os.close(self.current[2])
+            self.current = None
+
+
+def download_batch(file_names, server_files, client_socket, server_address):
+    """Tải gộp nhiều file nhỏ: server ghép chúng thành một luồng "@batch-<id>" tải như một file.
+
+    Trả về tập tên các file đã tải đủ (kể cả file đã có sẵn từ lần trước); các file còn lại
+    được tải lần lượt như cũ, kể cả khi server từ chối tải gộp hay luồng gộp bị lỗi giữa chừng.
+    Nếu người dùng không chọn thư mục thì cả nhóm coi như đã xử lý, giống khi hủy tải một file.
+    """
+    print(f"Đang tải gộp {len(file_names)} file nhỏ...")
+    download_folder_path = filedialog.askdirectory(title=f"Chọn thư mục lưu {len(file_names)} file")
+    if not download_folder_path:
+        print("Không chọn thư mục, hủy tải file.\n")
+        return set(file_names)
+
+    # Bỏ qua các file đã tải đủ ở lần chạy trước
+    completed = set()
+    requested = []
+    for name in file_names:
+        size, version = server_files[name]
+        if DownloadJournal(os.path.join(download_folder_path, name), size, version).complete:
+            print(f"File '{name}' đã có sẵn, bỏ qua.")
+            completed.add(name)
+        else:
+            requested.append(name)
+    if not requested:
+        return completed
+
+    kind, payload = request(client_socket, server_address, MSG_BATCH, "\n".join(requested).encode(FORMAT))
+    if kind != MSG_BATCH_INFO:
+        print(f"Server từ chối tải gộp: {payload.decode(FORMAT)}")
+        return completed
+    batch_id, batch_size = BATCH_INFO.unpack(payload)
+
+    unpacker = BatchUnpacker(download_folder_path)
+    received = [0]
+    try:
+        download_chunk((HOST, PORT), f"@batch-{batch_id}", 0, 0, batch_size - 1, None, received, None, unpacker.write)
+    except Exception as e:
+        print(f"Lỗi khi tải gộp: {e}")
+    finally:
+        unpacker.close()
+        send_frame(client_socket, server_address, MSG_BATCH_DONE, BATCH_INFO.pack(batch_id, batch_size))
+    completed.update(unpacker.completed)
+
+    for name in unpacker.missing:
+        print(f"File '{name}' không tồn tại trên server.")
+    if received[0] != batch_size or not unpacker.finished:
+        print("Lỗi khi tải gộp: không nhận đủ dữ liệu.")
+    else:
+        print(f"\nĐã tải gộp {len(unpacker.completed)} file vào {download_folder_path}.")
+    if len(completed) < len(file_names):
+        print(f"Tải lần lượt {len(file_names) - len(completed)} file chưa tải gộp được.")
+    print("--------------------------------------------------------------------------------\n")
+    return completed
+
+
 def list_files(client_socket):
-    """Gửi yêu cầu danh sách file và nhận kết quả."""
-    client_socket.sendto("LIST_FILES".encode(FORMAT), (HOST, PORT))
-    file_list, _ = client_socket.recvfrom(1024)
+    """Lấy và in danh sách file trên server."""
+    _, file_list = request(client_socket, (HOST, PORT), MSG_LIST)
     print("Danh sách file trên server:")
     print(file_list.decode(FORMAT))
 
+def stat_files(client_socket, server_address, file_names):
+    """Hỏi kích thước và phiên bản của nhiều file trong một lượt gửi dồn, trả về {tên file: (kích thước, phiên bản)}.
+
+    File không có trên server không nằm trong kết quả.
+    """
+    replies = exchange(client_socket, server_address, [(MSG_STAT, name.encode(FORMAT)) for name in file_names])
+    files = {}
+    for name, (kind, payload) in zip(file_names, replies):
+        if kind == MSG_FILE_INFO:
+            size, mtime_ns = FILE_INFO.unpack(payload)
+            files[name] = (size, f"{size}:{mtime_ns}")
+    return files
+
 
 def monitor(client_socket, input_file, server_address):
     """Giám sát file input.txt và tải các file mới."""
@@ -168,17 +800,26 @@ def monitor(client_socket, input_file, server_address):
             new_files = read_new_files(input_file, already_downloaded)
             if new_files:
                 print(f"Các file mới cần tải: {new_files}\n")
+                # Hỏi kích thước và phiên bản của mọi file mới trong một lượt gửi dồn
+                server_files = stat_files(client_socket, server_address, new_files)
             else:
                 print("Không có file cần tải xuống.")
+                server_files = {}
 
-            for file_name in new_files:
-                client_socket.sendto(file_name.encode(FORMAT), server_address)
-                response, _ = client_socket.recvfrom(1024)
+            # Gộp các file nhỏ vào một lần tải để không mất nhiều vòng hỏi đáp cho từng file
+            small_files = [f for f in new_files if f in server_files and server_files[f][0] <= BATCH_MAX_FILE_SIZE]
+            if len(small_files) >= BATCH_MIN_FILES:
+                # File nào chưa tải gộp xong thì tải lần lượt ngay trong lượt này
+                batched = download_batch(small_files, server_files, client_socket, server_address)
+                already_downloaded.update(batched)
+                new_files = [f for f in new_files if f not in batched]
 
-                if response.decode(FORMAT) == "OK":
-                    # Nhận kích thước file
-                    download_file(file_name, client_socket)
-                elif response.decode(FORMAT) == "NOT_FOUND":
+            for file_name in new_files:
+                # Phiên bản file trên server dùng để đối chiếu với nhật ký tải dở
+                if file_name in server_files:
+                    file_size, version = server_files[file_name]
+                    download_file(file_name, client_socket, file_size, version)
+                else:
                     print(f"File '{file_name}' không tồn tại trên server.\n")
                     print("--------------------------------------------------------------------------------\n")
 
@@ -204,37 +845,27 @@ def read_new_files(file_name, already_downloaded):
 
 
 def main():
+    global session_token, payload_size
+    server_address = (HOST, PORT)
     try:
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        client_socket.settimeout(2)
-        # Gửi tín hiệu kết nối đến server
-        client_socket.sendto("CLIENT".encode(FORMAT), (HOST, PORT))
-        flag = 0
-
-        # Nhận phản hồi từ server
-        while True:
-            try:
-                response, server_address = client_socket.recvfrom(1024)
-                response = response.decode(FORMAT)
-                if response == "ACCEPT":
-                    print("Đã kết nối với server.")
-                    list_files(client_socket)
-                    monitor(client_socket, "input.txt", server_address)
-                    break
-                else:
-                    print("Kết nối không thành công")
-            except socket.timeout:
-                if flag == 1:
-                    continue
-                flag = 1
-                print("Đã có client khác kết nối vào server, đang đợi......")
+        # Bắt tay phiên bản; gói bị mất thì exchange tự gửi lại, mẫu RTT đầu tiên lấy từ đây
+        kind, payload = request(client_socket, server_address, MSG_HELLO, HELLO.pack(PROTOCOL_VERSION, ROLE_CONTROL))
+        if kind != MSG_WELCOME:
+            raise ProtocolError(f"Kết nối không thành công: {payload.decode(FORMAT, 'replace')}")
+        session_token = payload[HELLO.size:].decode(FORMAT)
+        print(f"Đã kết nối với server (giao thức phiên bản {HELLO.unpack_from(payload)[0]}).")
+        payload_size = probe_mtu(client_socket, server_address)
+        print(f"Kích thước dữ liệu mỗi gói: {payload_size} byte.")
+        list_files(client_socket)
+        monitor(client_socket, "input.txt", server_address)
     except Exception as e:
         print(f"Lỗi client: {e}")
     except KeyboardInterrupt:
         print("\nDừng chờ kết nối")
     finally:
         print("Client đã thoát.")
-        client_socket.sendto("OFF".encode(FORMAT), server_address)
+        send_frame(client_socket, server_address, MSG_QUIT)
         client_socket.close()
 
 
@@ -0,0 +1,96 @@
+import zlib
+import lzma
+import threading
+from collections import OrderedDict
+
+CODEC_NONE, CODEC_ZLIB, CODEC_LZMA = 0, 1, 2
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+MAX_LEVEL = 9 # zlib: mức 0-9, lzma: preset 0-9
+BLOCK_SIZE = 64 * 1024 # Khối nén độc lập lớn nhất; mỗi gói dữ liệu (vài KB) được nén riêng nên luôn nhỏ hơn
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "dict_size": BLOCK_SIZE}] # Khối nhỏ: từ điển không cần lớn hơn khối
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 4 # Số mẫu lấy rải đều trong file
+MIN_SAVING = 0.1 # Nén thử mà giảm chưa tới 10% thì coi là dữ liệu đã nén, gửi thô
+MAX_SAMPLED_FILES = 4096 # Số kết quả lấy mẫu giữ lại
+
+def valid_codec(codec, level): # Bộ nén bên kia đề nghị có dùng được không
+    return codec in CODECS.values() and 0 <= level <= MAX_LEVEL
+
+def compress_block(codec, level, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, level)
+    if codec == CODEC_LZMA:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=[dict(LZMA_FILTERS[0], preset=level)])
+    return data
+
+def decompress_block(codec, data, max_size):
+    """Giải nén một khối; lỗi nếu dữ liệu hỏng hoặc giải nén ra quá max_size byte."""
+    if codec == CODEC_NONE:
+        result = data
+    elif codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("Khối nén zlib hỏng hoặc quá lớn.")
+    elif codec == CODEC_LZMA:
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+        result = decompressor.decompress(data, max_size)
+        if not decompressor.eof:
+            raise ValueError("Khối nén lzma hỏng hoặc quá lớn.")
+    else:
+        raise ValueError(f"Không hỗ trợ bộ nén {codec}.")
+    if len(result) > max_size:
+        raise ValueError("Khối giải nén quá lớn.")
+    return result
+
+def sample_ratio(read, size): # Tỉ lệ nén (zlib mức 1) của vài mẫu rải đều trong file
+    if size <= SAMPLE_SIZE:
+        offsets = [0]
+    else:
+        offsets = sorted({(size - SAMPLE_SIZE) * i // (SAMPLE_COUNT - 1) for i in range(SAMPLE_COUNT)})
+    raw = packed = 0
+    for offset in offsets:
+        data = read(offset, SAMPLE_SIZE)
+        raw += len(data)
+        packed += len(zlib.compress(data, 1))
+    return packed / raw if raw else 1.0
+
+class CompressionSampler:
+    """Quyết định file có đáng nén không bằng cách nén thử vài mẫu.
+
+    Kết quả được nhớ theo khóa server truyền vào: (tên, kích thước, mtime_ns) với file
+    thật, nên file đổi nội dung có khóa mới; (tên luồng,) với luồng tải gộp "@batch-<id>"
+    vì id lô không dùng lại. Khóa None: lấy mẫu lại mỗi lần, không nhớ.
+    """
+
+    def __init__(self, max_files=MAX_SAMPLED_FILES):
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.results = OrderedDict() # khóa -> True nếu đáng nén
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0 # Số lần quyết định gửi thô vì dữ liệu không nén được
+
+    def compressible(self, key, size, read):
+        """read(offset, size) trả về dữ liệu file; trả về True nếu nên nén file này."""
+        with self.lock:
+            result = self.results.get(key) if key is not None else None
+            if result is not None:
+                self.results.move_to_end(key)
+                self.hits += 1
+        if result is None:
+            result = size > 0 and sample_ratio(read, size) <= 1 - MIN_SAVING
+            with self.lock:
+                self.misses += 1
+                if key is not None:
+                    self.results[key] = result
+                    while len(self.results) > self.max_files:
+                        self.results.popitem(last=False)
+        if not result:
+            with self.lock:
+                self.skipped += 1
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "skipped": self.skipped, "sampled_files": len(self.results)}
@@ -0,0 +1,182 @@
+import time
+import threading
+from collections import OrderedDict
+
+INITIAL_WINDOW = 10 # Cửa sổ tắc nghẽn ban đầu (số gói)
+MIN_WINDOW = 2
+INITIAL_RTT = 0.05 # RTT giả định (giây) trước khi có mẫu đo đầu tiên
+RTT_GAIN = 1 / 8 # Trọng số mẫu RTT mới trong trung bình trượt
+RTTVAR_GAIN = 1 / 4 # Trọng số độ lệch RTT mới
+MIN_RTO, MAX_RTO = 0.02, 2.0 # Giới hạn thời gian chờ gửi lại (giây)
+MAX_BACKOFF = 64
+MIN_PROBE_TIMEOUT = 0.005 # Chờ ít nhất chừng này giây trước khi gửi gói thăm dò cuối lượt
+PACING_GAIN = 1.25 # Điều tốc nhanh hơn cwnd/RTT một chút để cửa sổ, không phải bộ điều tốc, là giới hạn chính
+BURST_PACKETS = 16 # Số gói được gửi liền nhau (một lần GSO) khi bộ điều tốc đã tích đủ token
+
+class TokenBucket:
+    """Bộ điều tốc token bucket: token tích lũy theo thời gian thực với tốc độ rate (byte/giây).
+
+    Gói chỉ phải chờ khi hết token, nên không cần ngủ sau từng gói; burst giới hạn
+    số byte được gửi dồn sau một khoảng nghỉ.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, size): # Số giây cần chờ trước khi gửi được size byte (0 nếu gửi ngay được)
+        self.refill()
+        if self.tokens >= size:
+            return 0.0
+        return (size - self.tokens) / self.rate
+
+    def consume(self, size):
+        self.tokens -= size
+
+class RttEstimator:
+    """Ước lượng RTT và thời gian chờ gửi lại (RTO) theo Jacobson/Karels (RFC 6298).
+
+    RTO = srtt + 4 * rttvar, nhân đôi sau mỗi lần hết giờ cho tới khi có mẫu mới.
+    Người gọi chỉ đưa vào mẫu của gói gửi đúng một lần (quy tắc Karn), vì không biết
+    ACK của gói gửi lại ứng với lần gửi nào.
+    """
+
+    def __init__(self, initial_rto, srtt=None, rttvar=None):
+        self.initial_rto = initial_rto # Dùng khi chưa có mẫu nào
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += RTTVAR_GAIN * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_GAIN * (rtt - self.srtt)
+        self.backoff = 1
+
+    def on_timeout(self):
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    def rto(self):
+        base = self.initial_rto if self.srtt is None else self.srtt + 4 * self.rttvar
+        return min(MAX_RTO, max(MIN_RTO, base) * self.backoff)
+
+    def probe_timeout(self): # Chờ 2 RTT không có ACK thì gửi gói thăm dò (tail loss probe), trước khi hết RTO
+        if self.srtt is None:
+            return self.rto()
+        return min(self.rto(), max(MIN_PROBE_TIMEOUT, 2 * self.srtt))
+
+class CongestionController:
+    """Điều khiển tắc nghẽn AIMD cho một lượt gửi UDP, tính theo số gói.
+
+    Slow start (cwnd tăng 1 mỗi gói được ACK) tới ssthresh, sau đó tăng khoảng 1 gói
+    mỗi RTT. Mất gói làm cwnd giảm một nửa, hết giờ chờ ACK đưa cwnd về MIN_WINDOW;
+    các gói mất trong cùng một cửa sổ chỉ tính là một lần giảm. Tốc độ điều tốc là
+    PACING_GAIN * cwnd * packet_size / srtt. Hết giờ chờ ACK cũng nhân đôi RTO, một
+    lần cho mỗi đợt giảm cửa sổ.
+    """
+
+    def __init__(self, packet_size, max_window, initial_rto=MAX_RTO):
+        self.packet_size = packet_size
+        self.max_window = max_window # Cửa sổ nhận của client
+        self.cwnd = float(min(INITIAL_WINDOW, max_window))
+        self.ssthresh = float(max_window)
+        self.rtt = RttEstimator(initial_rto)
+        self.recovery_until = -1 # Mất gói có seq nhỏ hơn giá trị này thuộc đợt giảm cửa sổ trước
+        self.acked = 0
+        self.losses = 0
+        self.timeouts = 0
+        self.pacer = TokenBucket(self.pacing_rate(), BURST_PACKETS * packet_size)
+
+    @property
+    def srtt(self):
+        return self.rtt.srtt
+
+    def set_packet_size(self, packet_size): # Kích thước gói đổi khi client thỏa thuận lại payload
+        self.packet_size = packet_size
+        self.pacer.burst = BURST_PACKETS * packet_size
+        self.pacer.rate = self.pacing_rate()
+
+    def window(self):
+        return max(MIN_WINDOW, min(int(self.cwnd), self.max_window))
+
+    def pacing_rate(self):
+        return PACING_GAIN * self.cwnd * self.packet_size / (self.srtt or INITIAL_RTT)
+
+    def on_rtt_sample(self, rtt):
+        self.rtt.sample(rtt)
+        self.pacer.rate = self.pacing_rate()
+
+    def on_ack(self, count): # count gói mới được ACK (tích lũy hoặc SACK)
+        self.acked += count
+        for _ in range(count):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window) # Không tăng mãi khi client là giới hạn
+        self.pacer.rate = self.pacing_rate()
+
+    def on_loss(self, seq, next_seq, timeout=False):
+        """Gói seq bị coi là mất; next_seq là gói mới tiếp theo sẽ gửi."""
+        if timeout:
+            self.timeouts += 1
+        else:
+            self.losses += 1
+        if seq < self.recovery_until:
+            return
+        self.recovery_until = next_seq
+        if timeout:
+            self.rtt.on_timeout()
+        self.ssthresh = max(self.cwnd / 2, MIN_WINDOW)
+        self.cwnd = MIN_WINDOW if timeout else self.ssthresh
+        self.pacer.rate = self.pacing_rate()
+
+    def state(self):
+        return {
+            "cwnd": round(self.cwnd, 2),
+            "ssthresh": round(self.ssthresh, 2),
+            "srtt_ms": round(self.srtt * 1000, 3) if self.srtt is not None else None,
+            "rto_ms": round(self.rtt.rto() * 1000, 3),
+            "pacing_rate": round(self.pacer.rate),
+            "acked": self.acked,
+            "losses": self.losses,
+            "timeouts": self.timeouts,
+        }
+
+class FairScheduler:
+    """Chia lượt gửi giữa các phiên client theo vòng tròn.
+
+    Mỗi lượt là một loạt gói (BURST_PACKETS) của một luồng gửi; phiên vừa được
+    lượt chuyển xuống cuối hàng đợi, nên client mở nhiều luồng cũng không lấn
+    được băng thông của client khác.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiting = OrderedDict() # phiên -> số luồng đang chờ lượt, theo thứ tự phục vụ
+        self.busy = False
+
+    def acquire(self, session):
+        with self.condition:
+            self.waiting[session] = self.waiting.get(session, 0) + 1
+            while self.busy or next(iter(self.waiting)) != session:
+                self.condition.wait()
+            self.busy = True
+            count = self.waiting.pop(session) - 1
+            if count:
+                self.waiting[session] = count # Còn luồng chờ: xuống cuối hàng
+
+    def release(self):
+        with self.condition:
+            self.busy = False
+            self.condition.notify_all()
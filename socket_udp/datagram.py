@@ -0,0 +1,108 @@
+import socket
+import struct
+import errno
+
+# Hằng số Linux, Python chưa định nghĩa sẵn
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+MAX_GSO_SEGMENTS = 64 # Giới hạn số đoạn trong một lần gửi GSO của kernel
+MAX_GSO_BYTES = 65000 # Tổng kích thước một lần gửi GSO phải vừa một gói UDP
+RECV_BUFFER_SIZE = 65535 # Đủ chứa các gói đã được GRO gộp lại
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+IP_PMTUDISC_DONT = getattr(socket, "IP_PMTUDISC_DONT", 0)
+IP_UDP_OVERHEAD = 28 # Header IPv4 + UDP
+MTU_CANDIDATES = (9000, 4352, 1500, 1280) # Các MTU dò thử, từ jumbo frame xuống mức tối thiểu của IPv6
+
+gso_supported = hasattr(socket.socket, "sendmsg") # Tắt hẳn ở lần lỗi đầu tiên (kernel hoặc card mạng không hỗ trợ)
+sendmsg_supported = hasattr(socket.socket, "sendmsg")
+
+def send_datagrams(sock, address, packets):
+    """Gửi danh sách gói (header, dữ liệu) tới address, không ghép header với dữ liệu.
+
+    Trên Linux các gói cùng kích thước được gửi trong một lần sendmsg với UDP_SEGMENT
+    (GSO), kernel tự cắt thành từng gói; nếu không hỗ trợ thì dùng sendmsg từng gói
+    (scatter-gather), cuối cùng là sendto.
+    """
+    global gso_supported
+    index = 0
+    while index < len(packets):
+        group = gso_group(packets, index)
+        if gso_supported and len(group) > 1:
+            buffers = []
+            for header, data in group:
+                buffers.append(header)
+                buffers.append(data)
+            segment_size = len(group[0][0]) + len(group[0][1])
+            try:
+                sock.sendmsg(buffers, [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", segment_size))], 0, address)
+                index += len(group)
+                continue
+            except OSError as e:
+                if e.errno == errno.EMSGSIZE:
+                    raise # Gói lớn hơn MTU đường truyền, không phải lỗi GSO
+                gso_supported = False
+        header, data = packets[index]
+        if sendmsg_supported:
+            sock.sendmsg([header, data], [], 0, address)
+        else:
+            sock.sendto(header + bytes(data), address)
+        index += 1
+
+def gso_group(packets, index): # Các gói liên tiếp gửi được trong một lần GSO: cùng kích thước, riêng gói cuối có thể ngắn hơn
+    first = len(packets[index][0]) + len(packets[index][1])
+    end = index + 1
+    total = first
+    while end < len(packets) and end - index < MAX_GSO_SEGMENTS and total + first <= MAX_GSO_BYTES:
+        size = len(packets[end][0]) + len(packets[end][1])
+        if size > first:
+            break
+        end += 1
+        total += size
+        if size < first:
+            break
+    return packets[index:end]
+
+def set_dont_fragment(sock, enabled=True):
+    """Bật cờ DF: gói lớn hơn MTU đường truyền báo lỗi EMSGSIZE thay vì bị phân mảnh IP.
+
+    enabled=False tắt cờ DF (kernel phân mảnh gói lớn). Trả về False nếu hệ điều hành
+    không hỗ trợ (gói khi đó có thể bị phân mảnh).
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO if enabled else IP_PMTUDISC_DONT)
+        return True
+    except OSError:
+        return False
+
+def payload_for_mtu(mtu, header_size): # Số byte dữ liệu mỗi gói để cả gói IP vừa MTU
+    return mtu - IP_UDP_OVERHEAD - header_size
+
+def enable_gro(sock):
+    """Bật UDP_GRO để kernel gộp nhiều gói đến thành một lần đọc; trả về False nếu không hỗ trợ."""
+    if not hasattr(sock, "recvmsg_into"):
+        return False
+    try:
+        sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+        return True
+    except OSError:
+        return False
+
+def recv_datagrams(sock, buffer, gro):
+    """Đọc vào buffer cấp sẵn, trả về danh sách memoryview của từng gói nhận được.
+
+    Khi GRO bật, một lần đọc có thể chứa nhiều gói cùng kích thước (gói cuối có thể
+    ngắn hơn); kích thước mỗi gói nằm trong cmsg UDP_GRO. Các memoryview trỏ vào
+    buffer nên chỉ dùng được tới lần đọc sau.
+    """
+    view = memoryview(buffer)
+    if not gro:
+        size, _ = sock.recvfrom_into(buffer)
+        return [view[:size]]
+    size, ancdata, _, _ = sock.recvmsg_into([buffer], socket.CMSG_SPACE(4))
+    segment_size = size
+    for level, kind, data in ancdata:
+        if level == SOL_UDP and kind == UDP_GRO:
+            segment_size = struct.unpack("=i", data[:4])[0]
+    return [view[offset:min(offset + segment_size, size)] for offset in range(0, size, segment_size)] or [view[:0]]
@@ -0,0 +1,51 @@
+import struct
+
+PARITY_HEADER = struct.Struct("!HH") # Đầu dữ liệu gói parity: số gói trong nhóm, XOR độ dài các gói
+
+class ParityEncoder:
+    """Sửa lỗi trước (FEC) bằng parity XOR: sau mỗi nhóm gói dữ liệu gửi lần đầu, tạo một gói parity.
+
+    Gói parity = XOR nội dung các gói trong nhóm (gói ngắn coi như đệm 0) kèm XOR độ dài
+    của chúng, nên bên nhận dựng lại được một gói bất kỳ bị mất trong nhóm mà không cần
+    chờ gửi lại. Kích thước nhóm có thể đổi giữa các nhóm.
+    """
+
+    def __init__(self, first_seq):
+        self.next_seq = first_seq # Gói nhỏ hơn là gói gửi lại, không tính vào nhóm
+        self.start = None
+        self.size = 0
+        self.count = 0
+        self.parity = 0
+        self.lengths = 0
+        self.max_length = 0
+
+    def add(self, seq, data, group_size, last):
+        """Thêm gói vừa gửi; trả về (seq đầu nhóm, dữ liệu gói parity) khi nhóm đủ, ngược lại None."""
+        if seq < self.next_seq:
+            return None
+        self.next_seq = seq + 1
+        if self.count == 0:
+            if group_size <= 0:
+                return None # FEC đang tắt
+            self.start = seq
+            self.size = group_size
+        self.parity ^= int.from_bytes(data, "little")
+        self.lengths ^= len(data)
+        self.max_length = max(self.max_length, len(data))
+        self.count += 1
+        if self.count < self.size and not last:
+            return None
+        payload = PARITY_HEADER.pack(self.count, self.lengths) + self.parity.to_bytes(self.max_length, "little")
+        start = self.start
+        self.count = self.parity = self.lengths = self.max_length = 0
+        return start, payload
+
+def recover(payload, others):
+    """Dựng lại gói còn thiếu duy nhất của nhóm từ dữ liệu parity và các gói khác trong nhóm."""
+    _, lengths = PARITY_HEADER.unpack_from(payload)
+    data = payload[PARITY_HEADER.size:]
+    parity = int.from_bytes(data, "little")
+    for packet in others:
+        parity ^= int.from_bytes(packet, "little")
+        lengths ^= len(packet)
+    return parity.to_bytes(len(data), "little")[:lengths]
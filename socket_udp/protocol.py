@@ -0,0 +1,52 @@
+import struct
+
+PROTOCOL_VERSION = 2 # Phiên bản cao nhất bên này hiểu được (nén được thỏa thuận trong CHUNK_REQUEST, không trong MSG_HELLO)
+MIN_PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct("!BHI") # Header mỗi khung: loại, mã yêu cầu, độ dài payload
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # Khung điều khiển lớn hơn coi như hỏng
+HELLO = struct.Struct("!HB") # Payload MSG_HELLO / MSG_WELCOME: phiên bản, vai trò kết nối
+FILE_INFO = struct.Struct("!QQ") # Payload MSG_FILE_INFO: kích thước, mtime_ns
+BATCH_INFO = struct.Struct("!IQ") # Payload MSG_BATCH_INFO: id lô, kích thước luồng
+DELTA = struct.Struct("!IIIH") # Đầu payload MSG_DELTA: kích thước khối, khối đầu, tổng số khối, độ dài tên; theo sau là tên và chữ ký các khối
+PLAN_PAGE = struct.Struct("!I") # MSG_DELTA_PLAN hỏi trang từ lệnh chép thứ mấy (theo sau là tên file); trả lời mang tổng số lệnh chép sau FILE_INFO
+
+# Loại khung, đều nhỏ hơn 0x20 để server phân biệt với lệnh văn bản cũ (bắt đầu bằng chữ cái)
+MSG_HELLO, MSG_WELCOME, MSG_ERROR = 1, 2, 3
+MSG_LIST, MSG_LISTING = 4, 5
+MSG_STAT, MSG_FILE_INFO, MSG_NOT_FOUND = 6, 7, 8
+MSG_DONE, MSG_QUIT = 9, 11
+# 10, 12-14, 24 và 28 là khung riêng của giao thức TCP (socket_tcp/protocol.py), không dùng lại số
+MSG_BATCH, MSG_BATCH_INFO, MSG_BATCH_DONE = 15, 16, 17
+MSG_DIGEST, MSG_DIGEST_VALUE = 18, 19
+MSG_STATS, MSG_STATS_VALUE = 20, 21
+MSG_MTU_PROBE, MSG_MTU_PROBE_END = 22, 23 # Gói dò MTU được đệm tới đúng kích thước
+# Đồng bộ delta: gửi chữ ký thành nhiều MSG_DELTA (mỗi khung được trả lời MSG_DELTA_ACK)
+# rồi hỏi từng trang MSG_DELTA_PLAN (vừa một gói)
+MSG_DELTA, MSG_DELTA_ACK, MSG_DELTA_PLAN = 25, 26, 27 # Payload MSG_DELTA_PLAN trả lời: FILE_INFO + PLAN_PAGE + các lệnh chép
+ROLE_CONTROL = 0 # Vai trò kết nối trong MSG_HELLO (UDP chỉ có phiên điều khiển, phần dữ liệu đi qua CHUNK_REQUEST)
+
+class ProtocolError(Exception):
+    pass
+
+def is_frame(data): # Dữ liệu mở đầu bằng khung (không phải SACK/CHUNK_REQUEST dạng văn bản)
+    return len(data) > 0 and data[0] < 0x20
+
+def encode(kind, request_id=0, payload=b""):
+    return FRAME_HEADER.pack(kind, request_id, len(payload)) + payload
+
+def decode(datagram):
+    """Tách một datagram UDP thành (loại, mã yêu cầu, payload)."""
+    if len(datagram) < FRAME_HEADER.size:
+        raise ProtocolError("Khung quá ngắn.")
+    kind, request_id, length = FRAME_HEADER.unpack_from(datagram)
+    payload = datagram[FRAME_HEADER.size:]
+    if len(payload) != length:
+        raise ProtocolError("Độ dài khung không khớp.")
+    return kind, request_id, payload
+
+def negotiate(payload):
+    """Phía server: đọc MSG_HELLO, trả về (phiên bản dùng chung, vai trò); lỗi nếu không có phiên bản chung."""
+    version, role = HELLO.unpack_from(payload)
+    if version < MIN_PROTOCOL_VERSION:
+        raise ProtocolError(f"Không hỗ trợ giao thức phiên bản {version}.")
+    return min(version, PROTOCOL_VERSION), role
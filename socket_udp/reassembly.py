@@ -0,0 +1,126 @@
+MAX_REASSEMBLY_BYTES = 4 * 1024 * 1024 # Giới hạn bộ nhớ giữ gói đến trước thứ tự cho mỗi phần đang tải
+
+class ReassemblyBuffer:
+    """Vòng đệm giữ các gói đến trước thứ tự, chỉ số ô là seq % capacity.
+
+    Bộ nhớ là một bytearray capacity * slot_size cấp một lần khi có gói đầu tiên đến
+    trước thứ tự (phần tải không bị đảo thứ tự thì không tốn gì), gói được chép thẳng
+    vào ô của nó. capacity bị giới hạn bởi max_bytes; gói nằm ngoài vòng bị bỏ (không
+    được SACK, server sẽ gửi lại). Dữ liệu trả về là memoryview trỏ vào ô, chỉ dùng
+    được tới khi ô đó nhận gói khác.
+    """
+
+    def __init__(self, capacity, slot_size, max_bytes=MAX_REASSEMBLY_BYTES):
+        self.max_bytes = max_bytes
+        self.window = capacity # Số gói tối đa server có thể gửi trước
+        self.storage = None
+        self.peak_bytes = 0
+        self.rejected = 0 # Số gói bị bỏ vì nằm ngoài vòng (vượt giới hạn bộ nhớ)
+        self.resize(slot_size)
+
+    def resize(self, slot_size): # Bỏ mọi gói đang giữ, dùng ô slot_size byte (khi đổi kích thước gói)
+        self.slot_size = slot_size
+        self.capacity = max(1, min(self.window, self.max_bytes // slot_size))
+        if self.storage is not None and len(self.storage) < self.capacity * slot_size:
+            self.storage = None
+        self.seqs = [None] * self.capacity # seq đang nằm trong từng ô
+        self.lengths = [0] * self.capacity
+        self.count = 0
+        self.held_bytes = 0
+
+    def clear(self):
+        self.resize(self.slot_size)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, seq):
+        return self.seqs[seq % self.capacity] == seq
+
+    def held(self): # Các seq đang giữ
+        return [seq for seq in self.seqs if seq is not None]
+
+    def add(self, base, seq, data):
+        """Giữ gói seq (base là gói tiếp theo cần ghi); trả về False nếu không giữ được."""
+        if not base < seq < base + self.capacity or len(data) > self.slot_size:
+            if seq > base:
+                self.rejected += 1
+            return False
+        index = seq % self.capacity
+        if self.seqs[index] == seq:
+            return True # Gói trùng
+        if self.storage is None:
+            self.storage = bytearray(self.capacity * self.slot_size)
+        offset = index * self.slot_size
+        self.storage[offset:offset + len(data)] = data
+        self.seqs[index] = seq
+        self.lengths[index] = len(data)
+        self.count += 1
+        self.held_bytes += len(data)
+        self.peak_bytes = max(self.peak_bytes, self.held_bytes)
+        return True
+
+    def get(self, seq):
+        index = seq % self.capacity
+        if self.seqs[index] != seq:
+            return None
+        offset = index * self.slot_size
+        return memoryview(self.storage)[offset:offset + self.lengths[index]]
+
+    def pop(self, seq):
+        data = self.get(seq)
+        if data is not None:
+            index = seq % self.capacity
+            self.seqs[index] = None
+            self.count -= 1
+            self.held_bytes -= len(data)
+        return data
+
+    def stats(self):
+        return {
+            "capacity": self.capacity,
+            "allocated_bytes": len(self.storage) if self.storage is not None else 0,
+            "held_bytes": self.held_bytes,
+            "peak_bytes": self.peak_bytes,
+            "rejected": self.rejected,
+        }
+
+class PacketHistory:
+    """Vòng đệm giữ capacity gói đã ghi gần nhất, để dựng gói mất từ parity.
+
+    Gói được chép vào ô seq % capacity của một bytearray cấp một lần (khi server bắt
+    đầu gửi parity), gói mới ghi đè gói cũ nhất; không tạo bytes mới cho mỗi gói.
+    """
+
+    def __init__(self, capacity, slot_size):
+        self.capacity = capacity
+        self.storage = None
+        self.resize(slot_size)
+
+    def resize(self, slot_size): # Bỏ mọi gói đang giữ, dùng ô slot_size byte
+        self.slot_size = slot_size
+        if self.storage is not None and len(self.storage) < self.capacity * slot_size:
+            self.storage = None
+        self.seqs = [None] * self.capacity
+        self.lengths = [0] * self.capacity
+
+    def clear(self):
+        self.resize(self.slot_size)
+
+    def put(self, seq, data):
+        if len(data) > self.slot_size:
+            return
+        if self.storage is None:
+            self.storage = bytearray(self.capacity * self.slot_size)
+        index = seq % self.capacity
+        offset = index * self.slot_size
+        self.storage[offset:offset + len(data)] = data
+        self.seqs[index] = seq
+        self.lengths[index] = len(data)
+
+    def get(self, seq):
+        index = seq % self.capacity
+        if self.seqs[index] != seq:
+            return None
+        offset = index * self.slot_size
+        return memoryview(self.storage)[offset:offset + self.lengths[index]]
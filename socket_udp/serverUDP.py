@@ -1,181 +1,728 @@
 import socket
 import os
 import struct
-import hashlib
+import zlib
 import threading
 import time
-from queue import Queue
+import bisect
+import json
+import argparse
+import errno
+from catalog import FileCatalog
+from cache import FileCache
+from congestion import CongestionController, FairScheduler, BURST_PACKETS
+from datagram import send_datagrams, set_dont_fragment, payload_for_mtu, MTU_CANDIDATES, IP_UDP_OVERHEAD
+from fec import ParityEncoder, PARITY_HEADER
+from delta import valid_block_size, pack_copies, SIGNATURE, COPY
+from compression import CompressionSampler, compress_block, valid_codec, CODEC_NONE
+from protocol import (
+    encode, decode, negotiate, is_frame, ProtocolError, FRAME_HEADER, MAX_FRAME_SIZE, HELLO, FILE_INFO, BATCH_INFO, DELTA, PLAN_PAGE,
+    MSG_HELLO, MSG_WELCOME, MSG_ERROR, MSG_LIST, MSG_LISTING, MSG_STAT, MSG_FILE_INFO, MSG_NOT_FOUND,
+    MSG_DONE, MSG_QUIT, MSG_BATCH, MSG_BATCH_INFO, MSG_BATCH_DONE, MSG_DIGEST, MSG_DIGEST_VALUE,
+    MSG_STATS, MSG_STATS_VALUE, MSG_MTU_PROBE, MSG_MTU_PROBE_END, MSG_DELTA, MSG_DELTA_ACK, MSG_DELTA_PLAN,
+)
 
 HOST = socket.gethostbyname(socket.gethostname())
 HOST_tmp = "127.0.0.1"
 PORT = 65432
 FORMAT = "utf8"
-CHUNK_SIZE = 1024
-MAX_SEQ_NUM = 10  # Số lượng gói tin tối đa có thể gửi trước khi phải đợi ACK
-ack = set()
-client_queue = Queue(0)
-control_events = {}  
-
-def calculate_checksum(data):
-    """Calculate checksum of a packet using SHA256."""
-    sha256 = hashlib.sha256()
-    sha256.update(data)
-    return sha256.digest()  # Returns the 32-byte checksum
-
-def handle_acknowledgment(seq_num):
-    """Handle ACK for a received chunk."""
-    if seq_num not in ack:
-        ack.add(seq_num)
-
-def read_file(file_name):
-    sending = ""
-    try:
-        with open(file_name, "r") as f:
-            for line in f:
-                if line.strip():
-                    sending += line.strip() + '\n'
-    except FileNotFoundError:
-        print(f"File không tồn tại: {file_name}")
-    return sending
-
-def send_chunk(server_socket, client_address, file_path, chunk_index, start, end, seq_num=0):
-    global control_events
-    try:
+MAX_SEQ_NUM = 256  # Số lượng gói tin tối đa có thể gửi trước khi phải đợi ACK (cửa sổ nhận của client; cửa sổ thực tế do điều khiển tắc nghẽn quyết định)
+RETRANSMIT_TIMEOUT = 0.2 # Số giây chờ ACK trước khi gửi lại một gói khi chưa đo được RTT; sau đó RTO tính theo RTT
+FAST_RETRANSMIT_THRESHOLD = 3 # Gửi lại ngay gói bị thiếu khi đã có chừng này gói sau nó được SACK
+TRANSFER_TIMEOUT = 30 # Bỏ lượt gửi nếu client không ACK gì trong chừng này giây
+TRANSFER_LINGER = 10 # Giữ trạng thái lượt gửi đã xong để gửi lại EOF nếu client chưa nhận được
+PACKET_VERSION = 1
+PACKET_DATA, PACKET_EOF, PACKET_PARITY, PACKET_COMPRESSED = 0, 1, 2, 3 # PACKET_COMPRESSED: dữ liệu gói đã nén bằng bộ nén client yêu cầu
+PACKET_HEADER = struct.Struct("!BBHII") # Header gói dữ liệu: phiên bản, loại gói, độ dài dữ liệu, số thứ tự, CRC32 dữ liệu
+FEC_MODE = "auto" # "auto": bật parity theo tỉ lệ mất gói đo được, "off", hoặc số gói dữ liệu cố định cho mỗi gói parity
+FEC_MIN_LOSS = 0.005 # Tỉ lệ mất gói dưới ngưỡng này thì không gửi parity
+FEC_MIN_SAMPLES = 64 # Số gói đã gửi tối thiểu trước khi ước lượng tỉ lệ mất gói
+FEC_MIN_GROUP, FEC_MAX_GROUP = 4, 32
+SESSION_TIMEOUT = 600 # Bỏ phiên của client không gửi yêu cầu nào trong chừng này giây
+MIN_PAYLOAD = 512
+MTU_PROBE_HEADER = struct.Struct("!H") # Đầu payload khung MSG_MTU_PROBE: MTU của gói dò
+MAX_PAYLOAD = payload_for_mtu(max(MTU_CANDIDATES), PACKET_HEADER.size + PARITY_HEADER.size) # Gói parity dài hơn gói dữ liệu PARITY_HEADER byte
+MAX_PLAN_COPIES = 2048 # Số lệnh chép tối đa của một lần đồng bộ delta
+MAX_DELTA_BLOCKS = MAX_FRAME_SIZE // SIGNATURE.size # Giới hạn số khối của một lần đồng bộ delta (như một khung MSG_DELTA qua TCP)
+CONTROL_DF_LIMIT = payload_for_mtu(min(MTU_CANDIDATES), 0) # Khung điều khiển dài hơn có thể vượt MTU đường truyền
+PLAN_PAGE_COPIES = (CONTROL_DF_LIMIT - FRAME_HEADER.size - FILE_INFO.size - PLAN_PAGE.size) // COPY.size # Số lệnh chép mỗi khung MSG_DELTA_PLAN
+transfers = {} # (phiên, file, phần) -> Transfer
+transfers_by_address = {} # địa chỉ socket chunk của client -> Transfer, để chuyển SACK tới đúng lượt gửi
+transfers_lock = threading.Lock()
+sessions = {} # địa chỉ socket điều khiển của client -> ClientSession
+sessions_by_token = {} # token phiên -> ClientSession, để gắn lượt gửi của socket chunk với phiên
+scheduler = FairScheduler() # Chia lượt gửi giữa các phiên
+catalog = None # Danh mục file (FileCatalog), tạo khi server khởi động
+file_cache = FileCache() # fd và block cache dùng chung cho các luồng gửi
+dont_fragment = False # Socket server đã bật cờ DF (cho gói dữ liệu và gói dò MTU)
+dont_fragment_lock = threading.Lock() # Giữ khi gửi gói cần đúng cờ DF (gói dữ liệu, gói dò MTU) và khi send_large tắt DF tạm thời
+compression_enabled = True # Tắt bằng --compression off: bỏ qua bộ nén client yêu cầu, gửi thô
+compression_sampler = CompressionSampler() # Nhớ file nào đáng nén, để không nén thử lại mỗi lượt gửi
+BATCH_HEADER = struct.Struct("!BHQQ") # Header mỗi file khi tải gộp: trạng thái, độ dài tên, kích thước, mtime_ns
+BATCH_FILE, BATCH_MISSING, BATCH_END = 0, 1, 2
+BATCH_PREFIX = "@batch-" # Tên "file" ảo dùng trong CHUNK_REQUEST khi tải gộp (không chứa ":")
+MAX_BATCHES = 16 # Số lô tải gộp giữ cùng lúc, lô cũ nhất bị bỏ khi vượt quá
+batches = {} # id -> BatchStream
+next_batch_id = 0
 
-        control_event = control_events.get(client_address)
-        if not control_event:
-            control_event = threading.Event()
-            control_event.set()  # Mặc định cho phép gửi
-            control_events[client_address] = control_event
-
-        with open(file_path, 'rb') as file:
-            file.seek(start)
-            remaining = end - start + 1
-            while remaining > 0:
-                control_event.wait()
-
-                data = file.read(min(CHUNK_SIZE, remaining))                
-                if not data:
-                    break
-                check_sum = calculate_checksum(data)
-
-                packet = struct.pack('I', seq_num)  # 4-byte integer for chunk ID
-                packet += check_sum  # 32-byte checksum
-                packet += data  # The actual data chunk
-
-                server_socket.sendto(packet, client_address)
-                remaining -= len(data)
-                seq_num += 1
-
-                time.sleep(0.001)
-                # if cnt == 10:
-                #     cnt = 0
-                #     time.sleep(0.01)
-            ##-------------------------------------##
-            server_socket.sendto("EOF".encode(FORMAT), client_address)
-
-            
-    except Exception as e:
-        print(f"Lỗi trong khi gửi chunk {chunk_index} to {client_address}: {e}")
-
-def handle_client(server_socket, client_address):
-    global client_queue
-    global control_events
-    """Handle requests from the client."""
-    try:
-        server_socket.sendto("ACCEPT".encode(FORMAT), client_address)
-        while True:
-            # Receive request from client
-            file_request, addr = server_socket.recvfrom(1024)
-            
-            if not file_request:
-                break
-            
-            request = file_request.decode(FORMAT)
-            # print(f"Received request from {client_address}: {request}")
-
-            # Handle LIST_FILES request
-            if request == "LIST_FILES":
-                file_list = read_file("files.txt")
-                server_socket.sendto(file_list.encode(FORMAT), client_address)
-
-            # Handle file download request
-            elif request in os.listdir():
-                print(f"Client {client_address} yêu cầu tải file: {request}")
-                file_size = os.path.getsize(request)
-                server_socket.sendto("OK".encode(FORMAT), client_address)
-                server_socket.sendto(str(file_size).encode(FORMAT), client_address)
-                ack.clear()
-
-            # Handle chunk download request
-            elif request.startswith("CHUNK_REQUEST"):
-                _, file_name, chunk_index, start, end, seq_num = request.split(":")
-                chunk_index, start, end, seq_num = map(int, [chunk_index, start, end, seq_num])
-
-                if client_address in control_events:
-                    control_events[client_address].clear()
-                
-                #print(f"Received CHUNK_REQUEST from {client_address}: Resending chunk {chunk_index}.")
-                threading.Thread(
-                    target=send_chunk,
-                    args=(server_socket, addr, file_name, chunk_index, start, end, seq_num)
-                ).start()
-
-                # Tiếp tục cờ điều khiển sau khi khởi động luồng
-                if client_address in control_events:
-                    control_events[client_address].set()
-            # Handle ACK
-            elif request.startswith("ACK"):
-                try:
-                    request_parts = request.split(":")
-                    if len(request_parts) == 4:
-                        _, file_name, chunk_index, seq_num = request_parts
-                        handle_acknowledgment(int(seq_num))
-                except (ValueError, IndexError):
-                    print(f"ACK Không họp lệ: {request}")
-
-            elif (client_address != addr):
-                client_queue.put(addr)
-                #server_socket.sendto("ServerBusy".encode(FORMAT), addr)
+class BatchStream:
+    """Luồng dữ liệu ảo ghép nhiều file nhỏ để tải gộp qua cơ chế chunk sẵn có.
+
+    Với mỗi file: header BATCH_HEADER + tên + dữ liệu; cuối luồng là header BATCH_END.
+    Không có CRC riêng vì mỗi gói tin đã có checksum.
+    """
+
+    def __init__(self, names):
+        self.starts = [] # Offset bắt đầu của từng đoạn trong luồng
+        self.segments = [] # (độ dài, bytes cố định hoặc tên file cần đọc)
+        for name in names:
+            name_bytes = name.encode(FORMAT)
+            entry = catalog.lookup(name)
+            if entry is None:
+                self.add(BATCH_HEADER.pack(BATCH_MISSING, len(name_bytes), 0, 0) + name_bytes)
                 continue
-            elif (request == "OFF"):
-                
-                print(f"Ngắt kết nối với client {client_address}")
-                if client_queue.empty():
-                    return
-                client_address = client_queue.get()
-                server_socket.sendto("ACCEPT".encode(FORMAT), client_address) 
-                print(f"Kết nối với client mới {client_address}")
-            else:  # File not found
-                server_socket.sendto("NOT_FOUND".encode(FORMAT), client_address)
-
-    except Exception as e:
-        print(f"Lỗi khi xử lý client {client_address}: {e}")
+            self.add(BATCH_HEADER.pack(BATCH_FILE, len(name_bytes), entry.size, entry.mtime_ns) + name_bytes)
+            if entry.size:
+                self.starts.append(self.size)
+                self.segments.append((entry.size, name))
+        self.add(BATCH_HEADER.pack(BATCH_END, 0, 0, 0))
+
+    @property
+    def size(self):
+        if not self.segments:
+            return 0
+        return self.starts[-1] + self.segments[-1][0]
+
+    def add(self, data):
+        self.starts.append(self.size)
+        self.segments.append((len(data), data))
+
+    def read(self, offset, size):
+        parts = []
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while size > 0 and 0 <= index < len(self.segments):
+            length, source = self.segments[index]
+            position = offset - self.starts[index]
+            count = min(size, length - position)
+            if isinstance(source, bytes):
+                data = source[position:position + count]
+            else:
+                data = file_cache.read(source, position, count)
+                if len(data) < count: # File bị cắt ngắn sau khi lập lô, giữ nguyên bố cục luồng
+                    data += bytes(count - len(data))
+            parts.append(data)
+            offset += count
+            size -= count
+            index += 1
+        return b"".join(parts)
+
+def create_batch(names): # Lập lô tải gộp mới, trả về (id, kích thước luồng)
+    global next_batch_id
+    next_batch_id += 1
+    batches[next_batch_id] = BatchStream(names)
+    while len(batches) > MAX_BATCHES:
+        del batches[min(batches)]
+    return next_batch_id, batches[next_batch_id].size
+
+def should_compress(file_path): # Nén thử vài mẫu của file hoặc luồng tải gộp (kết quả được nhớ)
+    if file_path.startswith(BATCH_PREFIX):
+        stream = batches.get(int(file_path[len(BATCH_PREFIX):]))
+        key, size = (file_path,), stream.size if stream is not None else 0 # id lô không dùng lại nên tên luồng đủ làm khóa
+    else:
+        entry = catalog.lookup(file_path)
+        if entry is None:
+            return False
+        key, size = (file_path, entry.size, entry.mtime_ns), entry.size
+    return compression_sampler.compressible(key, size, lambda offset, count: bytes(read_source(file_path, offset, count)))
+
+def listed_source(file_path): # Tên trong CHUNK_REQUEST phải là file trong danh mục hoặc lô tải gộp còn giữ (không cho đường dẫn ra ngoài thư mục phục vụ)
+    if file_path.startswith(BATCH_PREFIX):
+        batch_id = file_path[len(BATCH_PREFIX):]
+        return batch_id.isdigit() and int(batch_id) in batches
+    return catalog.lookup(file_path) is not None
+
+def read_source(file_path, offset, size): # Đọc từ file thật hoặc từ luồng tải gộp "@batch-<id>"
+    if file_path.startswith(BATCH_PREFIX):
+        stream = batches.get(int(file_path[len(BATCH_PREFIX):]))
+        return stream.read(offset, size) if stream is not None else b""
+    return file_cache.view(file_path, offset, size)
+
+class Transfer:
+    """Trạng thái gửi một đoạn file tới một socket chunk của client (selective repeat).
+
+    Gói số seq mang dữ liệu tại offset start + (seq - first_seq) * payload_size. Client
+    gửi "SACK:<cum>:<bitmap>": mọi gói < cum đã nhận, bit i của bitmap là gói cum + 1 + i.
+    Chỉ các gói chưa được ACK mới được gửi lại: ngay khi bị FAST_RETRANSMIT_THRESHOLD gói
+    sau vượt qua, hoặc khi hết RTO đo theo RTT. Khi không còn gói mới để gửi, gói cao nhất
+    chưa được ACK được gửi lại sớm một lần (tail loss probe) để SACK của nó lộ ra các gói
+    mất ở cuối lượt. Nếu client yêu cầu nén và file đáng nén, dữ liệu từng gói được nén
+    riêng (PACKET_COMPRESSED) khi nhờ đó gói nhỏ hơn; số thứ tự, offset và parity vẫn
+    tính theo dữ liệu thô. Số gói đang bay do CongestionController quyết định và các gói được
+    điều tốc bằng token bucket của nó.
+
+    Mỗi (phiên, file, phần) chỉ có một Transfer với một luồng gửi duy nhất; yêu cầu mới
+    cho cùng phần đó đổi đích gửi tại chỗ (retarget) thay vì tạo luồng gửi mới. Client
+    hạ payload_size bằng cách yêu cầu lại phần còn thiếu khi gói lớn không tới được.
+    """
+
+    def __init__(self, server_socket, address, file_path, start, end, first_seq, session, payload_size, compression):
+        self.server_socket = server_socket
+        self.session = session # Khóa chia lượt gửi công bằng (token phiên của client)
+        self.file_path = file_path
+        self.congestion = CongestionController(payload_size + PACKET_HEADER.size, MAX_SEQ_NUM, RETRANSMIT_TIMEOUT)
+        self.packets_sent = 0
+        self.probes = 0 # Số gói thăm dò cuối lượt đã gửi
+        self.fec_recovered = 0 # Số gói client đã tự dựng lại từ parity (mất gói mà server không thấy)
+        self.compressible = None # File có đáng nén không, lấy mẫu ở lần gửi đầu tiên cần nén
+        self.packets_compressed = 0
+        self.condition = threading.Condition()
+        self.finished = False
+        self.cancelled = False
+        self.generation = 0 # Tăng mỗi lần đổi đích, để loạt gói đã chuẩn bị cho đích cũ không được gửi
+        self.oversized = False # Đã gặp EMSGSIZE: gói lớn hơn MTU đường truyền
+        self.target(address, start, end, first_seq, payload_size, compression)
+
+    def target(self, address, start, end, first_seq, payload_size, compression): # Đặt đoạn cần gửi và socket nhận (gọi khi đang giữ condition hoặc từ __init__)
+        self.address = address
+        self.compression = compression # (bộ nén, mức nén) client yêu cầu
+        self.start = start
+        self.end = end
+        self.first_seq = first_seq
+        self.payload_size = payload_size
+        self.packet_size = payload_size + PACKET_HEADER.size
+        self.congestion.set_packet_size(self.packet_size)
+        self.last_seq = first_seq + (end - start + payload_size) // payload_size # Số thứ tự của gói EOF
+        self.base = first_seq # Mọi gói < base đã được ACK
+        self.next_seq = first_seq # Gói mới tiếp theo chưa gửi lần nào
+        self.sent = {} # seq -> thời điểm gửi gần nhất, cho các gói đã gửi mà chưa được ACK
+        self.sacked = set()
+        self.retransmit = set() # Gói cần gửi lại ngay (fast retransmit)
+        self.fast_retransmitted = set()
+        self.retransmitted = set() # Gói đã gửi hơn một lần, không dùng để đo RTT
+        self.probed = False # Đã gửi gói thăm dò từ ACK gần nhất có tiến triển
+        self.fec = ParityEncoder(first_seq)
+        self.generation += 1
+        self.last_ack = time.monotonic()
+
+    def retarget(self, address, start, end, first_seq, payload_size, compression):
+        """Yêu cầu mới cho cùng phần: bỏ các gói đang chờ của đích cũ, giữ trạng thái tắc nghẽn đã học.
+
+        Trả về False nếu luồng gửi đã kết thúc (cần tạo Transfer mới).
+        """
+        with self.condition:
+            if self.finished or self.cancelled:
+                return False
+            self.target(address, start, end, first_seq, payload_size, compression)
+            self.condition.notify()
+            return True
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+    def on_ack(self, cumulative, bitmap, recovered=0):
+        with self.condition:
+            self.last_ack = time.monotonic()
+            self.fec_recovered = max(self.fec_recovered, recovered)
+            if self.finished:
+                self.send_eof() # Client chưa nhận được EOF
+                return
+            newly_acked = 0
+            rtt_sample = None
+            now = time.monotonic()
+            if cumulative > self.base:
+                for seq in range(self.base, min(cumulative, self.next_seq)):
+                    sent_at = self.sent.pop(seq, None)
+                    if seq not in self.sacked:
+                        newly_acked += 1
+                        if sent_at is not None and seq not in self.retransmitted:
+                            rtt_sample = now - sent_at
+                    self.sacked.discard(seq)
+                    self.retransmit.discard(seq)
+                    self.retransmitted.discard(seq)
+                self.base = min(cumulative, self.next_seq)
+            seq = cumulative + 1
+            while bitmap:
+                if bitmap & 1 and seq in self.sent and seq not in self.sacked:
+                    self.sacked.add(seq)
+                    self.retransmit.discard(seq)
+                    newly_acked += 1
+                    if seq not in self.retransmitted:
+                        rtt_sample = now - self.sent[seq]
+                bitmap >>= 1
+                seq += 1
+            if rtt_sample is not None:
+                self.congestion.on_rtt_sample(rtt_sample)
+            if newly_acked:
+                self.congestion.on_ack(newly_acked)
+                self.probed = False
+            if self.sacked:
+                # Gói đã bị FAST_RETRANSMIT_THRESHOLD gói sau vượt qua coi như mất, gửi lại một lần không chờ hết giờ
+                highest = max(self.sacked)
+                for seq in range(self.base, highest - FAST_RETRANSMIT_THRESHOLD + 1):
+                    if seq in self.sent and seq not in self.sacked and seq not in self.fast_retransmitted:
+                        self.retransmit.add(seq)
+                        self.fast_retransmitted.add(seq)
+                        self.congestion.on_loss(seq, self.next_seq)
+            self.condition.notify()
+
+    def send_packets(self, seqs, generation):
+        with self.condition:
+            if generation != self.generation or self.cancelled:
+                return # Đích đã đổi hoặc lượt gửi bị hủy
+            address, start, end, first_seq, last_seq, fec = self.address, self.start, self.end, self.first_seq, self.last_seq, self.fec
+            payload_size = self.payload_size
+            codec, level = self.compression if self.compressible else (CODEC_NONE, 0)
+        packets = []
+        for seq in sorted(seqs, key=lambda seq: seq == last_seq - 1): # Gói cuối (có thể ngắn hơn) để sau cùng cho GSO
+            offset = start + (seq - first_seq) * payload_size
+            # Đọc qua block cache: các lần gửi lại cùng đoạn không phải đọc đĩa, dữ liệu không bị sao chép
+            data = read_source(self.file_path, offset, min(payload_size, end + 1 - offset))
+            kind, wire = PACKET_DATA, data
+            if codec != CODEC_NONE:
+                packed = compress_block(codec, level, data)
+                if len(packed) < len(data): # Gói không nhỏ đi thì gửi thô
+                    kind, wire = PACKET_COMPRESSED, packed
+                    self.packets_compressed += 1
+            # CRC32 (của dữ liệu trên đường truyền) đủ để phát hiện gói hỏng; cả file được kiểm tra bằng SHA-256 (DIGEST) khi tải xong
+            header = PACKET_HEADER.pack(PACKET_VERSION, kind, len(wire), seq, zlib.crc32(wire))
+            packets.append((header, wire))
+            parity = fec.add(seq, data, self.fec_group_size(), seq == last_seq - 1)
+            if parity is not None:
+                group_start, payload = parity
+                packets.append((PACKET_HEADER.pack(PACKET_VERSION, PACKET_PARITY, len(payload), group_start, zlib.crc32(payload)), payload))
+        self.packets_sent += len(seqs)
+        try:
+            # Các luồng gửi đã lần lượt theo scheduler nên lock chỉ chặn lúc send_large đang tắt DF:
+            # gói quá MTU phải báo EMSGSIZE chứ không bị phân mảnh
+            with dont_fragment_lock:
+                send_datagrams(self.server_socket, address, packets)
+        except OSError as e:
+            if e.errno != errno.EMSGSIZE:
+                raise
+            # Gói lớn hơn MTU đường truyền (cờ DF): coi như mất, client không nhận được gì sẽ yêu cầu lại với gói nhỏ hơn
+            if not self.oversized:
+                print(f"Gói {payload_size} byte quá lớn cho đường truyền tới {address}, chờ client giảm kích thước gói.")
+                self.oversized = True
+        with self.condition:
+            if generation != self.generation:
+                return
+            now = time.monotonic() # Thời điểm gửi thật sau khi chờ bộ điều tốc
+            for seq in seqs:
+                if seq in self.sent:
+                    self.sent[seq] = now
+
+    def fec_group_size(self): # Số gói dữ liệu cho mỗi gói parity, 0 là không dùng FEC
+        if FEC_MODE == "off":
+            return 0
+        if FEC_MODE != "auto":
+            return int(FEC_MODE)
+        if self.packets_sent < FEC_MIN_SAMPLES:
+            return 0
+        # Tính cả gói đã gửi lại lẫn gói client tự dựng lại, để FEC không tự tắt khi đang có tác dụng
+        loss = (self.congestion.losses + self.congestion.timeouts + self.fec_recovered) / self.packets_sent
+        if loss < FEC_MIN_LOSS:
+            return 0
+        return max(FEC_MIN_GROUP, min(FEC_MAX_GROUP, int(1 / (3 * loss))))
+
+    def send_eof(self):
+        self.server_socket.sendto(PACKET_HEADER.pack(PACKET_VERSION, PACKET_EOF, 0, self.last_seq, 0), self.address)
+
+    def next_packets(self): # Các gói cần gửi bây giờ: gói mới trong cửa sổ, gói fast retransmit, gói hết giờ chờ ACK và gói thăm dò
+        now = time.monotonic()
+        rto = self.congestion.rtt.rto() # Đọc một lần: hết giờ làm RTO nhân đôi
+        packets = sorted(self.retransmit)
+        self.retransmit.clear()
+        for seq, sent_at in self.sent.items():
+            if now - sent_at >= rto and seq not in self.sacked and seq not in packets:
+                packets.append(seq)
+                self.congestion.on_loss(seq, self.next_seq, timeout=True)
+        if not packets and not self.probed and self.next_seq >= self.last_seq:
+            # Cuối lượt không còn gói mới nào kéo theo SACK: gửi lại gói cao nhất chưa được ACK
+            outstanding = [seq for seq in self.sent if seq not in self.sacked]
+            if outstanding and now - max(self.sent[seq] for seq in outstanding) >= self.congestion.rtt.probe_timeout():
+                packets.append(max(outstanding))
+                self.probed = True
+                self.probes += 1
+        self.retransmitted.update(packets)
+        window = self.congestion.window()
+        while self.next_seq < self.last_seq and self.next_seq < self.base + window:
+            packets.append(self.next_seq)
+            self.next_seq += 1
+        for seq in packets:
+            self.sent[seq] = now
+        return packets
+
+    def timer_delay(self): # Số giây tới lần gửi lại hoặc thăm dò sớm nhất, để luồng gửi chờ đúng chừng đó
+        now = time.monotonic()
+        outstanding = [self.sent[seq] for seq in self.sent if seq not in self.sacked]
+        if not outstanding:
+            return self.congestion.rtt.rto()
+        deadline = min(outstanding) + self.congestion.rtt.rto()
+        if not self.probed and self.next_seq >= self.last_seq:
+            deadline = min(deadline, max(outstanding) + self.congestion.rtt.probe_timeout())
+        return max(0.001, deadline - now)
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    if self.cancelled:
+                        return
+                    if self.base >= self.last_seq:
+                        # Đánh dấu xong ngay trong lần giữ lock này để retarget không chen vào giữa
+                        self.finished = True
+                        self.send_eof()
+                        break
+                    if time.monotonic() - self.last_ack > TRANSFER_TIMEOUT:
+                        print(f"Client {self.address} không phản hồi, dừng gửi {self.file_path}.")
+                        self.cancelled = True
+                        return
+                    generation = self.generation
+                    packets = self.next_packets()
+                    if not packets:
+                        self.condition.wait(self.timer_delay())
+                        continue
+                    sample = self.compressible is None and self.compression[0] != CODEC_NONE
+                if sample: # Nén thử ngoài lock, kết quả được nhớ theo phiên bản file
+                    self.compressible = should_compress(self.file_path)
+                pacer = self.congestion.pacer
+                for index in range(0, len(packets), BURST_PACKETS):
+                    burst = packets[index:index + BURST_PACKETS]
+                    # Chỉ chờ khi bộ điều tốc hết token, không ngủ sau từng gói
+                    delay = pacer.delay(len(burst) * self.packet_size)
+                    if delay > 0:
+                        time.sleep(delay)
+                    pacer.consume(len(burst) * self.packet_size)
+                    # Mỗi lượt gửi một loạt gói, các phiên lần lượt xoay vòng
+                    scheduler.acquire(self.session)
+                    try:
+                        self.send_packets(burst, generation)
+                    finally:
+                        scheduler.release()
+            print(f"Đã gửi xong {self.file_path} tới {self.address}: {self.congestion.state()}, {self.probes} gói thăm dò, FEC khôi phục {self.fec_recovered} gói, {self.packets_compressed} gói nén")
+        except Exception as e:
+            print(f"Lỗi trong khi gửi {self.file_path} to {self.address}: {e}")
+
+class ClientSession:
+    """Phiên của một client, theo địa chỉ socket điều khiển của nó."""
+
+    def __init__(self, address):
+        self.address = address
+        self.token = os.urandom(4).hex() # Client gửi kèm trong CHUNK_REQUEST
+        self.last_seen = time.monotonic()
+        self.batch_reply = None # (mã yêu cầu, khung trả lời) của MSG_BATCH gần nhất: client gửi lại thì không lập lô mới
+        self.delta = None # DeltaUpload của lần đồng bộ delta gần nhất
+
+class DeltaUpload:
+    """Chữ ký các khối file cũ của client, gửi lên thành nhiều khung MSG_DELTA (mỗi khung vừa một datagram)."""
+
+    def __init__(self, name, block_size, block_count):
+        self.name = name
+        self.block_size = block_size
+        self.block_count = block_count
+        self.signature = bytearray(block_count * SIGNATURE.size)
+        self.parts = set() # Khối đầu của các khung đã nhận, khung gửi lại không được tính hai lần
+        self.received = 0
+        self.computing = False # Đã bắt đầu dò khối: khung MSG_DELTA mới thuộc lần đồng bộ sau
+        self.reply = None # (loại khung, FILE_INFO, các lệnh chép) khi đã tính xong
+
+    def add(self, first_block, signature): # Trả về False nếu khung không khớp với lần gửi này
+        count = len(signature) // SIGNATURE.size
+        if len(signature) % SIGNATURE.size or first_block + count > self.block_count:
+            return False
+        if first_block not in self.parts:
+            self.parts.add(first_block)
+            self.received += count
+            self.signature[first_block * SIGNATURE.size:(first_block + count) * SIGNATURE.size] = signature
+        return True
+
+    @property
+    def complete(self):
+        return self.received == self.block_count
+
+    def page(self, first): # Trả lời MSG_DELTA_PLAN (loại khung, payload) cho trang bắt đầu từ lệnh chép first
+        kind, info, copies = self.reply
+        if kind != MSG_DELTA_PLAN:
+            return kind, info
+        chunk = copies[first * COPY.size:(first + PLAN_PAGE_COPIES) * COPY.size]
+        return kind, info + PLAN_PAGE.pack(len(copies) // COPY.size) + chunk
+
+def open_session(server_socket, address):
+    now = time.monotonic()
+    for key in [key for key, session in sessions.items() if now - session.last_seen > SESSION_TIMEOUT]:
+        close_session(key)
+    session = sessions.get(address)
+    if session is None:
+        session = ClientSession(address)
+        sessions[address] = session
+        sessions_by_token[session.token] = session
+        print(f"Client {address} đã kết nối ({len(sessions)} phiên).")
+    return session
+
+def close_session(address):
+    session = sessions.pop(address, None)
+    if session is not None:
+        sessions_by_token.pop(session.token, None)
+        # Client đã thoát: hủy các lượt gửi còn dở của nó
+        with transfers_lock:
+            for transfer in transfers.values():
+                if transfer.session == session.token:
+                    transfer.cancel()
+
+def start_transfer(server_socket, address, file_name, chunk_index, start, end, first_seq, token, payload_size, compression):
+    if not listed_source(file_name):
+        # Gói dữ liệu mở đầu bằng PACKET_VERSION nên client phân biệt được khung lỗi này
+        server_socket.sendto(encode(MSG_ERROR, 0, b"NOT_FOUND"), address)
+        return
+    session = sessions_by_token.get(token)
+    # Token không còn phiên (phiên đã hết hạn): lượt gửi thuộc riêng địa chỉ socket chunk
+    owner = session.token if session else address
+    key = (owner, file_name, chunk_index)
+    with transfers_lock:
+        # Dọn các lượt gửi đã xong, bị hủy hoặc bị bỏ từ lâu
+        now = time.monotonic()
+        for old_key, transfer in list(transfers.items()):
+            if transfer.cancelled or (transfer.finished and now - transfer.last_ack > TRANSFER_LINGER) or now - transfer.last_ack > TRANSFER_TIMEOUT:
+                transfer.cancel()
+                del transfers[old_key]
+                if transfers_by_address.get(transfer.address) is transfer:
+                    del transfers_by_address[transfer.address]
+
+        transfer = transfers.get(key)
+        if transfer is not None:
+            if transfer.address == address and (transfer.start, transfer.end, transfer.first_seq, transfer.payload_size, transfer.compression) == (start, end, first_seq, payload_size, compression) and not transfer.finished:
+                return # Yêu cầu trùng (client gửi lại khi chưa nhận được gói nào): gộp vào lượt gửi đang chạy
+            old_address = transfer.address
+            if transfer.retarget(address, start, end, first_seq, payload_size, compression):
+                # Cùng phần nhưng đích hoặc đoạn mới: luồng gửi cũ chuyển sang gửi cho yêu cầu mới
+                if transfers_by_address.get(old_address) is transfer:
+                    del transfers_by_address[old_address]
+                transfers_by_address[address] = transfer
+                return
+        transfer = Transfer(server_socket, address, file_name, start, end, first_seq, owner, payload_size, compression)
+        transfers[key] = transfer
+        transfers_by_address[address] = transfer
+    threading.Thread(target=transfer.run, daemon=True).start()
+
+def send_mtu_probes(server_socket, client_address, request_id):
+    """Gửi một khung MSG_MTU_PROBE cho mỗi MTU trong MTU_CANDIDATES (cờ DF, không phân mảnh), rồi MSG_MTU_PROBE_END.
+
+    Client chọn MTU lớn nhất nhận được nguyên vẹn làm kích thước gói dữ liệu. MTU lớn
+    hơn MTU đường truyền mà server đã biết bị kernel từ chối (EMSGSIZE) nên bỏ qua.
+    """
+    with dont_fragment_lock: # Không gửi gói dò khi cờ DF đang tắt tạm thời (send_large)
+        for mtu in MTU_CANDIDATES:
+            probe = encode(MSG_MTU_PROBE, request_id, MTU_PROBE_HEADER.pack(mtu).ljust(mtu - IP_UDP_OVERHEAD - FRAME_HEADER.size, b"\0"))
+            try:
+                server_socket.sendto(probe, client_address)
+            except OSError as e:
+                if e.errno != errno.EMSGSIZE:
+                    raise
+    server_socket.sendto(encode(MSG_MTU_PROBE_END, request_id), client_address)
+
+def send_digest(server_socket, client_address, file_name, request_id): # Băm file lớn có thể lâu, chạy ngoài vòng nhận
+    digest = catalog.digest(file_name)
+    if digest is not None:
+        server_socket.sendto(encode(MSG_DIGEST_VALUE, request_id, digest.encode(FORMAT)), client_address)
+    else:
+        server_socket.sendto(encode(MSG_NOT_FOUND, request_id), client_address)
+
+def send_delta_plan(server_socket, client_address, upload, request_id, first): # Dò khối có thể mất vài giây, chạy ngoài vòng nhận
+    result = catalog.delta(upload.name, upload.signature, upload.block_size)
+    if result is None:
+        upload.reply = (MSG_NOT_FOUND, b"", b"")
+    else:
+        entry, copies = result
+        if len(copies) > MAX_PLAN_COPIES:
+            # Giữ các đoạn dài nhất, phần bị bỏ client tải lại như bình thường
+            copies = sorted(sorted(copies, key=lambda copy: copy[2], reverse=True)[:MAX_PLAN_COPIES])
+        reused = sum(length for _, _, length in copies)
+        print(f"Đồng bộ delta {upload.name}: client {client_address} dùng lại {reused}/{entry.size} bytes.")
+        upload.reply = (MSG_DELTA_PLAN, FILE_INFO.pack(entry.size, entry.mtime_ns), pack_copies(copies))
+    kind, reply = upload.page(first)
+    server_socket.sendto(encode(kind, request_id, reply), client_address)
+
+def transfer_stats(): # Trạng thái điều khiển tắc nghẽn của các lượt gửi, để tinh chỉnh
+    return json.dumps({f"{address[0]}:{address[1]}": transfer.congestion.state() for address, transfer in list(transfers_by_address.items())})
+
+def send_large(server_socket, data, address):
+    """Gửi khung điều khiển có thể lớn hơn MTU đường truyền (danh sách file, thống kê).
+
+    Socket server bật cờ DF để gói dữ liệu quá lớn báo lỗi ngay và gói dò MTU không bị
+    phân mảnh; khung dài hơn CONTROL_DF_LIMIT được gửi với cờ DF tắt tạm thời để kernel
+    phân mảnh IP thay vì báo EMSGSIZE. Trong lúc đó dont_fragment_lock chặn mọi gói dữ
+    liệu và gói dò MTU, nên chúng không bao giờ đi ra khi cờ DF đang tắt.
+    """
+    if not dont_fragment or len(data) <= CONTROL_DF_LIMIT:
+        server_socket.sendto(data, address)
+        return
+    with dont_fragment_lock:
+        set_dont_fragment(server_socket, False)
+        try:
+            server_socket.sendto(data, address)
+        finally:
+            set_dont_fragment(server_socket)
+
+def handle_frame(server_socket, session, kind, request_id, payload):
+    """Xử lý một khung điều khiển của client; khung trả lời mang cùng mã yêu cầu.
+
+    Client gửi dồn nhiều khung rồi ghép trả lời theo mã yêu cầu, và gửi lại khung chưa
+    có trả lời, nên mọi yêu cầu đều phải trả lời được nhiều lần.
+    """
+    client_address = session.address
+    session.last_seen = time.monotonic()
+
+    if kind == MSG_LIST:
+        send_large(server_socket, encode(MSG_LISTING, request_id, catalog.listing().encode(FORMAT)), client_address)
+
+    elif kind == MSG_STAT:
+        file_name = payload.decode(FORMAT)
+        entry = catalog.lookup(file_name)
+        if entry is not None:
+            print(f"Client {client_address} yêu cầu tải file: {file_name}")
+            server_socket.sendto(encode(MSG_FILE_INFO, request_id, FILE_INFO.pack(entry.size, entry.mtime_ns)), client_address)
+        else:
+            server_socket.sendto(encode(MSG_NOT_FOUND, request_id), client_address)
+
+    elif kind == MSG_DIGEST:
+        threading.Thread(target=send_digest, args=(server_socket, client_address, payload.decode(FORMAT), request_id), daemon=True).start()
+
+    elif kind == MSG_MTU_PROBE:
+        send_mtu_probes(server_socket, client_address, request_id)
+
+    elif kind == MSG_STATS:
+        send_large(server_socket, encode(MSG_STATS_VALUE, request_id, transfer_stats().encode(FORMAT)), client_address)
+
+    elif kind == MSG_BATCH:
+        if session.batch_reply is None or session.batch_reply[0] != request_id:
+            names = payload.decode(FORMAT).split("\n")
+            batch_id, batch_size = create_batch(names)
+            print(f"Client {client_address} tải gộp {len(names)} file (lô {batch_id}).")
+            session.batch_reply = (request_id, encode(MSG_BATCH_INFO, request_id, BATCH_INFO.pack(batch_id, batch_size)))
+        server_socket.sendto(session.batch_reply[1], client_address)
+
+    elif kind == MSG_DELTA:
+        block_size, first_block, block_count, name_length = DELTA.unpack_from(payload)
+        name = payload[DELTA.size:DELTA.size + name_length].decode(FORMAT)
+        upload = session.delta
+        if upload is None or upload.computing or (upload.name, upload.block_size, upload.block_count) != (name, block_size, block_count):
+            upload = session.delta = DeltaUpload(name, block_size, block_count) if valid_block_size(block_size) and block_count <= MAX_DELTA_BLOCKS else None
+        if upload is not None and upload.add(first_block, payload[DELTA.size + name_length:]):
+            server_socket.sendto(encode(MSG_DELTA_ACK, request_id), client_address)
+        else:
+            server_socket.sendto(encode(MSG_ERROR, request_id, "Chữ ký khối không hợp lệ.".encode(FORMAT)), client_address)
+
+    elif kind == MSG_DELTA_PLAN:
+        first = PLAN_PAGE.unpack_from(payload)[0]
+        upload = session.delta
+        if upload is None or upload.name != payload[PLAN_PAGE.size:].decode(FORMAT) or not upload.complete:
+            server_socket.sendto(encode(MSG_ERROR, request_id, "Chưa nhận đủ chữ ký khối.".encode(FORMAT)), client_address)
+        elif upload.reply is not None:
+            kind, reply = upload.page(first)
+            server_socket.sendto(encode(kind, request_id, reply), client_address)
+        elif not upload.computing:
+            upload.computing = True
+            threading.Thread(target=send_delta_plan, args=(server_socket, client_address, upload, request_id, first), daemon=True).start()
+        # Đang dò khối: yêu cầu gửi lại được trả lời khi tính xong (cùng mã yêu cầu)
+
+    elif kind == MSG_BATCH_DONE:
+        batches.pop(BATCH_INFO.unpack(payload)[0], None)
+
+    elif kind == MSG_DONE:
+        pass # Client báo đã tải xong file, không cần trả lời
+
+    elif kind == MSG_QUIT:
+        print(f"Ngắt kết nối với client {client_address}")
+        close_session(client_address)
+
+    else:
+        server_socket.sendto(encode(MSG_ERROR, request_id, f"Loại khung không hợp lệ: {kind}".encode(FORMAT)), client_address)
+
+def handle_hello(server_socket, address, request_id, payload):
+    """Bắt tay: MSG_WELCOME mang phiên bản dùng chung, vai trò và token phiên."""
+    try:
+        version, role = negotiate(payload)
+    except ProtocolError as e:
+        server_socket.sendto(encode(MSG_ERROR, request_id, str(e).encode(FORMAT)), address)
+        return
+    session = open_session(server_socket, address)
+    server_socket.sendto(encode(MSG_WELCOME, request_id, HELLO.pack(version, role) + session.token.encode(FORMAT)), address)
 
 def run_server():
+    """Một vòng nhận duy nhất, chuyển từng gói tới lượt gửi hoặc phiên client tương ứng."""
+    global catalog, dont_fragment
+    catalog = FileCatalog(".", "files.txt")
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
         server_socket.bind((HOST, PORT))
+        # Không phân mảnh IP: gói quá lớn báo lỗi ngay, mất một mảnh không làm mất cả gói
+        dont_fragment = set_dont_fragment(server_socket)
+        print(f"Server đang chạy với IP: {HOST} ... PORT: {PORT}")
 
         while True:
             try:
-                print(f"Server đang chạy với IP: {HOST} ... PORT: {PORT}")
-                socket_type, client_address = server_socket.recvfrom(1024)
-                if socket_type.decode(FORMAT) == "CLIENT":
-                    print(f"Client {client_address} đã kết nối.")
-                    handle_client(server_socket, client_address)
+                # Yêu cầu tải gộp có thể dài
+                data, addr = server_socket.recvfrom(65535)
+
+                # Khung điều khiển của client dùng giao thức khung
+                if is_frame(data):
+                    kind, request_id, payload = decode(data)
+                    if kind == MSG_HELLO:
+                        handle_hello(server_socket, addr, request_id, payload)
+                    else:
+                        handle_frame(server_socket, sessions.get(addr) or open_session(server_socket, addr), kind, request_id, payload)
+                    continue
+
+                # Chỉ SACK và CHUNK_REQUEST (đi trên socket chunk của client) còn là văn bản
+                request = data.decode(FORMAT)
+
+                # Handle ACK: ACK tích lũy + bitmap các gói nhận được sau đó
+                if request.startswith("SACK:"):
+                    transfer = transfers_by_address.get(addr)
+                    if transfer is not None:
+                        try:
+                            _, cumulative, bitmap, *recovered = request.split(":")
+                            transfer.on_ack(int(cumulative), int(bitmap, 16), int(recovered[0]) if recovered else 0)
+                        except ValueError:
+                            print(f"ACK Không họp lệ: {request}")
+
+                # Handle chunk download request (từ socket chunk riêng của client, kèm token phiên)
+                elif request.startswith("CHUNK_REQUEST:"):
+                    _, file_name, chunk_index, start, end, seq_num, token, payload_size, codec, level = request.split(":")
+                    start, end, seq_num = map(int, [start, end, seq_num])
+                    # Số byte dữ liệu mỗi gói client đã dò được
+                    payload_size = max(MIN_PAYLOAD, min(MAX_PAYLOAD, int(payload_size)))
+                    # Bộ nén và mức nén client đề nghị
+                    compression = (CODEC_NONE, 0)
+                    if compression_enabled and valid_codec(int(codec), int(level)):
+                        compression = (int(codec), int(level))
+                    start_transfer(server_socket, addr, file_name, int(chunk_index), start, end, seq_num, token, payload_size, compression)
+
                 else:
-                    print(f"Yêu cầu không hợp lệ từ {client_address}")
-                    type = socket_type.decode(FORMAT)
-                    print(f"{type}\n")
+                    print(f"Bỏ qua gói không hợp lệ từ {addr}")
 
             except Exception as e:
                 print(f"Lỗi tiến trình không hợp lệ từ: {e}")
 
 def main():
+    global FEC_MODE, compression_enabled
+    parser = argparse.ArgumentParser(description="Server UDP tải file")
+    parser.add_argument("--fec", default=FEC_MODE,
+                        help='Sửa lỗi trước bằng parity: "auto" (theo tỉ lệ mất gói), "off", hoặc số gói dữ liệu mỗi gói parity')
+    parser.add_argument("--compression", choices=("auto", "off"), default="auto",
+                        help='"auto": nén gói theo yêu cầu của client nếu file nén được, "off": luôn gửi thô')
+    args = parser.parse_args()
+    if args.fec not in ("auto", "off") and not args.fec.isdigit():
+        parser.error("--fec phải là auto, off hoặc một số nguyên")
+    FEC_MODE = args.fec
+    compression_enabled = args.compression == "auto"
     try:
         run_server()
     except KeyboardInterrupt:
         print("Server dừng!")
+        print(f"Thống kê cache: {file_cache.stats()}")
+        print(f"Thống kê nén: {compression_sampler.stats()}")
     except Exception as E:
         print(f"Error: {E}")
 